@@ -0,0 +1,36 @@
+''' Measures the time of "import opentidalfarm" in a fresh interpreter and
+the time spent in the optional dependencies, which are only imported once
+the tidal forcing or bathymetry classes are used. The import time of the
+optional dependencies should not be part of "import opentidalfarm". '''
+import subprocess
+import sys
+import time
+
+repetitions = 5
+
+
+def import_time(statement):
+    """ Returns the minimum run time of the statement in a fresh interpreter
+    over all repetitions. """
+    times = []
+    for i in range(repetitions):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", statement])
+        times.append(time.time() - start)
+    return min(times)
+
+
+baseline = import_time("pass")
+otf = import_time("import opentidalfarm")
+
+print "Statement\t\t\t\ttime (s)"
+print "%-40s%.3f" % ("import opentidalfarm", otf - baseline)
+
+for module in ["uptide", "utm", "yaml", "scipy.interpolate"]:
+    try:
+        __import__(module)
+    except ImportError:
+        print "%-40s(not installed)" % ("+ import %s" % module)
+        continue
+    t = import_time("import opentidalfarm; import %s" % module)
+    print "%-40s%.3f" % ("+ import %s" % module, t - otf)
@@ -0,0 +1,57 @@
+''' Compares the run time of the direct (MUMPS) and the iterative (GMRES with
+a field-split preconditioner) linear solvers of the coupled shallow water
+solver for a steady-state problem on the headland mesh and on a sequence of
+refined channel meshes. '''
+import time
+from opentidalfarm import *
+set_log_level(ERROR)
+
+
+def steady_problem(domain, inflow_facet_id, outflow_facet_id, wall_facet_id):
+    prob_params = SteadySWProblem.default_parameters()
+    prob_params.domain = domain
+
+    bcs = BoundaryConditionSet()
+    bcs.add_bc("u", Constant((2, 0)), facet_id=inflow_facet_id)
+    bcs.add_bc("eta", Constant(0), facet_id=outflow_facet_id)
+    bcs.add_bc("u", Constant((0, 0)), facet_id=wall_facet_id,
+               bctype="strong_dirichlet")
+    prob_params.bcs = bcs
+
+    prob_params.viscosity = Constant(5)
+    prob_params.depth = Constant(50)
+    prob_params.friction = Constant(0.0025)
+    prob_params.initial_condition = Constant((2, 0, 0))
+    return SteadySWProblem(prob_params)
+
+
+def run(problem, iterative):
+    sol_params = CoupledSWSolver.default_parameters()
+    sol_params.dump_period = -1
+    sol_params.iterative_solver = iterative
+    solver = CoupledSWSolver(problem, sol_params)
+
+    start = time.time()
+    for s in solver.solve(annotate=False):
+        pass
+    return time.time() - start, s["state"]
+
+
+problems = [("headland", steady_problem(
+    FileDomain("../../headland-simulation/mesh/headland.xml"), 1, 2, 3))]
+for n in [32, 64, 128]:
+    domain = RectangularDomain(x0=0, y0=0, x1=3000, y1=1000, nx=3*n, ny=n)
+    problems.append(("channel %ix%i" % (3*n, n),
+                     steady_problem(domain, 1, 2, 3)))
+
+print "Mesh\t\t\tDOFs\tMUMPS (s)\tGMRES (s)\tRelative difference"
+for name, problem in problems:
+    direct_time, direct_state = run(problem, iterative=False)
+    direct_state = direct_state.copy(deepcopy=True)
+    iterative_time, iterative_state = run(problem, iterative=True)
+
+    difference = (norm(direct_state.vector() - iterative_state.vector()) /
+                  norm(direct_state.vector()))
+    print "%s\t\t%i\t%.2f\t\t%.2f\t\t%.2e" % (name,
+        direct_state.function_space().dim(), direct_time, iterative_time,
+        difference)
@@ -0,0 +1,30 @@
+''' Measures the run time of the minimum distance constraint for large arrays
+with up to 10,000 turbines. The turbines are placed randomly with a constant
+density, so the number of turbine pairs within the minimum distance grows
+linearly with the number of turbines. '''
+import time
+import numpy
+from opentidalfarm import *
+set_log_level(ERROR)
+
+minimum_distance = 40.
+# The site area per turbine
+area_per_turbine = 100.**2
+
+print "Turbines\tfunction (s)\tjacobian (s)"
+for n in [100, 1000, 10000]:
+    numpy.random.seed(0)
+    width = (n*area_per_turbine)**0.5
+    m = numpy.random.rand(2*n)*width
+
+    ieq = MinimumDistanceConstraintsLargeArrays(m, minimum_distance, 0)
+
+    start = time.time()
+    ieq.function(m)
+    function_time = time.time() - start
+
+    start = time.time()
+    ieq.jacobian(m)
+    jacobian_time = time.time() - start
+
+    print "%i\t\t%.4f\t\t%.4f" % (n, function_time, jacobian_time)
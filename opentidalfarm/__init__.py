@@ -14,6 +14,10 @@ __email__ = 'simon.funke@gmail.com'
 import finite_elements
 import helpers
 
+# The subpackages are imported eagerly, since the public API is the flat
+# namespace of ``from opentidalfarm import *``, which Python 2 cannot populate
+# lazily. Their optional and slow dependencies are imported on first use
+# instead, see helpers.LazyModule.
 from farm import *
 from turbines import *
 from solvers import *
@@ -32,9 +36,8 @@ from dolfin import parameters
 from dolfin_adjoint import minimize, maximize, Function, solve, Control, \
                            Constant
 
+# This stays an import side effect: the representation applies to every form
+# that is compiled with the turbine, functional and solver expressions of this
+# package, including the forms that users assemble before or without a solve,
+# and the forms of the thrust curves and friction terms need uflacs.
 parameters["form_compiler"]["representation"] = "uflacs"
-
-# We set the perturbation_direction with a constant seed, so that it is
-# consistent in a parallel environment.
-import numpy
-numpy.random.seed(21)
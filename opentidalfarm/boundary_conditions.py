@@ -4,6 +4,8 @@ class BoundaryConditionSet(list):
     """ Stores a list of boundary conditions.
     Expression with an attribute named t will be
     automatically updated to the current timestep during the simultion.
+    Objects with a set_time method, such as :class:`BoundaryTidalForcing`, are
+    updated by calling it.
     """
 
     def update_time(self, t, only_type=None, exclude_type=None):
@@ -18,7 +20,9 @@ class BoundaryConditionSet(list):
             if bc[-1] in exclude_type:
                 continue
 
-            if hasattr(bc[1], "t"):
+            if hasattr(bc[1], "set_time"):
+                bc[1].set_time(t)
+            elif hasattr(bc[1], "t"):
                 bc[1].t = t
 
     def add_bc(self, function_name, expression=None, facet_id=None, bctype="strong_dirichlet"):
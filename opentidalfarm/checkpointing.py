@@ -0,0 +1,97 @@
+from dolfin import *
+from dolfin_adjoint import *
+
+
+def binomial_forward_steps(steps, snaps):
+    """ Returns the repetition number and the number of forward steps of the
+    optimal binomial checkpointing schedule (revolve) for reversing the given
+    number of timesteps with the given number of snapshots.
+
+    The repetition number r is the smallest integer such that
+    :math:`\\binom{s + r}{s} \\geq l`, where s is the number of snapshots and l
+    the number of timesteps. Each timestep is then evaluated at most r times,
+    and the schedule requires :math:`r l - \\binom{s + r}{s + 1}` forward
+    steps (Griewank and Walther, 2000).
+    """
+    from scipy.special import comb
+
+    if snaps < 1:
+        raise ValueError("At least one snapshot is required.")
+
+    r = 0
+    while comb(snaps + r, snaps, exact=True) < steps:
+        r += 1
+    return r, r*steps - comb(snaps + r, snaps + 1, exact=True)
+
+
+class CheckpointSchedule(object):
+    """ Chooses the adjoint checkpointing schedule for a memory budget.
+
+    The number of snapshots is the number of states that fit into the memory
+    and disk budgets. If all timesteps fit into memory, no checkpointing is
+    used. Otherwise a multistage revolve schedule is used, which keeps the
+    first snapshots in memory and the remaining ones on disk.
+
+    :param steps: The number of timesteps.
+    :param state_bytes: The size of the state of one timestep in bytes.
+    :param memory_budget: The memory budget for the snapshots in bytes.
+    :param disk_budget: The disk budget for the snapshots in bytes. Default:
+        None (no snapshots on disk)
+    """
+
+    def __init__(self, steps, state_bytes, memory_budget, disk_budget=None):
+        self.steps = steps
+        self.state_bytes = state_bytes
+
+        self.snaps_in_ram = int(memory_budget // state_bytes)
+        self.snaps_on_disk = 0
+        if disk_budget is not None:
+            self.snaps_on_disk = int(disk_budget // state_bytes)
+
+        #: True if the states do not all fit into memory.
+        self.active = self.snaps_in_ram < steps
+        if not self.active:
+            self.repetitions = 1
+            self.recomputed_steps = 0
+            return
+
+        if self.snaps_in_ram + self.snaps_on_disk < 1:
+            raise ValueError("The checkpointing budget is too small for a "
+                             "single state of %i bytes." % state_bytes)
+
+        self.repetitions, forward_steps = binomial_forward_steps(steps,
+            self.snaps_in_ram + self.snaps_on_disk)
+        # The first forward run advances steps-1 timesteps before the first
+        # adjoint step, everything beyond is recomputation.
+        self.recomputed_steps = max(0, forward_steps - (steps - 1))
+
+    @staticmethod
+    def state_size(function_space, functions=2):
+        """ Estimates the size in bytes of the snapshot of a timestep, which
+        consists of the given number of functions. In parallel, this is the
+        largest processor-local size, so that all processors choose the same
+        schedule. """
+        start, end = function_space.dofmap().ownership_range()
+        local_size = functions*(end - start)*8
+        return int(MPI.max(function_space.mesh().mpi_comm(), local_size))
+
+    def __str__(self):
+        if not self.active:
+            return ("No adjoint checkpointing: %i timesteps of %i bytes fit "
+                    "into memory." % (self.steps, self.state_bytes))
+
+        return ("Adjoint checkpointing of %i timesteps with %i snapshots in "
+                "memory and %i on disk: each timestep is computed at most %i "
+                "times, %i timesteps are recomputed (%.0f%% overhead)." %
+                (self.steps, self.snaps_in_ram, self.snaps_on_disk,
+                 self.repetitions, self.recomputed_steps,
+                 100.*self.recomputed_steps/self.steps))
+
+    def apply(self, verbose=False):
+        """ Configures dolfin-adjoint with this schedule. Must be called after
+        adj_reset and before the forward run. """
+        if self.active:
+            adj_checkpointing("multistage", self.steps,
+                              snaps_on_disk=self.snaps_on_disk,
+                              snaps_in_ram=self.snaps_in_ram,
+                              verbose=verbose)
@@ -1,11 +1,18 @@
 import os.path
+import hashlib
 import dolfin
 from domain import Domain
+from ..helpers import call_on_first_processor
 
 
 class FileDomain(Domain):
     """ Create a domain from DOLFIN mesh files (.xml).
 
+    If a cache file is given, the mesh and its markers are cached in this
+    HDF5 file on the first load. Subsequent loads read the HDF5 file in
+    parallel, with each processor reading its own partition, as long as the
+    hashes of the .xml files are unchanged.
+
     :param mesh_file: The .xml file of the mesh.
     :type mesh_file: str
     :param facet_ids_file: The .xml file containing the facet ids of the mesh.
@@ -14,12 +21,20 @@ class FileDomain(Domain):
     :param cell_ids_file: The .xml file containing the cell ids of the mesh.
         If None, the default is to `mesh_file` + "_physical_region.xml".
     :type cell_ids_file: str
+    :param cache_file: The HDF5 cache file. Domains on different
+        communicators must not share a cache file. If None, the mesh is not
+        cached. Default: None
+    :type cache_file: str
+    :param comm: The MPI communicator of the mesh. If None, the default is to
+        use all processors.
     """
 
-    def __init__(self, mesh_file, facet_ids_file=None, cell_ids_file=None):
+    def __init__(self, mesh_file, facet_ids_file=None, cell_ids_file=None,
+                 cache_file=None, comm=None):
 
-        #: A :class:`dolfin.Mesh` containing the mesh.
-        self.mesh = dolfin.Mesh(mesh_file)
+        if comm is None:
+            comm = dolfin.mpi_comm_world()
+        self._comm = comm
 
         # Read facet markers
         if facet_ids_file is None:
@@ -31,12 +46,80 @@ class FileDomain(Domain):
             cell_ids_file = (os.path.splitext(mesh_file)[0] +
                             "_physical_region.xml")
 
-        #: A :class:`dolfin.FacetFunction` containing the surface markers.
-        self.facet_ids = dolfin.MeshFunction("size_t", self.mesh, facet_ids_file)
+        if cache_file is not None:
+            xml_hash = _files_hash(comm, [mesh_file, facet_ids_file,
+                                          cell_ids_file])
+            if not self._read_cache(cache_file, xml_hash):
+                self._read_xml(mesh_file, facet_ids_file, cell_ids_file)
+                self._write_cache(cache_file, xml_hash)
+        else:
+            self._read_xml(mesh_file, facet_ids_file, cell_ids_file)
+
         #: A :class:`dolfin.Measure` for the facet parts.
         self._ds = dolfin.Measure('ds')(subdomain_data=self.facet_ids)
+        #: A :class:`dolfin.Measure` for the cell subdomains.
+        self._dx = dolfin.Measure("dx")(subdomain_data=self.cell_ids)
 
+    def _read_xml(self, mesh_file, facet_ids_file, cell_ids_file):
+        #: A :class:`dolfin.Mesh` containing the mesh.
+        self.mesh = dolfin.Mesh(self._comm, mesh_file)
+        #: A :class:`dolfin.FacetFunction` containing the surface markers.
+        self.facet_ids = dolfin.MeshFunction("size_t", self.mesh,
+                                             facet_ids_file)
         #: A :class:`dolfin.CellFunction` containing the area markers.
         self.cell_ids = dolfin.MeshFunction("size_t", self.mesh, cell_ids_file)
-        #: A :class:`dolfin.Measure` for the cell subdomains.
-        self._dx = dolfin.Measure("dx")(subdomain_data=self.cell_ids)
+
+    def _read_cache(self, cache_file, xml_hash):
+        """ Reads the mesh and the markers from the cache file. Returns False
+        if the cache file does not exist or is out of date. """
+        if not os.path.isfile(cache_file):
+            return False
+
+        comm = self._comm
+        f = dolfin.HDF5File(comm, cache_file, "r")
+        try:
+            if (not f.has_dataset("mesh") or
+                f.attributes("mesh")["xml_hash"] != xml_hash):
+                return False
+
+            dolfin.info("Read mesh from cache file %s." % cache_file)
+            self.mesh = dolfin.Mesh(comm)
+            f.read(self.mesh, "mesh", False)
+            dim = self.mesh.topology().dim()
+            self.facet_ids = dolfin.MeshFunction("size_t", self.mesh, dim - 1)
+            f.read(self.facet_ids, "facet_ids")
+            self.cell_ids = dolfin.MeshFunction("size_t", self.mesh, dim)
+            f.read(self.cell_ids, "cell_ids")
+        finally:
+            f.close()
+        return True
+
+    def _write_cache(self, cache_file, xml_hash):
+        """ Writes the mesh and the markers to the cache file. """
+        try:
+            f = dolfin.HDF5File(self.mesh.mpi_comm(), cache_file, "w")
+        except RuntimeError:
+            dolfin.warning("Could not create the mesh cache file %s." %
+                           cache_file)
+            return
+
+        dolfin.info("Write mesh to cache file %s." % cache_file)
+        f.write(self.mesh, "mesh")
+        f.attributes("mesh")["xml_hash"] = xml_hash
+        f.write(self.facet_ids, "facet_ids")
+        f.write(self.cell_ids, "cell_ids")
+        f.close()
+
+
+def _files_hash(comm, filenames):
+    """ Returns the SHA1 hash of the contents of the given files. The files
+    are read on the first processor of the communicator only. """
+    def files_hash():
+        sha = hashlib.sha1()
+        for filename in filenames:
+            with open(filename, "rb") as f:
+                for chunk in iter(lambda: f.read(2**20), b""):
+                    sha.update(chunk)
+        return sha.hexdigest()
+
+    return call_on_first_processor(comm, files_hash)
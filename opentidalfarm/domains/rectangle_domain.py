@@ -18,12 +18,14 @@ class RectangularDomain(Domain):
     :type ny: int
     :param ny: The number of elements in the y direction
     :type ny: int
+    :param comm: The MPI communicator of the mesh. If None, the default is to
+        use all processors.
     """
 
 
-    def __init__(self, x0, y0, x1, y1, nx, ny):
+    def __init__(self, x0, y0, x1, y1, nx, ny, comm=None):
         #: A :class:`dolfin.Mesh` containing the mesh.
-        mpi_comm = dolfin.mpi_comm_world()
+        mpi_comm = comm if comm is not None else dolfin.mpi_comm_world()
         self.mesh = dolfin.RectangleMesh(mpi_comm, dolfin.Point(x0, y0),
                 dolfin.Point(x1, y1), nx, ny)
 
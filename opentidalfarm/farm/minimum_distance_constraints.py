@@ -1,6 +1,9 @@
 import dolfin_adjoint
 import dolfin
 import numpy
+from ..turbine_distances import turbine_pairs, squared_distances, \
+                                squared_distances_jacobian, \
+                                check_cutoff, unconstrained_pairs
 
 class MinimumDistanceConstraints(dolfin_adjoint.InequalityConstraint):
     """This class implements minimum distance constraints between turbines.
@@ -17,14 +20,24 @@ class MinimumDistanceConstraints(dolfin_adjoint.InequalityConstraint):
             http://dolfin-adjoint.org/documentation/api.html#dolfin_adjoint.InequalityConstraint
 
     """
-    def __init__(self, turbine_positions, minimum_distance, controls):
+    def __init__(self, turbine_positions, minimum_distance, controls,
+                 cutoff=None):
         """Create MinimumDistanceConstraints
 
         :param serialized_turbines: The serialized turbine paramaterisation.
         :type serialized_turbines: numpy.ndarray.
         :param minimum_distance: The minimum distance allowed between turbines.
         :type minimum_distance: float.
-        :raises: NotImplementedError
+        :param cutoff: If given, only the turbine pairs that are closer than
+            this distance at the given turbine positions are constrained.
+            Otherwise all pairs are constrained.
+            The pairs that are not constrained individually, but come closer
+            than the minimum distance during the optimisation, are penalised
+            in one additional constraint (as in
+            :class:`MinimumDistanceConstraintsLargeArrays`). The cutoff must
+            not be smaller than the minimum distance.
+        :type cutoff: float.
+        :raises: NotImplementedError, ValueError
 
 
         """
@@ -37,21 +50,27 @@ class MinimumDistanceConstraints(dolfin_adjoint.InequalityConstraint):
         self._minimum_distance = minimum_distance
         self._controls = controls
 
+        # The constrained turbine pairs. If None, all pairs are constrained.
+        self._pairs = None
+        check_cutoff(cutoff, minimum_distance)
+        if cutoff is not None:
+            self._pairs = turbine_pairs(numpy.reshape(self._turbines, (-1, 2)),
+                                         cutoff)
 
-    def _sl2norm(self, x):
-        """Calculates the squared l2norm of a vector x."""
-        return sum([v**2 for v in x])
+
+    def _get_pairs(self, xy):
+        """Returns the index arrays of the constrained turbine pairs."""
+        if self._pairs is not None:
+            return self._pairs
+        return turbine_pairs(xy)
 
 
     def length(self):
         """Returns the number of constraints ``len(function(m))``."""
-        n_constraints = 0
-        for i in range(len(self._turbines)):
-          for j in range(len(self._turbines)):
-            if i <= j:
-              continue
-            n_constraints += 1
-        return n_constraints
+        if self._pairs is not None:
+            return len(self._pairs[0]) + 1
+        n_turbines = len(self._turbines) / 2
+        return n_turbines * (n_turbines-1) / 2
 
 
     def function(self, m):
@@ -64,20 +83,27 @@ class MinimumDistanceConstraints(dolfin_adjoint.InequalityConstraint):
 
         """
         dolfin.log(dolfin.PROGRESS, "Calculating minimum distance constraints.")
-        inequality_constraints = []
-        for i in range(len(m)/2):
-            for j in range(len(m)/2):
-                if i <= j:
-                    continue
-                inequality_constraints.append(self._sl2norm([m[2*i]-m[2*j],
-                                                             m[2*i+1]-m[2*j+1]])
-                                              - self._minimum_distance**2)
-
-        inequality_constraints = numpy.array(inequality_constraints)
+        xy = numpy.reshape(m, (-1, 2))
+
+        i, j = self._get_pairs(xy)
+        inequality_constraints = (squared_distances(xy, i, j)
+                                  - self._minimum_distance**2)
+
         if any(inequality_constraints <= 0):
             dolfin.log(dolfin.WARNING,
                        "Minimum distance inequality constraints (should all "
                        "be > 0): %s" % inequality_constraints)
+        if self._pairs is not None:
+            i, j = unconstrained_pairs(xy, self._pairs, self._minimum_distance)
+            if len(i) > 0:
+                dolfin.log(dolfin.WARNING,
+                           "%i turbine pairs violate the minimum distance, but "
+                           "are not constrained individually. Consider "
+                           "increasing the cutoff distance." % len(i))
+            penalty = (squared_distances(xy, i, j)
+                       - self._minimum_distance**2).sum()
+            inequality_constraints = numpy.append(inequality_constraints,
+                                                  penalty)
         return inequality_constraints
 
 
@@ -95,30 +121,24 @@ class MinimumDistanceConstraints(dolfin_adjoint.InequalityConstraint):
         """
         dolfin.log(dolfin.PROGRESS, "Calculating the jacobian of minimum "
                    "distance constraints function.")
-        inequality_constraints = []
-
-        for i in range(len(m)/2):
-            for j in range(len(m)/2):
-                if i <= j:
-                    continue
-
-                # Need to add space for zeros for the friction
-                if self._controls.position and self._controls.friction:
-                    prime_inequality_constraints = numpy.zeros(len(m*3/2))
-                    friction_length = len(m)/2
-                else:
-                    prime_inequality_constraints = numpy.zeros(len(m))
-                    friction_length = 0
-
-                # Provide a shorter handle
-                p_ineq_c = prime_inequality_constraints
-
-                # The control vector contains the friction coefficients first,
-                # so we need to shift here
-                p_ineq_c[friction_length+2*i] = 2*(m[2*i] - m[2*j])
-                p_ineq_c[friction_length+2*j] = -2*(m[2*i] - m[2*j])
-                p_ineq_c[friction_length+2*i+1] = 2*(m[2*i+1] - m[2*j+1])
-                p_ineq_c[friction_length+2*j+1] = -2*(m[2*i+1] - m[2*j+1])
-                inequality_constraints.append(p_ineq_c)
-
-        return numpy.array(inequality_constraints)
+        xy = numpy.reshape(m, (-1, 2))
+
+        # Need to add space for zeros for the friction
+        if self._controls.position and self._controls.friction:
+            friction_length = len(xy)
+        else:
+            friction_length = 0
+
+        # The control vector contains the friction coefficients first,
+        # so we need to shift here
+        i, j = self._get_pairs(xy)
+        jacobian = squared_distances_jacobian(xy, i, j, friction_length,
+                                               friction_length + len(m))
+        jacobian = jacobian.toarray()
+        if self._pairs is not None:
+            i, j = unconstrained_pairs(xy, self._pairs, self._minimum_distance)
+            penalty = squared_distances_jacobian(xy, i, j, friction_length,
+                                                 friction_length + len(m))
+            penalty = penalty.sum(axis=0)
+            jacobian = numpy.vstack((jacobian, numpy.asarray(penalty)))
+        return jacobian
@@ -54,5 +54,5 @@ class CostFunctional(PrototypeFunctional):
 
         """
         turbine_field_individual = \
-                self.farm.turbine_cache['turbine_field_individual'][i]
+                self.farm.turbine_cache.turbine_field_individual(i)
         return assemble(self._cost(turbine_field_individual)*self.farm.site_dx)
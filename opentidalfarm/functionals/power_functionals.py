@@ -51,6 +51,6 @@ class PowerFunctional(PrototypeFunctional):
 
         """
         turbine_field_individual = \
-                self.farm.turbine_cache['turbine_field_individual'][i]
+                self.farm.turbine_cache.turbine_field_individual(i)
         u = sqrt(dot(state[0], state[0]) + dot(state[1], state[1]))
         return self.rho * self.farm.power_integral(u, tf=turbine_field_individual)
@@ -47,5 +47,5 @@ class H01Regularisation(PrototypeFunctional):
 
         """
         turbine_field_individual = \
-                self.farm.turbine_cache['turbine_field_individual'][i]
+                self.farm.turbine_cache.turbine_field_individual(i)
         return assemble(self.Jt(None, turbine_field_individual))
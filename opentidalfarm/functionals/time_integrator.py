@@ -1,4 +1,5 @@
 import numpy
+import dolfin
 from dolfin import *
 from dolfin_adjoint import *
 from ..problems import MultiSteadySWProblem
@@ -11,14 +12,55 @@ class TimeIntegrator(object):
         self.functional = functional
         self.final_only = final_only
 
+        # The time levels of a multi steady-state problem may be distributed
+        # over groups of processors.
+        self.partition = None
+        if type(self.problem) == MultiSteadySWProblem:
+            self.partition = self.problem.parameters.time_level_partition
+
         self.vals = []
         self.times = []
+        self.local_times = []
+
+        # The solvers yield the same state and turbine field objects at every
+        # time level, hence the functional form is compiled once for each
+        # pair and only reassembled afterwards. The counters refer to these
+        # forms only, not to the JIT cache of the form compiler.
+        self._forms = {}
+        self.compiled_forms = 0
+        self.reused_forms = 0
+        self.form_compile_time = 0.
 
     def add(self, time, state, tf, is_final):
         if not self.final_only or (self.final_only and is_final):
-            val = assemble(self.functional.Jt(state, tf))
+            val = dolfin.assemble(self._compiled_form(state, tf))
             self.vals.append(val)
             self.times.append(time)
+            self.local_times.append(time)
+
+    def _compiled_form(self, state, tf):
+        """ Returns the compiled functional form for the given state and
+        turbine field. """
+        key = (id(state), id(tf))
+        if key in self._forms:
+            self.reused_forms += 1
+            return self._forms[key][-1]
+
+        self.compiled_forms += 1
+        timer = dolfin.Timer("functional form compilation")
+        form = dolfin.Form(self.functional.Jt(state, tf))
+        self.form_compile_time += timer.stop()
+
+        # Keep references to the coefficients so that their ids stay unique
+        self._forms[key] = (state, tf, form)
+        return form
+
+    def gather(self):
+        """ Gathers the functional values of the time levels solved by the
+        other processor groups of a time level partition. """
+        if self.partition is not None:
+            self.times, self.vals = self.partition.gather(self.local_times,
+                                                          self.vals)
 
     def integrate(self):
         """ Integrats the functional with a second order scheme. """
@@ -32,7 +74,11 @@ class TimeIntegrator(object):
         # FIXME: Don't assume constant timesteps
         dt = self.times[1]-self.times[0]
 
-        # Compute quadrature weights
+        return sum(self._weights() * dt * self.vals)
+
+    def _weights(self):
+        """ Returns the quadrature weights of the time levels. """
+
         w = numpy.ones(len(self.times))
 
         # The multi-steady state case is special in that we want to integrate
@@ -45,7 +91,7 @@ class TimeIntegrator(object):
             w[0] = 0.5
         w[-1] += 0.5
 
-        return sum(w * dt * self.vals)
+        return w
 
     def dolfin_adjoint_functional(self, state):
         """ Constructs the dolfin-adjoint.Functional """
@@ -55,12 +101,39 @@ class TimeIntegrator(object):
         # to create a dummy function with the appropriate name.
         R = FunctionSpace(self.problem.parameters.domain.mesh, "R", 0)
         tf = Function(R, name="turbine_friction")
+        Jt = self.functional.Jt(state, tf)
+
+        if self.partition is not None:
+            return Functional(self._partitioned_form(Jt))
 
         if self.final_only:
-            return Functional(self.functional.Jt(state, tf) * dt[FINISH_TIME])
+            return Functional(Jt * dt[FINISH_TIME])
 
         if type(self.problem) == MultiSteadySWProblem:
-            return Functional(self.functional.Jt(state, tf) *
-                    dt[float(self.times[1]):])
+            return Functional(Jt * dt[float(self.times[1]):])
+        else:
+            return Functional(Jt * dt)
+
+    def _partitioned_form(self, Jt):
+        """ Returns the quadrature of Jt over the time levels solved by the
+        processor group of this processor. The gradients of the groups sum up
+        to the gradient of the full functional. """
+        if self.final_only:
+            w = numpy.zeros(len(self.times))
+            w[-1] = 1.
         else:
-            return Functional(self.functional.Jt(state, tf) * dt)
+            w = self._weights()*(self.times[1]-self.times[0])
+
+        J = None
+        for t, weight in zip(self.times, w):
+            if weight == 0 or t not in self.local_times:
+                continue
+            term = weight*Jt*dt[t]
+            J = term if J is None else J + term
+
+        if J is None:
+            # This group has no contribution. The tape of the group ends with
+            # its last time level, which may differ from the finish time of
+            # the problem, hence the form refers to a recorded time level.
+            J = 0*Jt*dt[self.local_times[-1]]
+        return J
@@ -1,11 +1,33 @@
 import random
-import yaml
+import importlib
 import os.path
 import dolfin
 import numpy
 import itertools
 from dolfin import *
 from dolfin_adjoint import *
+from profiling import profiled
+
+
+class LazyModule(object):
+    """ A proxy for a module that is only imported when one of its attributes
+    is first accessed. This keeps optional and slow to import dependencies out
+    of ``import opentidalfarm``.
+
+    :param name: The full name of the module, e.g. "scipy.interpolate".
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+yaml = LazyModule("yaml")
 
 
 def norm_approx(u, alpha=1e-4):
@@ -44,6 +66,63 @@ def get_rank():
     return rank
 
 
+def mpi_sum_array(arr):
+    """ Sums a numpy array element-wise over all processors with a single
+    collective.
+
+    :param arr: The processor-local array.
+    :returns: numpy.ndarray -- The element-wise sum over all processors.
+    """
+    if MPI.size(mpi_comm_world()) == 1:
+        return arr
+
+    from mpi4py import MPI as mpi4py_MPI
+    arr = numpy.ascontiguousarray(arr, dtype=float)
+    result = numpy.empty_like(arr)
+    mpi4py_MPI.COMM_WORLD.Allreduce(arr, result, op=mpi4py_MPI.SUM)
+    return result
+
+
+def mpi_max_array(arr):
+    """ Computes the element-wise maximum of a numpy array over all processors
+    with a single collective.
+
+    :param arr: The processor-local array.
+    :returns: numpy.ndarray -- The element-wise maximum over all processors.
+    """
+    if MPI.size(mpi_comm_world()) == 1:
+        return arr
+
+    from mpi4py import MPI as mpi4py_MPI
+    arr = numpy.ascontiguousarray(arr, dtype=float)
+    result = numpy.empty_like(arr)
+    mpi4py_MPI.COMM_WORLD.Allreduce(arr, result, op=mpi4py_MPI.MAX)
+    return result
+
+
+def call_on_first_processor(comm, f, *args):
+    """ Calls f on the first processor of a communicator and broadcasts its
+    result. An exception raised by f is raised on all processors, so that the
+    others do not wait for the broadcast forever.
+
+    :param comm: The MPI communicator, e.g. of a mesh.
+    :param f: The function, whose result must be picklable.
+    :returns: The result of f on the first processor.
+    """
+    result, error = None, None
+    if MPI.rank(comm) == 0:
+        try:
+            result = f(*args)
+        except Exception as e:
+            error = e
+
+    if MPI.size(comm) > 1:
+        result, error = comm.bcast((result, error), root=0)
+    if error is not None:
+        raise error
+    return result
+
+
 def test_gradient_array(J, dJ, x, seed=0.01, perturbation_direction=None,
                         number_of_tests=5, plot_file=None):
     '''Checks the correctness of the derivative dJ.
@@ -126,28 +205,46 @@ def test_gradient_array(J, dJ, x, seed=0.01, perturbation_direction=None,
 
 
 class StateWriter:
+    """ Writes the velocity and free-surface of the solver states to XDMF
+    files, interpolated to CG1. All states of a run are appended to the same
+    files.
+
+    The states are written synchronously: dolfin's XDMF/HDF5 output is not
+    thread-safe and must not run concurrently with the solver.
+
+    The files are opened on the communicator of the mesh. If the time levels
+    are distributed over processor groups (see :class:`TimeLevelPartition`),
+    each group writes its own files, whose names end in the group index.
+
+    :param solver: The solver whose states are written.
+    :param callback: A function that is called for every written state.
+    """
     def __init__(self, solver, callback=None):
         self.timestep = 0
         self.solver = solver
+        self.callback = callback
+
+        mesh = solver.function_space.mesh()
+        V_out = VectorFunctionSpace(mesh, 'CG', 1, dim=2)
+        Q_out = FunctionSpace(mesh, 'CG', 1)
+        self.u_out_state = dolfin.Function(V_out, name="u")
+        self.p_out_state = dolfin.Function(Q_out, name="eta")
         self.u_out, self.p_out = self.output_files(
             solver.problem.parameters.finite_element.func_name)
-        self.M_u_out, self.v_out, self.u_out_state = self.u_output_projector(
-            solver.function_space.mesh())
-        self.M_p_out, self.q_out, self.p_out_state = self.p_output_projector(
-            solver.function_space.mesh())
-        self.callback = callback
 
-    def write(self, state):
-        log(PROGRESS, "Projecting velocity and pressure to CG1 for visualisation")
-        rhs = assemble(inner(self.v_out, state.split()[0]) * dx)
-        solve(self.M_u_out, self.u_out_state.vector(), rhs, "cg", "sor",
-              annotate=False)
-        rhs = assemble(inner(self.q_out, state.split()[1]) * dx)
-        solve(self.M_p_out, self.p_out_state.vector(), rhs, "cg", "sor",
-              annotate=False)
+    @profiled("state output")
+    def write(self, state, time=None):
+        """ Writes the state at the given time. If no time is given, the
+        number of previously written states is used. """
+        log(PROGRESS, "Interpolating velocity and pressure to CG1 for visualisation")
+        u, p = state.split()
+        self.u_out_state.interpolate(u)
+        self.p_out_state.interpolate(p)
 
-        self.u_out << self.u_out_state
-        self.p_out << self.p_out_state
+        if time is None:
+            time = float(self.timestep)
+        self.u_out.write(self.u_out_state, time)
+        self.p_out.write(self.p_out_state, time)
 
         if self.solver.parameters.output_abs_u_at_turbine_positions:
             u_at_turbines = []
@@ -166,36 +263,27 @@ class StateWriter:
 
         self.timestep += 1
 
-    def u_output_projector(self, mesh):
-        # Projection operator for output.
-        Output_V = VectorFunctionSpace(mesh, 'CG', 1, dim=2)
-
-        u_out = TrialFunction(Output_V)
-        v_out = TestFunction(Output_V)
-
-        M_out = assemble(inner(v_out, u_out) * dx)
-        out_state = Function(Output_V)
-
-        return M_out, v_out, out_state
-
-    def p_output_projector(self, mesh):
-        # Projection operator for output.
-        Output_V = FunctionSpace(mesh, 'CG', 1)
-
-        u_out = TrialFunction(Output_V)
-        v_out = TestFunction(Output_V)
-
-        M_out = assemble(inner(v_out, u_out) * dx)
-        out_state = Function(Output_V)
-
-        return M_out, v_out, out_state
+    def close(self):
+        """ Closes the output files. """
+        self.u_out = self.p_out = None
 
     def output_files(self, basename):
         dir = self.solver.get_optimisation_and_search_directory()
-        # Output file
-        u_out = File(os.path.join(dir, basename + "_u.pvd"), "compressed")
-        p_out = File(os.path.join(dir, basename + "_p.pvd"), "compressed")
-        return u_out, p_out
+        comm = self.solver.function_space.mesh().mpi_comm()
+
+        partition = getattr(self.solver.problem.parameters,
+                            "time_level_partition", None)
+        if partition is not None:
+            basename += "_group%i" % partition.group
+
+        # Output files, to which all timesteps of the run are appended
+        files = []
+        for field in ["u", "p"]:
+            f = XDMFFile(comm,
+                         os.path.join(dir, basename + "_%s.xdmf" % field))
+            f.parameters["rewrite_function_mesh"] = False
+            files.append(f)
+        return files
 
 
 def cpu0only(f):
@@ -227,6 +315,75 @@ def function_eval(func, point):
         return maxval
 
 
+class PointEvaluator(object):
+    """ A parallel safe evaluation of dolfin functions at a batch of points.
+
+    Each processor evaluates the functions at the points that lie in its part
+    of the mesh, and the results are merged with a single collective. The
+    cells that contain the points are cached, so that the mesh is only
+    searched again for points that have left their cell since the last call.
+    Points outside the local part of the mesh are cached as well, and are
+    only searched again once they have moved. The points are identified by
+    their index in the batch.
+
+    :param mesh: The mesh of the functions.
+    """
+
+    def __init__(self, mesh):
+        self.mesh = mesh
+        self._tree = mesh.bounding_box_tree()
+        # The cell of each point, or -1 if the point is not in the local part
+        # of the mesh. For the latter, the coordinates of the search are kept.
+        self._cells = {}
+        self._not_owned = {}
+
+    def _locate(self, points):
+        """ Returns a boolean array which is True for the points in the local
+        part of the mesh. """
+        num_cells = self.mesh.num_cells()
+        local = numpy.zeros(len(points), dtype=bool)
+
+        for k, (x, y) in enumerate(points):
+            cell = self._cells.get(k)
+            if cell == -1 and self._not_owned[k] == (x, y):
+                continue
+
+            point = Point(x, y)
+            if cell in (None, -1) or not Cell(self.mesh, cell).collides(point):
+                cell = self._tree.compute_first_entity_collision(point)
+                if cell >= num_cells:
+                    self._cells[k] = -1
+                    self._not_owned[k] = (x, y)
+                    continue
+                self._cells[k] = cell
+            local[k] = True
+
+        return local
+
+    def __call__(self, functions, points):
+        """ Evaluates scalar functions at the points.
+
+        :param functions: A list of scalar functions.
+        :param points: The points, as an array of shape (n, 2).
+        :returns: numpy.ndarray -- The values of shape
+            (len(functions), n). Points outside the domain have the value
+            -inf.
+        """
+        points = numpy.reshape(points, (-1, 2)).astype(float)
+        values = -numpy.inf*numpy.ones((len(functions), len(points)))
+        value = numpy.zeros(1)
+
+        # Evaluate in the cached cells, which avoids a second search of the
+        # bounding box tree.
+        for k in numpy.flatnonzero(self._locate(points)):
+            cell = Cell(self.mesh, self._cells[k])
+            for i, func in enumerate(functions):
+                func.eval_cell(value, points[k], cell)
+                values[i, k] = value[0]
+
+        return mpi_max_array(values)
+
+
 class FrozenClass(object):
     """ A class which can be (un-)frozen. If the class is frozen, no attributes
         can be added to the class. """
@@ -276,6 +433,51 @@ class OutputWriter(object):
 
     def __init__(self, functional):
         self.functional = functional
+        #: The power of each turbine, as computed by the last call to
+        #: :meth:`individual_turbine_power`.
+        self.turbine_power = None
+        #: The thrust force of each turbine, as computed by the last call to
+        #: :meth:`individual_turbine_power`.
+        self.turbine_force = None
+
+    def turbine_diagnostics(self, state, farm, rho):
+        """ Computes the power and the thrust force of all turbines at once.
+
+        The turbine field is the sum of the turbine bumps. The derivative of
+        the functional and the components of the friction force
+        :math:`\\rho |u| u` are assembled once against the test functions of
+        the turbine function space. The contribution of each turbine is then
+        the product with its bump.
+
+        The thrust is exact, since the friction term of the momentum equation
+        is linear in the turbine field. The power is only exact for
+        functionals that are linear in the turbine field, such as the
+        :class:`PowerFunctional`.
+
+        :param state: The solution state.
+        :param farm: The turbine farm.
+        :param rho: The density of water.
+        :returns: A tuple (power, force) of arrays with one entry per turbine.
+        """
+        tf = farm.turbine_cache["turbine_field"]
+        V = tf.function_space()
+        bumps = farm.turbine_cache.turbine_bumps()
+        q = TestFunction(V)
+
+        power_density = assemble(derivative(self.functional.Jt(state, tf),
+                                            tf))
+
+        u = as_vector((state[0], state[1]))
+        speed = sqrt(dot(u, u))
+        force_densities = [assemble(rho*speed*u[i]*q*farm.site_dx)
+                           for i in range(2)]
+
+        densities = numpy.column_stack([power_density.array()] +
+                                       [f.array() for f in force_densities])
+        values = mpi_sum_array(bumps.T.dot(densities))
+        power = values[:, 0]
+        force = numpy.sqrt((values[:, 1:]**2).sum(axis=1))
+        return power, force
 
     def individual_turbine_power(self, solver):
         """ Print out the individual turbine's power or save it to file.
@@ -283,18 +485,15 @@ class OutputWriter(object):
         log(INFO, "Computing individual turbine power extraction contribution.")
         farm = solver.problem.parameters.tidal_farm
         turbine_positions = farm.turbine_positions
-        individual_turbine_data = []
+
+        self.turbine_power, self.turbine_force = self.turbine_diagnostics(
+            solver.state, farm, solver.problem.parameters.rho)
+
         for i in range(len(turbine_positions)):
-            turbine_info = {}
-            turbine_info['location'] = turbine_positions[i]
-            turbine_info['power'] = self.functional.Jt_individual(solver.state, i)
-            turbine_info['force'] = self.functional.force_individual(solver.state, i)
-            turbine_info['friction'] = farm.turbine_cache._parameters['friction'][i]
-            turbine_info['friction_field'] = farm.turbine_cache['turbine_field_individual'][i]
             info("Contribution of turbine %d at x=%.3f, "
-                 "y=%.3f, is %.2f kW with a friction of %.2f." % (i,
-                 turbine_info['location'][0], turbine_info['location'][1],
-                 turbine_info['power']*0.001, turbine_info['friction']))
+                 "y=%.3f, is %.2f kW with a thrust of %.2f kN." % (i,
+                 turbine_positions[i][0], turbine_positions[i][1],
+                 self.turbine_power[i]*0.001, self.turbine_force[i]*0.001))
 
 
 # recipe from https://docs.python.org/library/itertools.html:
@@ -304,21 +503,59 @@ def pairwise(iterable):
     next(b, None)
     return zip(a, b)
 
-def tabulated_expression(x, table):
+def simplify_table(table, tolerance=0.):
+    """Removes the points of a table of (x, y) pairs that are not needed to
+    represent its linear interpolant within the given tolerance in y.
+
+    The points are selected with the Ramer-Douglas-Peucker algorithm, using
+    the vertical distance to the interpolant. The first and last point are
+    always kept.
+
+    :returns: numpy.ndarray -- The remaining (x, y) pairs."""
+    table = numpy.asarray(table, dtype=float)
+    keep = numpy.zeros(len(table), dtype=bool)
+    keep[[0, -1]] = True
+
+    segments = [(0, len(table) - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+        x, y = table[first:last+1].T
+        line = y[0] + (x - x[0])*(y[-1] - y[0])/(x[-1] - x[0])
+        error = abs(y - line)
+        i = numpy.argmax(error)
+        if error[i] > tolerance:
+            keep[first + i] = True
+            segments += [(first, first + i), (first + i, last)]
+
+    return table[keep]
+
+def tabulated_expression(x, table, tolerance=1e-3):
     """Return expression that linearly interpolates from table of (x,y) pairs.
     
     For a table of x, y pairs ((x0, y0), (x1, y1), ..., (xn, yn)) where
     x0<x1<...<xn, return the ufl expression that when evaluated, linearly
-    interpolates between y_i and y_{i+1} where x_i<x<x_{i+1}. When x<x0 or
-    x>xn, the expression evaluates to 0."""
-    expr = 0
-
-    for (x1, y1), (x2, y2) in pairwise(table):
-        val = ((x - x1)/(x2-x1)*y2
-           +  (x - x2)/(x1-x2)*y1)
+    interpolates between y_i and y_{i+1} where x_i<x<x_{i+1}. When x<x0 the
+    expression evaluates to 0 and when x>=xn it evaluates to yn.
+
+    The interpolant is written as a sum of ramps max(x - x_i, 0), weighted by
+    the change of slope at x_i. Points within `tolerance` of the interpolant
+    of the remaining points are dropped (see :func:`simplify_table`), so that
+    the size of the expression depends on the shape of the curve rather than
+    on the resolution of the table. The expression then differs from the
+    linear interpolant of the full table by at most `tolerance`. Set
+    `tolerance` to 0 to represent the table exactly."""
+    xs, ys = simplify_table(table, tolerance).T
+    slopes = numpy.diff(ys)/numpy.diff(xs)
+    # The change of slope at each point, the slope is zero outside the table
+    kinks = numpy.diff(numpy.concatenate(([0.], slopes, [0.])))
 
-        part = conditional(le(x1, x), conditional(lt(x, x2), val, 0), 0)
-        expr += part
+    expr = 0
+    if ys[0] != 0:
+        expr += conditional(le(float(xs[0]), x), float(ys[0]), 0)
 
-    expr += conditional(le(x2, x), y2, 0)
+    for xi, kink in zip(xs, kinks):
+        if kink != 0:
+            expr += float(kink)*max_value(x - float(xi), 0)
     return expr
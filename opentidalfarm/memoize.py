@@ -1,8 +1,12 @@
 import os
+import sys
+import math
 import signal
 import cPickle
-from dolfin import log, INFO, WARNING
-from helpers import cpu0only
+import collections
+import numpy
+from dolfin import log, INFO, WARNING, MPI, mpi_comm_world, Function
+from helpers import cpu0only, get_rank
 
 def to_tuple(obj):
     if hasattr(obj, '__iter__'):
@@ -11,10 +15,226 @@ def to_tuple(obj):
         return obj
 
 
+def round_significant(arr, digits):
+    ''' Rounds each entry of arr to the given number of significant digits. '''
+    return tuple([float("%.*e" % (digits - 1, v)) for v in numpy.ravel(arr)])
+
+
+def relative_distance(a, b):
+    ''' Returns the distance of two control vectors in the infinity norm,
+    relative to the infinity norm of a. '''
+    a = numpy.ravel(a)
+    b = numpy.ravel(b)
+    if a.shape != b.shape:
+        return numpy.inf
+
+    diff = numpy.max(numpy.abs(a - b)) if len(a) > 0 else 0.
+    if diff == 0:
+        return 0.
+    scale = numpy.max(numpy.abs(a))
+    if scale == 0:
+        return numpy.inf
+    return diff/scale
+
+
+def nbytes(obj):
+    ''' Estimates the memory footprint of a cached key or value in bytes. '''
+    if isinstance(obj, numpy.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, Function):
+        # The processor-local values of the function
+        return obj.vector().local_size()*numpy.dtype(float).itemsize
+    elif isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum([nbytes(o) for o in obj])
+    elif isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum([nbytes(k) + nbytes(v)
+                                         for k, v in obj.items()])
+    else:
+        return sys.getsizeof(obj)
+
+
+class MemoryStore(object):
+    ''' An in-memory store for memoised values with least-recently-used
+    eviction.
+
+    :param max_bytes: The memory budget in bytes. If the cached keys and
+        values exceed it, the least recently used entries are evicted.
+        Default: None (unbounded).
+    '''
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._data = collections.OrderedDict()
+        self._nbytes = {}
+        self.nbytes = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        # Move the entry to the most recently used position
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self.nbytes -= self._nbytes[key]
+            del self._data[key]
+
+        self._data[key] = value
+        self._nbytes[key] = nbytes(key) + nbytes(value)
+        self.nbytes += self._nbytes[key]
+        self._evict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        return self._data.items()
+
+    def _evict(self):
+        ''' Evicts the least recently used entries until the memory budget is
+        met. The most recent entry is always kept. '''
+        if self.max_bytes is None:
+            return
+
+        while self.nbytes > self.max_bytes and len(self._data) > 1:
+            key, _ = self._data.popitem(last=False)
+            self.nbytes -= self._nbytes.pop(key)
+            log(INFO, "Evicted memoised value from memory.")
+
+
+class AppendOnlyFileStore(MemoryStore):
+    ''' A :class:`MemoryStore` backed by an append-only log file.
+
+    Every new entry is appended to the log file as soon as it is stored, so
+    the file is always an up-to-date checkpoint and writing it costs
+    O(new entry). Entries that were evicted from memory remain available and
+    are read back from the log file when they are accessed again.
+
+    :param filename: The log file.
+    :param max_bytes: The memory budget in bytes. Default: None (unbounded).
+    :param truncate: If True, an existing log file is discarded. Otherwise its
+        entries are indexed and made available. Default: False.
+    '''
+
+    def __init__(self, filename, max_bytes=None, truncate=False):
+        super(AppendOnlyFileStore, self).__init__(max_bytes)
+        self.filename = filename
+        self._offsets = {}
+        self._size = 0
+
+        if truncate:
+            if get_rank() == 0 and os.path.exists(filename):
+                os.remove(filename)
+        else:
+            self._scan()
+
+    def __contains__(self, key):
+        return (super(AppendOnlyFileStore, self).__contains__(key) or
+                key in self._offsets)
+
+    def __getitem__(self, key):
+        if super(AppendOnlyFileStore, self).__contains__(key):
+            return super(AppendOnlyFileStore, self).__getitem__(key)
+
+        log(INFO, "Read memoised value from '%s'." % self.filename)
+        with open(self.filename, "rb") as f:
+            f.seek(self._offsets[key])
+            _, value = cPickle.load(f)
+
+        super(AppendOnlyFileStore, self).__setitem__(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        super(AppendOnlyFileStore, self).__setitem__(key, value)
+        if key not in self._offsets:
+            self._append(key, value)
+
+    def __len__(self):
+        return len(set(self._offsets.keys() + self._data.keys()))
+
+    def keys(self):
+        return list(set(self._offsets.keys() + self._data.keys()))
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def _append(self, key, value):
+        ''' Appends a record to the log file. All processors serialise the
+        record to keep the file offsets consistent, but only the first one
+        writes it. '''
+        record = cPickle.dumps((key, value), cPickle.HIGHEST_PROTOCOL)
+        self._offsets[key] = self._size
+        self._size += len(record)
+
+        if get_rank() == 0:
+            # Make sure the record is written completely, even if the user
+            # sends a signal.
+            old_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+            with open(self.filename, "ab") as f:
+                f.write(record)
+                f.flush()
+            signal.signal(signal.SIGINT, old_handler)
+
+    def _scan(self):
+        ''' Indexes the records of an existing log file. '''
+        if not os.path.exists(self.filename):
+            return
+
+        file_size = os.path.getsize(self.filename)
+        with open(self.filename, "rb") as f:
+            while True:
+                try:
+                    key, _ = cPickle.load(f)
+                except (EOFError, cPickle.UnpicklingError, ValueError,
+                        TypeError):
+                    # A truncated record raises EOFError as well
+                    break
+                self._offsets[key] = self._size
+                self._size = f.tell()
+
+        if self._size < file_size:
+            log(WARNING, "Ignoring incomplete record at the end of "
+                         "'%s'." % self.filename)
+            # Drop the incomplete record so that new records are appended at
+            # the indexed offsets.
+            if get_rank() == 0:
+                with open(self.filename, "r+b") as f:
+                    f.truncate(self._size)
+            MPI.barrier(mpi_comm_world())
+
+        log(INFO, "Indexed %i memoised values in '%s'." % (len(self._offsets),
+                                                           self.filename))
+
+
 class MemoizeMutable:
-    ''' Implements a memoization function to avoid duplicated functional (derivative) evaluations '''
+    ''' Implements a memoization function to avoid duplicated functional
+    (derivative) evaluations.
+
+    :param fn: The function to be memoised.
+    :param hash_keys: If True, the arguments are hashed to build the cache
+        keys. Default: False.
+    :param store: The store for the memoised values, e.g. a
+        :class:`MemoryStore` or :class:`AppendOnlyFileStore`.
+        Default: an unbounded :class:`MemoryStore`.
+    :param rtol: The relative tolerance (in the infinity norm) within which
+        two control vectors, i.e. the first arguments, are considered equal.
+        The control vector is rounded to a matching number of significant
+        digits to build the key. If that key is not found, the stored control
+        vector nearest to the given one within the tolerance is used. Default:
+        0 (exact matches only).
+    '''
 
     def get_key(self, args, kwds):
+        if self.rtol > 0 and len(args) > 0:
+            args = ((round_significant(args[0], self._digits),) +
+                    tuple(args[1:]))
+
         h1 = to_tuple(args)
         h2 = to_tuple(kwds.items())
         h = tuple([h1, h2])
@@ -25,14 +245,53 @@ class MemoizeMutable:
             h = hash(h)
         return h
 
-    def __init__(self, fn, hash_keys=False):
-        ''' sigint_save: Create a checkpoint file in case a sigint signal is received. '''
+    def __init__(self, fn, hash_keys=False, store=None, rtol=0.):
         self.fn = fn
-        self.memo = {}
+        if store is None:
+            store = MemoryStore()
+        self.memo = store
         self.hash_keys = hash_keys
 
-    def __call__(self, *args, **kwds):
+        if rtol > 0 and hash_keys:
+            raise ValueError("A tolerance can not be used with hashed keys.")
+        self.rtol = rtol
+        if rtol > 0:
+            # Values rounded to this many significant digits differ by less
+            # than rtol relative to each other.
+            self._digits = int(math.ceil(1 - math.log10(rtol)))
+
+        # The checkpoint file and the keys that have already been written to
+        # it.
+        self._checkpoint_file = None
+        self._checkpointed = set()
+
+    def find_key(self, args, kwds):
+        ''' Returns the key under which the value for the given arguments is
+        stored. If a tolerance is set and there is no entry for the exact key,
+        the key of the nearest control vector within the tolerance is
+        returned. '''
         h = self.get_key(args, kwds)
+        if self.rtol == 0 or h in self.memo:
+            return h
+
+        best_key, best_distance = h, None
+        for key in self.memo.keys():
+            # All arguments but the control vector must match exactly.
+            if key[1] != h[1] or key[0][1:] != h[0][1:]:
+                continue
+
+            distance = relative_distance(args[0], key[0][0])
+            if (distance <= self.rtol and
+                (best_distance is None or distance < best_distance)):
+                best_key, best_distance = key, distance
+
+        if best_distance is not None:
+            log(INFO, "Found checkpoint value for a control vector within a "
+                      "relative distance of %e." % best_distance)
+        return best_key
+
+    def __call__(self, *args, **kwds):
+        h = self.find_key(args, kwds)
 
         if h not in self.memo:
             self.memo[h] = self.fn(*args, **kwds)
@@ -41,7 +300,7 @@ class MemoizeMutable:
         return self.memo[h]
 
     def has_cache(self, *args, **kwds):
-        h = self.get_key(args, kwds)
+        h = self.find_key(args, kwds)
         return h in self.memo
 
     # Insert a function value into the cache manually.
@@ -51,22 +310,82 @@ class MemoizeMutable:
 
     @cpu0only
     def save_checkpoint(self, filename):
+        ''' Writes the memoised values to a checkpoint file.
+
+        The checkpoint file is a log of (key, value) records. Only the values
+        added since the last checkpoint to the same file are appended. If the
+        memo is an :class:`AppendOnlyFileStore` on the same file, it is
+        already up to date and nothing needs to be written.
+        '''
+        if getattr(self.memo, "filename", None) == filename:
+            return
+
+        if filename != self._checkpoint_file:
+            # Start a new checkpoint file
+            mode = "wb"
+            self._checkpointed = set()
+            self._checkpoint_file = filename
+        else:
+            mode = "ab"
+
+        new_items = [(key, value) for key, value in self.memo.items()
+                     if key not in self._checkpointed]
+        if mode == "ab" and len(new_items) == 0:
+            return
+
         def sig_save(sig, stack):
             print "Received signal %i. Writing final checkpoint to disk before exiting..." % sig
-            cPickle.dump(self.memo, open(filename, "wb"))
+            write(new_items)
             print "Checkpoint writing finished. Bye."
             os._exit(sig)
 
+        def write(items):
+            with open(filename, mode) as f:
+                for key, value in items:
+                    cPickle.dump((key, value), f, cPickle.HIGHEST_PROTOCOL)
+
         # Make sure we save successfully, even if the user sends a signal
         print "Save checkpoint."
         old_handler = signal.signal(signal.SIGINT, sig_save)
-        cPickle.dump(self.memo, open(filename, "wb"))
+        write(new_items)
         signal.signal(signal.SIGINT, old_handler)
 
+        self._checkpointed.update([key for key, _ in new_items])
+
     def load_checkpoint(self, filename):
+        ''' Loads memoised values from a checkpoint file. Both the record log
+        and the legacy format (a single pickled dictionary) are supported. '''
+        if getattr(self.memo, "filename", None) == filename:
+            # The store has indexed the file already.
+            return
+
         try:
-            self.memo = cPickle.load(open(filename, "rb"))
+            f = open(filename, "rb")
         except IOError:
             log(WARNING, "Warning: Checkpoint file '%s' not found." % filename)
-        except ValueError:
+            return
+
+        loaded = []
+        try:
+            with f:
+                while True:
+                    try:
+                        record = cPickle.load(f)
+                    except EOFError:
+                        break
+
+                    if isinstance(record, dict):
+                        loaded += record.items()
+                    else:
+                        loaded.append(record)
+        except (ValueError, cPickle.UnpicklingError):
             log(WARNING, "Error: Checkpoint file '%s' is invalid." % filename)
+
+        for key, value in loaded:
+            self.memo[key] = value
+
+        # Only new values need to be appended on the next checkpoint, unless
+        # the file was in the legacy format.
+        if len(loaded) > 0 and not isinstance(record, dict):
+            self._checkpoint_file = filename
+            self._checkpointed = set([key for key, _ in loaded])
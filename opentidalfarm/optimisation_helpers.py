@@ -1,8 +1,12 @@
 import os.path
 import numpy
 import dolfin
-from dolfin import Constant, log, INFO
-from helpers import function_eval
+from dolfin import Constant, log, INFO, WARNING
+from helpers import PointEvaluator
+from turbine_distances import turbine_pairs, squared_distances, \
+                              squared_distances_jacobian, \
+                              check_cutoff, unconstrained_pairs
+from profiling import profiled
 from dolfin_adjoint import InequalityConstraint, EqualityConstraint
 
 __all__ = ["MinimumDistanceConstraints", "MinimumDistanceConstraintsLargeArrays",
@@ -73,56 +77,54 @@ class DomainRestrictionConstraints(InequalityConstraint):
 
         self.attraction_center = attraction_center
 
-    def length(self):
-        m_pos = self.config.params['turbine_pos']
-        return len(m_pos)
+        # Evaluates the feasible area and its gradient at all turbines at once
+        self._evaluator = PointEvaluator(feasible_area.function_space().mesh())
 
-    def function(self, m):
-        ieqcons = []
+    def _positions(self, m):
+        """ Returns the turbine positions as an array of shape (n, 2) and the
+        index of the first position control in m. """
         if len(self.config.params['controls']) == 2:
         # If the controls consists of the the friction and the positions, then we need to first extract the position part
             assert(len(m) % 3 == 0)
-            m_pos = m[len(m) / 3:]
+            shift = len(m) / 3
         else:
-            m_pos = m
+            shift = 0
+        return numpy.reshape(m[shift:], (-1, 2)), shift
 
-        for i in range(len(m_pos) / 2):
-            x = m_pos[2 * i]
-            y = m_pos[2 * i + 1]
-            try:
-                ieqcons.append(function_eval(self.feasible_area, (x, y)))
-            except RuntimeError:
-                print "Warning: a turbine is outside the domain"
-                ieqcons.append((x - self.attraction_center[0]) ** 2 + (y - self.attraction_center[1]) ** 2)  # Point is outside domain
+    def length(self):
+        m_pos = self.config.params['turbine_pos']
+        return len(m_pos)
+
+    @profiled("constraint evaluation")
+    def function(self, m):
+        xy, shift = self._positions(m)
+        ieqcons = self._evaluator([self.feasible_area], xy)[0]
+
+        outside = numpy.isinf(ieqcons)
+        if outside.any():
+            log(WARNING, "A turbine is outside the domain.")
+            # Points outside the domain
+            ieqcons[outside] = ((xy[outside] - self.attraction_center)**2).sum(axis=1)
 
-        arr = -numpy.array(ieqcons)
+        arr = -ieqcons
         if any(arr <= 0):
           log(INFO, "Domain restriction inequality constraints (should be >= 0): %s" % arr)
         return arr
 
+    @profiled("constraint jacobian")
     def jacobian(self, m):
-        ieqcons = []
-        if len(self.config.params['controls']) == 2:
-        # If the controls consists of the the friction and the positions, then we need to first extract the position part
-            assert(len(m) % 3 == 0)
-            m_pos = m[len(m) / 3:]
-        else:
-            m_pos = m
+        xy, shift = self._positions(m)
+        grad = self._evaluator(self.feasible_area_grad, xy).T
 
-        for i in range(len(m_pos) / 2):
-            x = m_pos[2 * i]
-            y = m_pos[2 * i + 1]
-            primes = numpy.zeros(len(m))
-            try:
-                primes[2 * i] = function_eval(self.feasible_area_grad[0], (x, y))
-                primes[2 * i + 1] = function_eval(self.feasible_area_grad[1], (x, y))
+        outside = numpy.isinf(grad[:, 0])
+        grad[outside] = 2 * (xy[outside] - self.attraction_center)
 
-            except RuntimeError:
-                primes[2 * i] = 2 * (x - self.attraction_center[0])
-                primes[2 * i + 1] = 2 * (y - self.attraction_center[1])
-            ieqcons.append(primes)
+        n = len(xy)
+        ieqcons = numpy.zeros((n, len(m)))
+        ieqcons[numpy.arange(n), shift + 2 * numpy.arange(n)] = grad[:, 0]
+        ieqcons[numpy.arange(n), shift + 2 * numpy.arange(n) + 1] = grad[:, 1]
 
-        return -numpy.array(ieqcons)
+        return -ieqcons
 
 def get_domain_constraints(config, feasible_area, attraction_center):
     return DomainRestrictionConstraints(config, feasible_area, attraction_center)
@@ -174,14 +176,26 @@ class MinimumDistanceConstraints(InequalityConstraint):
             http://www.dolfin-adjoint.org/en/latest/documentation/api.html#dolfin_adjoint.InequalityConstraint
 
     """
-    def __init__(self, turbine_positions, minimum_distance, number_of_thrust_controls):
+    def __init__(self, turbine_positions, minimum_distance,
+                 number_of_thrust_controls, cutoff=None):
         """Create MinimumDistanceConstraints
 
         :param serialized_turbines: The serialized turbine paramaterisation.
         :type serialized_turbines: numpy.ndarray.
         :param minimum_distance: The minimum distance allowed between turbines.
         :type minimum_distance: float.
-        :raises: NotImplementedError
+        :param cutoff: If given, only the turbine pairs that are closer than
+            this distance at the given turbine positions are constrained.
+            Otherwise all pairs are constrained. The cutoff should be large
+            enough to cover the movement of the turbines during the
+            optimisation, for example a few turbine diameters.
+            The pairs that are not constrained individually, but come closer
+            than the minimum distance during the optimisation, are penalised
+            in one additional constraint (as in
+            :class:`MinimumDistanceConstraintsLargeArrays`). The cutoff must
+            not be smaller than the minimum distance.
+        :type cutoff: float.
+        :raises: NotImplementedError, ValueError
 
 
         """
@@ -194,17 +208,30 @@ class MinimumDistanceConstraints(InequalityConstraint):
         self._minimum_distance = minimum_distance
         self._number_of_thrust_controls = number_of_thrust_controls
 
+        # The constrained turbine pairs. If None, all pairs are constrained.
+        self._pairs = None
+        check_cutoff(cutoff, minimum_distance)
+        if cutoff is not None:
+            self._pairs = turbine_pairs(numpy.reshape(self._turbines, (-1, 2)),
+                                         cutoff)
 
-    def _sl2norm(self, x):
-        """Calculates the squared l2norm of a vector x."""
-        return sum([v**2 for v in x])
+
+    def _get_pairs(self, xy):
+        """Returns the index arrays of the constrained turbine pairs."""
+        if self._pairs is not None:
+            return self._pairs
+        return turbine_pairs(xy)
 
 
     def length(self):
         """Returns the number of constraints ``len(function(m))``."""
-        return len(self._turbines) * (len(self._turbines)-1) / 2
+        if self._pairs is not None:
+            return len(self._pairs[0]) + 1
+        n_turbines = len(self._turbines) / 2
+        return n_turbines * (n_turbines-1) / 2
 
 
+    @profiled("constraint evaluation")
     def function(self, m):
         """Return an object which must be zero for the point to be feasible.
 
@@ -215,27 +242,33 @@ class MinimumDistanceConstraints(InequalityConstraint):
 
         """
         dolfin.log(dolfin.PROGRESS, "Calculating minimum distance constraints.")
-        inequality_constraints = []
 
         # skip controls associated with variable thrust
-        xy = m[self._number_of_thrust_controls:]
+        xy = numpy.reshape(m[self._number_of_thrust_controls:], (-1, 2))
 
-        for i in range(len(xy)/2):
-            for j in range(len(xy)/2):
-                if i <= j:
-                    continue
-                inequality_constraints.append(self._sl2norm([xy[2*i]-xy[2*j],
-                                                             xy[2*i+1]-xy[2*j+1]])
-                                              - self._minimum_distance**2)
+        i, j = self._get_pairs(xy)
+        inequality_constraints = (squared_distances(xy, i, j)
+                                  - self._minimum_distance**2)
 
-        inequality_constraints = numpy.array(inequality_constraints)
         if any(inequality_constraints <= 0):
             dolfin.log(dolfin.WARNING,
                        "Minimum distance inequality constraints (should all "
                        "be > 0): %s" % inequality_constraints)
+        if self._pairs is not None:
+            i, j = unconstrained_pairs(xy, self._pairs, self._minimum_distance)
+            if len(i) > 0:
+                dolfin.log(dolfin.WARNING,
+                           "%i turbine pairs violate the minimum distance, but "
+                           "are not constrained individually. Consider "
+                           "increasing the cutoff distance." % len(i))
+            penalty = (squared_distances(xy, i, j)
+                       - self._minimum_distance**2).sum()
+            inequality_constraints = numpy.append(inequality_constraints,
+                                                  penalty)
         return inequality_constraints
 
 
+    @profiled("constraint jacobian")
     def jacobian(self, m):
         """Returns the gradient of the constraint function.
 
@@ -250,28 +283,23 @@ class MinimumDistanceConstraints(InequalityConstraint):
         """
         dolfin.log(dolfin.PROGRESS, "Calculating the jacobian of minimum "
                    "distance constraints function.")
-        inequality_constraints = []
 
         # skip controls associated with variable thrust
-        xy = m[self._number_of_thrust_controls:]
-
-        for i in range(len(xy)/2):
-            for j in range(len(xy)/2):
-                if i <= j:
-                    continue
-
-                # Provide a shorter handle
-                p_ineq_c = numpy.zeros_like(m)
-
-                # The control vector contains the friction coefficients first,
-                # so we need to shift here
-                p_ineq_c[self._number_of_thrust_controls+2*i] = 2*(xy[2*i] - xy[2*j])
-                p_ineq_c[self._number_of_thrust_controls+2*j] = -2*(xy[2*i] - xy[2*j])
-                p_ineq_c[self._number_of_thrust_controls+2*i+1] = 2*(xy[2*i+1] - xy[2*j+1])
-                p_ineq_c[self._number_of_thrust_controls+2*j+1] = -2*(xy[2*i+1] - xy[2*j+1])
-                inequality_constraints.append(p_ineq_c)
-
-        return numpy.array(inequality_constraints)
+        xy = numpy.reshape(m[self._number_of_thrust_controls:], (-1, 2))
+
+        # The control vector contains the friction coefficients first,
+        # so we need to shift here
+        i, j = self._get_pairs(xy)
+        jacobian = squared_distances_jacobian(xy, i, j,
+                                               self._number_of_thrust_controls,
+                                               len(m))
+        jacobian = jacobian.toarray()
+        if self._pairs is not None:
+            i, j = unconstrained_pairs(xy, self._pairs, self._minimum_distance)
+            penalty = squared_distances_jacobian(xy, i, j,
+                self._number_of_thrust_controls, len(m)).sum(axis=0)
+            jacobian = numpy.vstack((jacobian, numpy.asarray(penalty)))
+        return jacobian
 
 
 class MinimumDistanceConstraintsLargeArrays(InequalityConstraint):
@@ -321,28 +349,19 @@ class MinimumDistanceConstraintsLargeArrays(InequalityConstraint):
         self._number_of_thrust_controls = number_of_thrust_controls
 
 
-    def _sl2norm(self, x):
-        """Calculates the squared l2norm of a vector x."""
-        return sum([v**2 for v in x])
-
-
     def length(self):
         """Returns the number of constraints ``len(function(m))``."""
         return 1
 
 
-    def _penalty(self, x_sq):
-        return min(0, x_sq - self._minimum_distance**2)
-
-
-    def _dpenalty(self, x_sq):
-        """ Returns the derivative of the penalty function """
-        if x_sq - self._minimum_distance**2 > 0:
-            return 0.0
-        else:
-            return 1.0
+    def _near_pairs(self, xy):
+        """Returns the index arrays of the turbine pairs that are not further
+        apart than the minimum distance. Only these pairs contribute to the
+        penalty. They are found with a KD-tree."""
+        return turbine_pairs(xy, self._minimum_distance)
 
 
+    @profiled("constraint evaluation")
     def function(self, m):
         """Return an object which must be >0 for the point to be feasible.
 
@@ -354,16 +373,10 @@ class MinimumDistanceConstraintsLargeArrays(InequalityConstraint):
         """
         dolfin.log(dolfin.PROGRESS, "Calculating minimum distance constraints.")
 
-        xy = m[self._number_of_thrust_controls:]
+        xy = numpy.reshape(m[self._number_of_thrust_controls:], (-1, 2))
 
-        value = 0
-        for i in range(len(xy)/2):
-            for j in range(len(xy)/2):
-                if i <= j:
-                    continue
-                dist_sq = self._sl2norm([xy[2*i]-xy[2*j],
-                                         xy[2*i+1]-xy[2*j+1]])
-                value += self._penalty(dist_sq)
+        i, j = self._near_pairs(xy)
+        value = (squared_distances(xy, i, j) - self._minimum_distance**2).sum()
 
         if value <= 0:
             dolfin.log(dolfin.WARNING,
@@ -372,6 +385,7 @@ class MinimumDistanceConstraintsLargeArrays(InequalityConstraint):
         return numpy.array([value])
 
 
+    @profiled("constraint jacobian")
     def jacobian(self, m):
         """Returns the gradient of the constraint function.
 
@@ -386,29 +400,15 @@ class MinimumDistanceConstraintsLargeArrays(InequalityConstraint):
         """
         dolfin.log(dolfin.PROGRESS, "Calculating the jacobian of minimum "
                    "distance constraints function.")
-        inequality_constraints = []
-
-        xy = m[self._number_of_thrust_controls:]
-
-        p_ineq_c = numpy.zeros_like(m)
-
-        for i in range(len(xy)/2):
-            for j in range(len(xy)/2):
-                if i <= j:
-                    continue
-
-                dist_sq = self._sl2norm([xy[2*i]-xy[2*j],
-                                         xy[2*i+1]-xy[2*j+1]])
-                dvalue = self._dpenalty(dist_sq)
-
-                # The control vector contains the friction coefficients first,
-                # so we need to shift here
-                p_ineq_c[self._number_of_thrust_controls+2*i] += dvalue * 2*(xy[2*i] - xy[2*j])
-                p_ineq_c[self._number_of_thrust_controls+2*j] += dvalue * (-2*(xy[2*i] - xy[2*j]))
-                p_ineq_c[self._number_of_thrust_controls+2*i+1] += dvalue * 2*(xy[2*i+1] - xy[2*j+1])
-                p_ineq_c[self._number_of_thrust_controls+2*j+1] += dvalue * (-2*(xy[2*i+1] - xy[2*j+1]))
+        xy = numpy.reshape(m[self._number_of_thrust_controls:], (-1, 2))
 
-        return numpy.array([p_ineq_c])
+        # The control vector contains the friction coefficients first,
+        # so we need to shift here
+        i, j = self._near_pairs(xy)
+        jacobian = squared_distances_jacobian(xy, i, j,
+                                               self._number_of_thrust_controls,
+                                               len(m))
+        return numpy.asarray(jacobian.sum(axis=0))
 
 class ConvexPolygonSiteConstraint(InequalityConstraint):
     ''' Generates the inequality constraints for generic polygon constraints.
@@ -450,6 +450,7 @@ class ConvexPolygonSiteConstraint(InequalityConstraint):
     def output_workspace(self):
         return numpy.array([0]*self.length())
 
+    @profiled("constraint evaluation")
     def function(self, m):
         ieqcons = []
         controlled_by = self.farm.turbine_specification.controls
@@ -470,6 +471,7 @@ class ConvexPolygonSiteConstraint(InequalityConstraint):
           log(INFO, "Convex site position constraints (should be >= 0): %s" % arr)
         return arr
 
+    @profiled("constraint jacobian")
     def jacobian(self, m):
         ieqcons = []
         if self.farm._variable_positions and self.farm._variable_thrust:
@@ -5,6 +5,7 @@ from steady_sw import SteadySWProblemParameters
 from steady_sw import SteadySWProblem
 from multi_steady_sw import MultiSteadySWProblemParameters
 from multi_steady_sw import MultiSteadySWProblem
+from time_level_partition import TimeLevelPartition
 from sw import SWProblemParameters
 from sw import SWProblem
 from dummy import DummyProblemParameters
@@ -17,6 +17,14 @@ class MultiSteadySWProblemParameters(SteadySWProblemParameters):
     :ivar dt: The timestep. Default: 1.0.
     :ivar start_time: The start time. Default: 0.0.
     :ivar finish_time: The finish time. Default: 100.0.
+
+    Parallel settings:
+
+    :ivar time_level_partition: A
+        :class:`opentidalfarm.problems.time_level_partition.TimeLevelPartition`
+        to solve the time levels concurrently on groups of processors. The
+        domain must then be created on the communicator of the partition.
+        Default: None (all time levels are solved by all processors)
     """
 
     # Time parameters
@@ -27,6 +35,9 @@ class MultiSteadySWProblemParameters(SteadySWProblemParameters):
     # Functional time integration parameters
     functional_final_time_only = False
 
+    # Parallel settings
+    time_level_partition = None
+
 class MultiSteadySWProblem(SteadySWProblem):
     r""" Create a shallow water problem consisting of a sequence of
     (independent) steady-state shallow water problems. More specifically, it
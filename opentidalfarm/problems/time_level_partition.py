@@ -0,0 +1,69 @@
+import numpy
+
+
+class TimeLevelPartition(object):
+    """ Distributes the time levels of a :class:`MultiSteadySWProblem` over
+    groups of processors.
+
+    The processors are split into groups of equal size, each with its own
+    communicator. Each group solves the forward and adjoint equations of every
+    `groups`-th time level on its own copy of the domain, and the
+    functional values and gradients are summed over the groups.
+
+    The domain must be created on the communicator of the group, for example:
+
+    .. code-block:: python
+
+        partition = TimeLevelPartition(groups=4)
+        domain = FileDomain("mesh.xml", comm=partition.comm)
+        ...
+        problem_params.time_level_partition = partition
+
+    Requires mpi4py.
+
+    :param groups: The number of processor groups. The number of processors
+        must be a multiple of it.
+    """
+
+    def __init__(self, groups):
+        from mpi4py import MPI as mpi4py_MPI
+        world = mpi4py_MPI.COMM_WORLD
+
+        if groups < 1 or world.size % groups != 0:
+            raise ValueError("The number of processors must be a multiple of "
+                             "the number of groups.")
+
+        self.groups = groups
+        #: The index of the group of this processor.
+        self.group = world.rank // (world.size // groups)
+        #: The communicator of the group of this processor.
+        self.comm = world.Split(color=self.group, key=world.rank)
+        # Connects the processors with the same rank in each group
+        self._across = world.Split(color=self.comm.rank, key=world.rank)
+
+    def owns(self, level):
+        """ Returns True if the time level with the given index is solved by
+        the group of this processor. """
+        return level % self.groups == self.group
+
+    def sum(self, arr):
+        """ Sums an array, that is identical on all processors of a group,
+        over the groups. """
+        from mpi4py import MPI as mpi4py_MPI
+        arr = numpy.ascontiguousarray(arr, dtype=float)
+        result = numpy.empty_like(arr)
+        self._across.Allreduce(arr, result, op=mpi4py_MPI.SUM)
+        return result
+
+    def gather(self, times, vals):
+        """ Gathers the functional values of the time levels of all groups.
+
+        :returns: The times and values of all groups, ordered by time.
+        """
+        pairs = {}
+        for group_times, group_vals in self._across.allgather((list(times),
+                                                               list(vals))):
+            pairs.update(zip(group_times, group_vals))
+
+        times = sorted(pairs)
+        return times, [pairs[t] for t in times]
@@ -0,0 +1,191 @@
+""" Structured timing and memory instrumentation.
+
+The global :data:`profiler` records nested, named regions of the
+optimisation loop, such as the forward and adjoint solves, the turbine cache
+updates, the constraint evaluations and the state output. For each region it
+records the wall time, the number of calls, counters such as the Newton and
+Krylov iterations, and the peak resident set size of the process. The
+records are aggregated per optimisation iteration and can be exported as
+JSON. If :attr:`Profiler.trace` is enabled, every call is kept as well and can
+be exported as a Chrome trace timeline (open it in chrome://tracing or
+https://ui.perfetto.dev).
+
+.. code-block:: python
+
+    from opentidalfarm.profiling import profiler
+
+    profiler.trace = True
+    with profiler.region("my computation"):
+        ...
+    profiler.write_json("profile.json")
+    profiler.write_chrome_trace("profile_trace.json")
+"""
+import sys
+import time
+import json
+import functools
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def peak_rss():
+    """ Returns the peak resident set size of this process in bytes, or None
+    if it is not available on this platform. """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes
+    if sys.platform != "darwin":
+        rss *= 1024
+    return rss
+
+
+class _Region(object):
+    """ An open region of the profiler. """
+
+    def __init__(self, name, path, start):
+        self.name = name
+        self.path = path
+        self.start = start
+        self.counters = {}
+
+
+class Profiler(object):
+    """ Records nested regions with their wall time, call counts, counters and
+    the peak memory usage.
+
+    Regions are identified by their path, which joins the names of the
+    enclosing regions with "/", e.g. "gradient evaluation/adjoint solve".
+
+    :ivar enabled: If False, regions are not recorded. Default: True
+    :ivar trace: If True, every call of a region is kept for the Chrome trace
+        export, so the memory usage grows with the number of calls. If False,
+        only the per iteration aggregates are kept. Default: False
+    :ivar iteration: The optimisation iteration to which new regions are
+        attributed.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.trace = False
+        self.reset()
+
+    def reset(self):
+        """ Removes all records. """
+        self.iteration = 0
+        self.events = []
+        self._totals = {}
+        self._stack = []
+        self._start = time.time()
+
+    @contextlib.contextmanager
+    def region(self, name):
+        """ A context manager that records the enclosed code as a region with
+        the given name, nested in the currently open region. """
+        if not self.enabled:
+            yield
+            return
+
+        path = name
+        if self._stack:
+            path = self._stack[-1].path + "/" + name
+        region = _Region(name, path, time.time())
+        self._stack.append(region)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            self._record(region, time.time() - region.start)
+
+    def count(self, counter, value=1):
+        """ Adds the value to a counter of the innermost open region, for
+        example the number of Newton iterations of a solve. """
+        if self.enabled and self._stack:
+            counters = self._stack[-1].counters
+            counters[counter] = counters.get(counter, 0) + value
+
+    def _record(self, region, duration):
+        rss = peak_rss()
+
+        totals = self._totals.setdefault(self.iteration, {})
+        total = totals.get(region.path)
+        if total is None:
+            total = totals[region.path] = {"calls": 0, "time": 0.,
+                                           "counters": {}, "peak_rss": rss}
+        total["calls"] += 1
+        total["time"] += duration
+        total["peak_rss"] = max(total["peak_rss"], rss)
+        for counter, value in region.counters.iteritems():
+            total["counters"][counter] = (total["counters"].get(counter, 0) +
+                                          value)
+
+        if self.trace:
+            self.events.append({"name": region.name,
+                                "path": region.path,
+                                "iteration": self.iteration,
+                                "start": region.start - self._start,
+                                "duration": duration,
+                                "counters": region.counters,
+                                "peak_rss": rss})
+
+    def summary(self):
+        """ Returns the aggregated records as a list with one entry per
+        optimisation iteration. Each entry is a dictionary with the iteration
+        number and a dictionary that maps the region paths to their number of
+        calls, total wall time in seconds, summed counters and peak resident
+        set size in bytes. """
+        return [{"iteration": iteration, "regions": self._totals[iteration]}
+                for iteration in sorted(self._totals)]
+
+    def write_json(self, filename):
+        """ Writes the per iteration summary to a JSON file. """
+        with open(filename, "w") as f:
+            json.dump({"iterations": self.summary(),
+                       "peak_rss": peak_rss()}, f, indent=1, sort_keys=True)
+
+    def chrome_trace(self, pid=0):
+        """ Returns the recorded regions in the Chrome trace event format.
+
+        :param pid: The process id of the events, e.g. the MPI rank.
+        """
+        events = []
+        for event in self.events:
+            args = dict(event["counters"])
+            args["iteration"] = event["iteration"]
+            args["peak_rss"] = event["peak_rss"]
+            events.append({"name": event["name"],
+                           "cat": event["path"],
+                           "ph": "X",
+                           "ts": event["start"]*1e6,
+                           "dur": event["duration"]*1e6,
+                           "pid": pid,
+                           "tid": 0,
+                           "args": args})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, filename, pid=0):
+        """ Writes the recorded regions to a Chrome trace file. Requires
+        :attr:`trace` to be enabled. """
+        with open(filename, "w") as f:
+            json.dump(self.chrome_trace(pid), f)
+
+
+#: The profiler that records the regions of OpenTidalFarm.
+profiler = Profiler()
+
+
+def profiled(name):
+    """ A decorator that records each call of the function as a region with
+    the given name in the global :data:`profiler`. """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with profiler.region(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
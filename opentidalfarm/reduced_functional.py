@@ -7,7 +7,11 @@ from dolfin import *
 from dolfin_adjoint import *
 from solvers import Solver
 from functionals import TimeIntegrator, PrototypeFunctional
-from memoize import MemoizeMutable
+from memoize import MemoizeMutable, MemoryStore, AppendOnlyFileStore
+from memoize import relative_distance
+from checkpointing import CheckpointSchedule
+from profiling import profiler, profiled
+from problems import MultiSteadySWProblem
 from reduced_functional_prototype import ReducedFunctionalPrototype
 
 __all__ = ["ReducedFunctional", "ReducedFunctionalParameters",
@@ -29,6 +33,21 @@ class ReducedFunctionalParameters(helpers.FrozenClass):
         search iteration. Default: False
     :ivar checkpoint_basefilename: The base filename (without extensions) for
         storing or loading the checkpoints. Default: 'checkpoints'.
+    :ivar memoization_store: Where the memoised functional and gradient values
+        are kept. 'memory' keeps them in memory only. 'disk' additionally
+        appends every new value to the checkpoint files, so that values evicted
+        from memory remain available and the checkpoints are always up to
+        date. Default: 'memory'
+    :ivar memoization_max_bytes: The memory budget in bytes for the memoised
+        functional values and for the memoised gradient values. The least
+        recently used values are evicted first. If checkpoints are saved, the
+        values are kept with the 'disk' store, so that evicted values are
+        never missing from the checkpoints. Default: None (unbounded)
+    :ivar memoization_rtol: The relative tolerance (in the infinity norm)
+        within which two control arrays are considered equal. Memoised
+        functional values, gradients and the last forward solution are reused
+        for control arrays within this tolerance. Default: 0 (exact matches
+        only)
     """
 
     scale = 1.
@@ -36,6 +55,9 @@ class ReducedFunctionalParameters(helpers.FrozenClass):
     save_checkpoints = False
     load_checkpoints = False
     checkpoints_basefilename = "checkpoints"
+    memoization_store = "memory"
+    memoization_max_bytes = None
+    memoization_rtol = 0.
 
 
 class ReducedFunctional(ReducedFunctionalPrototype):
@@ -111,8 +133,13 @@ class ReducedFunctional(ReducedFunctionalPrototype):
             controls = [controls]
         self.controls = controls
 
-        self._compute_functional_mem = MemoizeMutable(self._compute_functional)
-        self._compute_gradient_mem = MemoizeMutable(self._compute_gradient)
+        rtol = self.parameters.memoization_rtol
+        self._compute_functional_mem = MemoizeMutable(
+            self._compute_functional, store=self._memoization_store("_fwd.dat"),
+            rtol=rtol)
+        self._compute_gradient_mem = MemoizeMutable(
+            self._compute_gradient, store=self._memoization_store("_adj.dat"),
+            rtol=rtol)
 
         # Load checkpoints from file
         if self.parameters.load_checkpoints:
@@ -133,12 +160,14 @@ class ReducedFunctional(ReducedFunctionalPrototype):
         return ReducedFunctionalParameters()
 
 
+    @profiled("gradient evaluation")
     def _compute_gradient(self, m, forget=True):
         """ Compute the functional gradient for the turbine positions/frictions array """
         farm = self.solver.problem.parameters.tidal_farm
 
         # If any of the parameters changed, the forward model needs to be re-run
-        if self.last_m is None or numpy.any(m != self.last_m):
+        if (self.last_m is None or relative_distance(m, self.last_m) >
+            self.parameters.memoization_rtol):
             self._compute_functional(m, annotate=True)
 
         J = self.time_integrator.dolfin_adjoint_functional(self.solver.state)
@@ -162,7 +191,9 @@ class ReducedFunctional(ReducedFunctionalPrototype):
         else:
             parameters = FunctionControl("turbine_friction_cache")
 
-        djdtf = dolfin_adjoint.compute_gradient(J, parameters, forget=forget)
+        with profiler.region("adjoint solve"):
+            djdtf = dolfin_adjoint.compute_gradient(J, parameters,
+                                                    forget=forget)
         dolfin.parameters["adjoint"]["stop_annotating"] = False
 
         # Decide if we need to apply the chain rule to get the gradient of
@@ -171,6 +202,13 @@ class ReducedFunctional(ReducedFunctionalPrototype):
             # We are looking for the gradient with respect to the friction
             dj = dolfin_adjoint.optimization.get_global(djdtf)
 
+            # Sum the contributions of the time levels of the other processor
+            # groups. In the turbine case below, this is done by the sum over
+            # all processors.
+            partition = self.time_integrator.partition
+            if partition is not None:
+                dj = partition.sum(dj)
+
         else:
             # Let J be the functional, m the parameter and u the solution of the
             # PDE equation F(u) = 0.
@@ -178,58 +216,47 @@ class ReducedFunctional(ReducedFunctionalPrototype):
             # dJ/dm = (\partial J)/(\partial u) * (d u) / d m + \partial J / \partial m
             #               = adj_state * \partial F / \partial u + \partial J / \partial m
             # In this particular case m = turbine_friction, J = \sum_t(ft)
-            dj = []
-
-            if farm.turbine_specification.controls.friction:
-                # Compute the derivatives with respect to the turbine friction
-                for tfd in farm.turbine_cache["turbine_derivative_friction"]:
-                    farm.update()
-                    dj.append(djdtf.vector().inner(tfd.vector()))
-
-            elif farm.turbine_specification.controls.dynamic_friction:
-                # Compute the derivatives with respect to the turbine friction
-                for djdtf_arr, t in zip(djdtf,
-                                    farm.turbine_cache["turbine_derivative_friction"]):
-                    for tfd in t:
-                        farm.update()
-                        dj.append(djdtf_arr.vector().inner(tfd.vector()))
-
-            if (farm.turbine_specification.controls.position):
-                if (farm.turbine_specification.controls.dynamic_friction):
-                    # Compute the derivatives with respect to the turbine position
-                    farm.update()
-                    turb_deriv_pos = farm.turbine_cache["turbine_derivative_pos"]
-                    n_time_steps =len(turb_deriv_pos)
-                    for n in xrange(farm.number_of_turbines):
-                        for var in ('turbine_pos_x', 'turbine_pos_y'):
-                            dj_t = 0
-                            for t in xrange(n_time_steps):
-                                tfd_t = turb_deriv_pos[t][n][var]
-                                dj_t += djdtf_arr.vector().inner(tfd_t.vector())
-                            dj.append(dj_t)
-
-                else:
-                    # Compute the derivatives with respect to the turbine position
-                    for d in farm.turbine_cache["turbine_derivative_pos"]:
-                        for var in ('turbine_pos_x', 'turbine_pos_y'):
-                            farm.update()
-                            tfd = d[var]
-                            dj.append(djdtf.vector().inner(tfd.vector()))
+            #
+            # The derivatives of the turbine field with respect to the controls
+            # are stored in the sparse (DOF x control) matrix D, so that the
+            # chain rule reduces to the product D^T * dJ/d(turbine_field).
+            farm.update()
+            D = farm.turbine_cache["turbine_derivatives"]
+
+            if farm.turbine_specification.controls.dynamic_friction:
+                # Stack the gradients of all timesteps as columns and reduce
+                # them with a single product.
+                djdtf_arr = numpy.column_stack([djdtf_t.vector().array()
+                                                for djdtf_t in djdtf])
+                dj_t = helpers.mpi_sum_array(D.T.dot(djdtf_arr))
+
+                # The friction derivatives are ordered by timestep first.
+                n_turbines = len(farm._parameters["position"])
+                dj = dj_t[:n_turbines].T.flatten()
+
+                # The position derivatives are the same for every timestep,
+                # hence the contributions are summed over time.
+                if farm.turbine_specification.controls.position:
+                    dj = numpy.concatenate((dj, dj_t[n_turbines:].sum(axis=1)))
 
-            dj = numpy.array(dj)
+            else:
+                dj = helpers.mpi_sum_array(D.T.dot(djdtf.vector().array()))
 
         return dj
 
+    @profiled("functional evaluation")
     def _compute_functional(self, m, annotate=True):
         """ Compute the functional of interest for the turbine positions/frictions array """
         self.last_m = m
         self._update_turbine_farm(m)
+        self.solver.controls = numpy.array(m)
         farm = self.solver.problem.parameters.tidal_farm
 
         # Configure dolfin-adjoint
         adj_reset()
-        dolfin.parameters["adjoint"]["record_all"] = True
-        self._set_revolve_parameters()
+        checkpointing = self._set_revolve_parameters()
+        # Recording all values would defeat the checkpointing
+        dolfin.parameters["adjoint"]["record_all"] = not checkpointing
 
         # Solve the shallow water system and integrate the functional of
         # interest.
@@ -241,12 +268,17 @@ class ReducedFunctional(ReducedFunctionalPrototype):
         for sol in self.solver.solve(annotate=annotate):
             self.time_integrator.add(sol["time"], sol["state"], sol["tf"],
                                      sol["is_final"])
+        self.time_integrator.gather()
 
         log(INFO, "Temporal breakdown of functional evaluation")
         log(INFO, "----------------------------------")
         for time, val in zip(self.time_integrator.times, self.time_integrator.vals):
             log(INFO, "Time: {} s\t Value: {}.".format(float(time), val))
         log(INFO, "----------------------------------")
+        log(INFO, "Functional forms: {} compiled in {:.3f} s, {} "
+                  "reused.".format(self.time_integrator.compiled_forms,
+                      self.time_integrator.form_compile_time,
+                      self.time_integrator.reused_forms))
 
         if ((self.solver.parameters.dump_period > 0)
             and self._solver_params.output_temporal_breakdown_of_j):
@@ -270,18 +302,51 @@ class ReducedFunctional(ReducedFunctionalPrototype):
 
 
     def _set_revolve_parameters(self):
-        if (hasattr(self._solver_params, "revolve_parameters")
-            and self._solver_params.revolve_parameters is not None):
-          (strategy,
-           snaps_on_disk,
-           snaps_in_ram,
-           verbose) = self._farm.params['revolve_parameters']
-          adj_checkpointing(
-              strategy,
-              self._problem_params.finish_time/self._problem_params.dt,
-              snaps_on_disk=snaps_on_disk,
-              snaps_in_ram=snaps_in_ram,
-              verbose=verbose)
+        """ Configures the adjoint checkpointing, either with the manual
+        revolve parameters or with a schedule for the checkpointing memory
+        budget of the solver. Returns True if checkpointing is active. """
+        revolve_parameters = getattr(self._solver_params,
+                                     "revolve_parameters", None)
+        memory_budget = getattr(self._solver_params,
+                                "checkpoint_memory_budget", None)
+
+        if revolve_parameters is not None:
+            (strategy,
+             snaps_on_disk,
+             snaps_in_ram,
+             verbose) = revolve_parameters
+            adj_checkpointing(
+                strategy,
+                self._number_of_timesteps(),
+                snaps_on_disk=snaps_on_disk,
+                snaps_in_ram=snaps_in_ram,
+                verbose=verbose)
+            return True
+
+        if memory_budget is not None:
+            state_bytes = CheckpointSchedule.state_size(
+                self.solver.function_space)
+            schedule = CheckpointSchedule(self._number_of_timesteps(),
+                state_bytes, memory_budget,
+                self._solver_params.checkpoint_disk_budget)
+            log(INFO, str(schedule))
+            schedule.apply()
+            return schedule.active
+
+        return False
+
+    def _number_of_timesteps(self):
+        """ The number of timesteps of a forward run. """
+        if not self.solver.problem._is_transient:
+            return 1
+
+        steps = int(round((float(self._problem_params.finish_time) -
+                           float(self._problem_params.start_time)) /
+                          float(self._problem_params.dt)))
+        # The multi steady-state problem also solves for the start time
+        if type(self.solver.problem) == MultiSteadySWProblem:
+            steps += 1
+        return steps
 
 
     def _update_turbine_farm(self, m):
@@ -312,6 +377,35 @@ class ReducedFunctional(ReducedFunctionalPrototype):
         farm.update()
 
 
+    def _memoization_store(self, extension):
+        """ Creates the store for the memoised functional or gradient values.
+        """
+        max_bytes = self.parameters.memoization_max_bytes
+        store = self.parameters.memoization_store
+
+        # A bounded memory store could evict values before they are written
+        # to the checkpoint files. The disk store appends every value to the
+        # checkpoint file as soon as it is stored, so nothing is lost.
+        if (store == "memory" and max_bytes is not None and
+            self.parameters.save_checkpoints):
+            log(INFO, "Keep the memoised values in the checkpoint files, "
+                      "since the memoization memory is bounded.")
+            store = "disk"
+
+        if store == "memory":
+            return MemoryStore(max_bytes=max_bytes)
+
+        elif store == "disk":
+            base_filename = self.parameters.checkpoints_basefilename
+            base_path = os.path.join(self._solver_params.output_dir,
+                                     base_filename)
+            return AppendOnlyFileStore(
+                base_path + extension, max_bytes=max_bytes,
+                truncate=not self.parameters.load_checkpoints)
+
+        else:
+            raise ValueError("Unknown memoization_store '%s'." % store)
+
     def _save_checkpoint(self):
         """ Checkpoint the reduced functional from which can be used to restart
         the turbine optimisation. """
@@ -320,6 +414,19 @@ class ReducedFunctional(ReducedFunctionalPrototype):
         self._compute_functional_mem.save_checkpoint(base_path + "_fwd.dat")
         self._compute_gradient_mem.save_checkpoint(base_path + "_adj.dat")
 
+    def _write_profile(self):
+        """ Writes the timing and memory profile of the first processor to
+        the output directory if `output_profile` is set, independently of the
+        `dump_period`, see :mod:`opentidalfarm.profiling`. """
+        if (not getattr(self._solver_params, "output_profile", False) or
+            MPI.rank(mpi_comm_world()) != 0):
+            return
+
+        base_path = os.path.join(self._solver_params.output_dir, "profile")
+        profiler.write_json(base_path + ".json")
+        if profiler.trace:
+            profiler.write_chrome_trace(base_path + "_trace.json")
+
     def _load_checkpoint(self):
         """ Checkpoint the reduceduced functional from which can be used to
         restart the turbine optimisation. """
@@ -331,12 +438,14 @@ class ReducedFunctional(ReducedFunctionalPrototype):
     def evaluate(self, m, annotate=True):
         """ Return the functional value for the given parameter array. """
         log(INFO, 'Start evaluation of j')
+        profiler.iteration = self.solver.optimisation_iteration
         timer = dolfin.Timer("j evaluation")
         j = self._compute_functional_mem(m, annotate=annotate)
         timer.stop()
 
         if self.parameters.save_checkpoints:
             self._save_checkpoint()
+        self._write_profile()
 
         log(INFO, 'Runtime: %f s.' % timer.elapsed()[0])
         log(INFO, 'j = %e.' % float(j))
@@ -361,6 +470,7 @@ class ReducedFunctional(ReducedFunctionalPrototype):
     def _dj(self, m, forget, new_search_iteration=True):
         """ This memoised function returns the gradient of the functional for the parameter choice m. """
         log(INFO, 'Start evaluation of dj')
+        profiler.iteration = self.solver.optimisation_iteration
         timer = dolfin.Timer("dj evaluation")
         dj = self._compute_gradient_mem(m, forget)
 
@@ -395,6 +505,7 @@ class ReducedFunctional(ReducedFunctionalPrototype):
 
         if self.parameters.save_checkpoints:
             self._save_checkpoint()
+        self._write_profile()
 
         log(INFO, "Runtime: " + str(timer.stop()) + " s")
         log(INFO, "|dj| = " + str(numpy.linalg.norm(dj)))
@@ -447,7 +558,9 @@ class ReducedFunctional(ReducedFunctionalPrototype):
         the functional for the parameter choice m. '''
 
         log(INFO, "Checking derivative at m = " + str(m))
-        p = numpy.random.rand(len(m))
+        # The perturbation direction has a fixed seed, so that it is the same
+        # on all processors.
+        p = numpy.random.RandomState(21).rand(len(m))
         minconv = helpers.test_gradient_array(self.evaluate,
                                               self._dj,
                                               m,
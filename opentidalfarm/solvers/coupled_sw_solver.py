@@ -1,14 +1,20 @@
 import os.path
 from os import mkdir
 
+import dolfin
 from dolfin import *
 from dolfin_adjoint import *
+from dolfin_adjoint import adjglobals, adjlinalg, compatibility, solving
+import libadjoint
 
 from solver import Solver
 from ..problems import SWProblem
 from ..problems import SteadySWProblem
 from ..problems import MultiSteadySWProblem
 from ..helpers import StateWriter, FrozenClass
+from ..profiling import profiler
+from warm_start import WarmStartCache
+from fieldsplit_solver import FieldSplitNewtonSolver
 
 
 class CoupledSWSolverParameters(FrozenClass):
@@ -26,12 +32,44 @@ class CoupledSWSolverParameters(FrozenClass):
         By default, the MUMPS direct solver is used for the linear system. If
         not available, the default solver and preconditioner of FEniCS is used.
 
+    :ivar iterative_solver: If True, the linear systems of the forward Newton
+        iterations are solved with GMRES and a Schur complement field-split
+        preconditioner with algebraic multigrid on the velocity block (see
+        :class:`FieldSplitNewtonSolver`), instead of the linear solver in
+        `dolfin_solver`. The solves are recorded for dolfin-adjoint with the
+        `dolfin_solver` settings, which are used for the adjoint and for
+        replays. Requires petsc4py. Default: False
+    :ivar iterative_solver_parameters: The settings for the iterative solver:
+        the relative tolerance, the maximum number of iterations and the
+        restart of GMRES, and the algebraic multigrid preconditioner for the
+        velocity and Schur complement blocks ("hypre" or "gamg").
+
     :ivar dump_period: Specifies how often the solution should be dumped to disk.
         Use a negative value to disable it. Default 1.
     :ivar cache_forward_state: If True, the shallow water solutions are stored
         for every timestep and are used as initial guesses for the next solve.
         If False, the solution of the previous timestep is used as an initial guess.
         Default: True
+    :ivar cache_forward_state_controls: The number of previous control vectors
+        for which the shallow water solutions are cached. The initial guesses
+        are taken from the cached run with the nearest control vector. If the
+        cache is full, the least recently used run is evicted. Each cached run
+        stores one solution per timestep. Default: 1
+    :ivar cache_forward_state_memory_budget: The memory in bytes (per
+        processor) for the cached shallow water solutions. If it is exceeded,
+        the solutions of the least recently used control vectors are evicted,
+        but the solutions of the current run are always kept. Default: None
+        (only `cache_forward_state_controls` applies)
+    :ivar extrapolate_forward_state: If True and at least two runs are cached,
+        the initial guesses are linearly extrapolated from the solutions of the
+        two runs with the nearest control vectors. Default: False
+    :ivar jacobian_reuse_period: If larger than 1, a modified Newton method is
+        used with a direct linear solver: the factorisation of the Jacobian is
+        recomputed only at the first time level of each period of this many
+        time levels, and is reused for all Newton iterations of the remaining
+        time levels of the period. The symbolic factorisation is always reused.
+        Modified Newton iterations converge linearly, so the maximum number of
+        Newton iterations may need to be increased. Default: 1 (full Newton)
     :ivar print_individual_turbine_power: Print out the turbine power for each
         turbine. Default: False
     :ivar quadrature_degree: The quadrature degree for the matrix assembly.
@@ -39,7 +77,17 @@ class CoupledSWSolverParameters(FrozenClass):
     :ivar cpp_flags: A list of cpp compiler options for the code generation.
         Default: ["-O3", "-ffast-math", "-march=native"]
     :ivar revolve_parameters: The adjoint checkpointing settings as a set of the
-        form (strategy, snaps_on_disk, snaps_in_ram, verbose). Default: None
+        form (strategy, snaps_on_disk, snaps_in_ram, verbose). Overrides
+        `checkpoint_memory_budget`. Default: None
+    :ivar checkpoint_memory_budget: The memory in bytes (per processor) for
+        storing the forward states for the adjoint run. If the states of all
+        timesteps do not fit, a binomial checkpointing schedule is chosen
+        automatically and its recomputation overhead is logged, see
+        :class:`opentidalfarm.checkpointing.CheckpointSchedule`.
+        Default: None (all states are kept in memory)
+    :ivar checkpoint_disk_budget: The disk space in bytes (per processor) for
+        additional checkpoints if `checkpoint_memory_budget` is set.
+        Default: None (no checkpoints on disk)
     :ivar output_dir: The base directory in which to store the file ouputs.
         Default: `os.curdir`
     :ivar output_turbine_power: Output the power generation of the individual
@@ -56,12 +104,24 @@ class CoupledSWSolverParameters(FrozenClass):
         velocity at each turbine position. Default: False
     :ivar output_control_array: Output a numpy textfile containing the
         control array from each optimisation and search iteration. Default: False
+    :ivar output_profile: Output the wall time, call counts, solver iterations
+        and peak memory usage of the forward and adjoint solves, turbine cache
+        updates, constraint evaluations and state output per optimisation
+        iteration, as `profile.json`, and as the Chrome trace
+        `profile_trace.json` if the trace of the profiler is enabled, see
+        :mod:`opentidalfarm.profiling`. It is written independently of the
+        `dump_period`. Default: False
     :ivar callback: A callback function that is executed for every time-level.
         The callback function must take a single parameter which contains the
         dictionary with the solution variables.
     """
 
     dolfin_solver = {"newton_solver": {}}
+    iterative_solver = False
+    iterative_solver_parameters = {"relative_tolerance": 1e-8,
+                                   "maximum_iterations": 500,
+                                   "gmres_restart": 100,
+                                   "amg": "hypre"}
     dump_period = 1
     print_individual_turbine_power = False
 
@@ -76,15 +136,22 @@ class CoupledSWSolverParameters(FrozenClass):
     output_temporal_breakdown_of_j = False
     output_control_array = False
     output_abs_u_at_turbine_positions = False
+    output_profile = False
 
     # Performance settings
     cache_forward_state = True
+    cache_forward_state_controls = 1
+    cache_forward_state_memory_budget = None
+    extrapolate_forward_state = False
+    jacobian_reuse_period = 1
     quadrature_degree = -1
     cpp_flags = ["-O3", "-ffast-math", "-march=native"]
     revolve_parameters = None  # (strategy,
                                # snaps_on_disk,
                                # snaps_in_ram,
                                # verbose)
+    checkpoint_memory_budget = None
+    checkpoint_disk_budget = None
 
     # Callback function
     callback = lambda self, sol: None
@@ -119,6 +186,9 @@ class CoupledSWSolver(Solver):
         = f_u^{n+1}, \\
         \nabla \cdot \left(H^{n+1} u^{n+1}\right) & = 0.
 
+    If the problem has a time level partition, each processor group only
+    solves and yields its own time levels.
+
     For a :class:`opentidalfarm.problems.sw.SWProblem`, and given an initial
     condition :math:`u^{0}` and :math:`\eta^{0}` it solves :math:`u^{n+1}` and
     :math:`\eta^{n+1}` for each timelevel such that:
@@ -169,13 +239,18 @@ class CoupledSWSolver(Solver):
         self.problem = problem
         self.parameters = solver_params
 
-        # If cache_for_nonlinear_initial_guess is true, then we store all
-        # intermediate state variables in this dictionary to be used for the
-        # next solve
-        self.state_cache = {}
+        # If cache_forward_state is true, then we store all intermediate state
+        # variables in this cache to be used for the next solves. It is
+        # created on the first solve.
+        self.state_cache = None
 
         self.state = None
 
+        # The nonlinear solvers of the last solve, together with the residual
+        # and the strong boundary conditions for which they were created.
+        # They are reused by the next solve if these have not changed.
+        self._solvers = None
+
         self.mesh = problem.parameters.domain.mesh
         elements = self.problem.parameters.finite_element()
         self.function_space = FunctionSpace(self.mesh, MixedElement(elements))
@@ -224,6 +299,88 @@ class CoupledSWSolver(Solver):
         else:
             return float(current_time - finish_time) >= - 1e3*DOLFIN_EPS
 
+    @staticmethod
+    def _same_residual(F, G):
+        """ Returns True if the residual forms F and G are identical. Constant
+        coefficients, such as the time step that each solve creates, are
+        compared by value, all other coefficients by identity. """
+        if F.signature() != G.signature():
+            return False
+        for c, d in zip(F.coefficients(), G.coefficients()):
+            if (isinstance(c, dolfin.Constant) and
+                isinstance(d, dolfin.Constant)):
+                if (c.values() != d.values()).any():
+                    return False
+            elif c is not d:
+                return False
+        return True
+
+    def _nonlinear_solvers(self, F, state_new):
+        """ Returns the Newton solver, the iterative block solver (None if
+        disabled) and the strong boundary conditions for the residual F. The
+        solvers are created once and are reused across solves, including the
+        factorisation of a direct linear solver, as long as the residual and
+        the strong boundary conditions do not change. """
+        solver_params = self.parameters
+        strong_bcs_key = [(function_name, id(expr), facet_id) for
+                          function_name, expr, facet_id, _ in
+                          self.problem.parameters.bcs.filter(
+                              bctype="strong_dirichlet")]
+        key = (strong_bcs_key, solver_params.iterative_solver)
+
+        if (self._solvers is not None and self._solvers[1] == key and
+            self._same_residual(F, self._solvers[0])):
+            nonlinear_solver, block_solver, strong_bcs = self._solvers[2:]
+            log(INFO, "Reuse the nonlinear solver of the previous solve.")
+        else:
+            strong_bcs = self._generate_strong_bcs()
+            nonlinear_problem = NonlinearVariationalProblem(F, state_new,
+                bcs=strong_bcs, J=derivative(F, state_new))
+            nonlinear_solver = NonlinearVariationalSolver(nonlinear_problem)
+
+            block_solver = None
+            if solver_params.iterative_solver:
+                block_solver = FieldSplitNewtonSolver(F, state_new, strong_bcs,
+                    solver_params.dolfin_solver["newton_solver"],
+                    solver_params.iterative_solver_parameters)
+
+            # The cached boundary conditions keep their expressions alive, so
+            # that the ids in the key remain unique.
+            self._solvers = (F, key, nonlinear_solver, block_solver,
+                             strong_bcs)
+
+        nonlinear_solver.parameters.update(solver_params.dolfin_solver)
+        return nonlinear_solver, block_solver, strong_bcs
+
+    @staticmethod
+    def _annotated_solve(nonlinear_solver, solve, annotate):
+        ''' Computes the solution of the current time level with the
+        callable solve, which must not annotate, and records it with
+        dolfin-adjoint as a solve of nonlinear_solver.
+
+        The recording follows the annotation of
+        NonlinearVariationalSolver.solve, but does not run the Newton solver
+        again. The recorded solver parameters are the ones configured by the
+        user, so that replays and the adjoint are not affected by how the
+        forward solution was obtained, e.g. with a reused factorisation or the
+        iterative block solver.
+
+        :returns: The result of solve. '''
+        problem = nonlinear_solver.problem
+        if annotate:
+            solving.annotate(problem.F_ufl == 0, problem.u_ufl,
+                             problem.bcs_ufl, J=problem.J_ufl,
+                             solver_parameters=compatibility.to_dict(
+                                 nonlinear_solver.parameters))
+
+        result = solve()
+
+        if annotate and parameters["adjoint"]["record_all"]:
+            adjglobals.adjointer.record_variable(
+                adjglobals.adj_variables[problem.u_ufl],
+                libadjoint.MemoryStorage(adjlinalg.Vector(problem.u_ufl)))
+        return result
+
     def solve(self, annotate=True):
         ''' Returns an iterator for solving the shallow water equations. '''
 
@@ -256,6 +413,7 @@ class CoupledSWSolver(Solver):
             t = Constant(problem_params.start_time)
 
             include_time_term = True
+            partition = None
 
         elif type(self.problem) == MultiSteadySWProblem:
             log(INFO, "Solve a multi steady-state shallow water problem")
@@ -270,6 +428,20 @@ class CoupledSWSolver(Solver):
 
             include_time_term = False
 
+            # The time levels may be distributed over groups of processors
+            partition = problem_params.time_level_partition
+            if (partition is not None and farm and
+                type(farm.friction_function) == list):
+                raise NotImplementedError("Dynamic friction is not supported "
+                                          "with a time level partition.")
+            # The time levels are start_time, start_time + dt, ..., finish_time
+            if (partition is not None and
+                float(problem_params.start_time) +
+                (partition.groups - 1)*float(dt) >
+                float(finish_time) + 0.5*float(dt)):
+                raise ValueError("The time level partition has more groups "
+                                 "than time levels.")
+
         elif type(self.problem) == SteadySWProblem:
             log(INFO, "Solve a steady-state shallow water problem")
 
@@ -280,6 +452,7 @@ class CoupledSWSolver(Solver):
             t = Constant(0.)
 
             include_time_term = False
+            partition = None
 
         else:
             raise TypeError("Do not know how to solve problem of type %s." %
@@ -300,10 +473,22 @@ class CoupledSWSolver(Solver):
         # Define test functions
         v, q = TestFunctions(self.function_space)
 
-        # Define functions
-        state = Function(self.function_space, name="Current_state")
-        self.state = state
-        state_new = Function(self.function_space, name="New_state")
+        # Define functions. They are kept across solves, so that the nonlinear
+        # solvers can be reused.
+        if self.state is None:
+            self.state = Function(self.function_space, name="Current_state")
+            self._state_new = Function(self.function_space, name="New_state")
+        state = self.state
+        state_new = self._state_new
+
+        if cache_forward_state:
+            if self.state_cache is None:
+                self.state_cache = WarmStartCache(
+                    max_controls=solver_params.cache_forward_state_controls,
+                    max_bytes=solver_params.cache_forward_state_memory_budget,
+                    extrapolate=solver_params.extrapolate_forward_state)
+            controls = self.controls if self.controls is not None else []
+            self.state_cache.start(controls)
 
         # Load initial condition (or initial guess for stady problems)
         # Projection is necessary to obtain 2nd order convergence
@@ -439,91 +624,33 @@ class CoupledSWSolver(Solver):
         if include_time_term:
             F += M - M0
 
-        # Generate the scheme specific strong boundary conditions
-        strong_bcs = self._generate_strong_bcs()
+        # Get the nonlinear solvers for all time levels, together with the
+        # scheme specific strong boundary conditions
+        nonlinear_solver, block_solver, strong_bcs = \
+            self._nonlinear_solvers(F, state_new)
+
+        newton_params = nonlinear_solver.parameters["newton_solver"]
+        direct = newton_params["linear_solver"] in lu_solver_methods()
+        if direct:
+            newton_params["lu_solver"]["same_nonzero_pattern"] = True
+        reuse_period = solver_params.jacobian_reuse_period
+        if reuse_period > 1 and not direct:
+            log(WARNING, "The Jacobian factorisation can only be reused with a "
+                         "direct linear solver.")
 
         ############################### Perform the simulation ###########################
 
+        writer = None
         if solver_params.dump_period > 0:
             writer = StateWriter(solver=self)
-            if type(self.problem) == SWProblem:
+
+        # The writer is closed in any case, also if the iteration is
+        # abandoned or fails, so that the files are closed.
+        try:
+            if writer is not None and type(self.problem) == SWProblem:
                 log(INFO, "Writing state to disk...")
-                writer.write(state)
-
-        result = {"time": float(t),
-                  "u": state.split()[0],
-                  "eta": state.split()[1],
-                  "tf": tf,
-                  "state": state,
-                  "is_final": self._finished(t, finish_time)}
-        solver_params.callback(result)
-        yield(result)
-
-        log(INFO, "Start of time loop")
-        if annotate:
-            adjointer.time.start(t)
-        timestep = 0
-        while not self._finished(t, finish_time):
-            # Update timestep
-            timestep += 1
-            t = Constant(t + dt)
-
-            # Update bc's
-            t_theta = Constant(t - (1.0 - theta) * dt)
-            bcs.update_time(t, only_type=["strong_dirichlet"])
-            bcs.update_time(t_theta, exclude_type=["strong_dirichlet"])
-
-            # Update source term
-            f_u.t = Constant(t_theta)
-
-            # Set the control function for the upcoming timestep.
-            if farm:
-                if type(farm.friction_function) == list:
-                    tf.assign(theta*farm.friction_function[timestep]+(1.\
-                              -float(theta))*farm.friction_function[timestep-1],
-                              annotate=annotate)
-                else:
-                    tf.assign(farm.friction_function)
-
-            # Set the initial guess for the solve
-            if cache_forward_state and self.state_cache.has_key(float(t)):
-                log(INFO, "Read initial guess from cache for t=%f." % t)
-                # Load initial guess for solver from cache
-                state_new.assign(self.state_cache[float(t)], annotate=False)
-
-            elif not include_time_term:
-                log(INFO, "Set the initial guess for the nonlinear solver to the initial condition.")
-                # Reset the initial guess after each timestep
-                ic = problem_params.initial_condition
-                state_new.assign(ic, annotate=False)
-
-            # Solve non-linear system with a Newton solver
-            if self.problem._is_transient:
-                log(INFO, "Solve shallow water equations at time %s" % float(t))
-            else:
-                log(INFO, "Solve shallow water equations.")
-
-            solve(F == 0, state_new, bcs=strong_bcs,
-                  solver_parameters=solver_params.dolfin_solver,
-                  annotate=annotate,
-                  J=derivative(F, state_new))
-
-            # After the timestep solve, update state
-            state.assign(state_new)
-
-            if cache_forward_state:
-                # Save state for initial guess cache
-                log(INFO, "Cache solution t=%f as next initial guess." % t)
-                if not self.state_cache.has_key(float(t)):
-                    self.state_cache[float(t)] = Function(self.function_space)
-                self.state_cache[float(t)].assign(state_new, annotate=False)
-
-            if (solver_params.dump_period > 0 and
-                timestep % solver_params.dump_period == 0):
-                log(INFO, "Write state to disk...")
-                writer.write(state)
-
-            # Return the results
+                writer.write(state, float(t))
+
             result = {"time": float(t),
                       "u": state.split()[0],
                       "eta": state.split()[1],
@@ -533,11 +660,118 @@ class CoupledSWSolver(Solver):
             solver_params.callback(result)
             yield(result)
 
-            # Increase the adjoint timestep
+            log(INFO, "Start of time loop")
             if annotate:
-                adj_inc_timestep(time=float(t), finished=self._finished(t,
-                    finish_time))
-
+                adjointer.time.start(t)
+            timestep = 0
+            while not self._finished(t, finish_time):
+                # Update timestep
+                timestep += 1
+                t = Constant(t + dt)
+
+                if partition is not None and not partition.owns(timestep):
+                    log(INFO, "Skip time level %s, which is solved by another "
+                              "processor group." % float(t))
+                    continue
+
+                # Update bc's
+                t_theta = Constant(t - (1.0 - theta) * dt)
+                bcs.update_time(t, only_type=["strong_dirichlet"])
+                bcs.update_time(t_theta, exclude_type=["strong_dirichlet"])
+
+                # Update source term
+                f_u.t = Constant(t_theta)
+
+                # Set the control function for the upcoming timestep.
+                if farm:
+                    if type(farm.friction_function) == list:
+                        tf.assign(theta*farm.friction_function[timestep]+(1.\
+                                  -float(theta))*farm.friction_function[timestep-1],
+                                  annotate=annotate)
+                    else:
+                        tf.assign(farm.friction_function)
+
+                # Set the initial guess for the solve
+                cached = (cache_forward_state and
+                          self.state_cache.initial_guess(float(t), state_new))
+
+                if not cached and not include_time_term:
+                    log(INFO, "Set the initial guess for the nonlinear solver to the initial condition.")
+                    # Reset the initial guess after each timestep
+                    ic = problem_params.initial_condition
+                    state_new.assign(ic, annotate=False)
+
+                # Solve non-linear system with a Newton solver
+                if self.problem._is_transient:
+                    log(INFO, "Solve shallow water equations at time %s" % float(t))
+                else:
+                    log(INFO, "Solve shallow water equations.")
+
+                reuse = (direct and reuse_period > 1 and
+                         (timestep - 1) % reuse_period != 0)
+
+                with profiler.region("forward solve"):
+                    if block_solver is None and reuse:
+                        # The reused factorisation must not end up in the
+                        # solver parameters that dolfin-adjoint records, so
+                        # the solve is recorded separately.
+                        def solve_reusing_factorization():
+                            newton_params["lu_solver"]["reuse_factorization"] = \
+                                True
+                            try:
+                                return nonlinear_solver.solve(annotate=False)
+                            finally:
+                                newton_params["lu_solver"][
+                                    "reuse_factorization"] = False
+
+                        newton_iterations, converged = self._annotated_solve(
+                            nonlinear_solver, solve_reusing_factorization,
+                            annotate)
+                    elif block_solver is None:
+                        newton_iterations, converged = nonlinear_solver.solve(
+                            annotate=annotate)
+                    else:
+                        newton_iterations, converged = self._annotated_solve(
+                            nonlinear_solver, block_solver.solve, annotate)
+                        profiler.count("krylov_iterations",
+                                       block_solver.krylov_iterations())
+                    profiler.count("newton_iterations", newton_iterations)
+
+                # After the timestep solve, update state
+                state.assign(state_new)
+
+                if cache_forward_state:
+                    # Save state for initial guess cache
+                    log(INFO, "Cache solution t=%f as next initial guess." % t)
+                    self.state_cache.store(float(t), state_new)
+
+                if (solver_params.dump_period > 0 and
+                    timestep % solver_params.dump_period == 0):
+                    log(INFO, "Write state to disk...")
+                    writer.write(state, float(t))
+
+                # Return the results
+                result = {"time": float(t),
+                          "u": state.split()[0],
+                          "eta": state.split()[1],
+                          "tf": tf,
+                          "state": state,
+                          "is_final": self._finished(t, finish_time)}
+                solver_params.callback(result)
+                yield(result)
+
+                # Increase the adjoint timestep. With a time level partition, the
+                # tape of this group ends with the last time level it owns.
+                if annotate:
+                    if partition is None:
+                        finished = self._finished(t, finish_time)
+                    else:
+                        finished = (float(t) + partition.groups*float(dt) >
+                                    float(finish_time) + 0.5*float(dt))
+                    adj_inc_timestep(time=float(t), finished=finished)
+        finally:
+            if writer is not None:
+                writer.close()
 
         # If we're outputting the individual turbine power
         if (self.parameters.print_individual_turbine_power
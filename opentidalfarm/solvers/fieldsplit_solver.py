@@ -0,0 +1,101 @@
+import dolfin
+from dolfin import *
+from dolfin_adjoint import *
+
+
+class _SWNonlinearProblem(NonlinearProblem):
+    """ The shallow water residual and Jacobian for dolfin's Newton solver. """
+
+    def __init__(self, F, J, bcs):
+        NonlinearProblem.__init__(self)
+        self.F_form = F
+        self.J_form = J
+        self.bcs = bcs
+
+    def F(self, b, x):
+        dolfin.assemble(self.F_form, tensor=b)
+        for bc in self.bcs:
+            bc.apply(b, x)
+
+    def J(self, A, x):
+        dolfin.assemble(self.J_form, tensor=A)
+        for bc in self.bcs:
+            bc.apply(A)
+
+
+class FieldSplitNewtonSolver(object):
+    r""" A Newton solver for the coupled shallow water equations, whose linear
+    systems are solved with GMRES and a Schur complement field-split
+    preconditioner.
+
+    The velocity and free-surface degrees of freedom form the two fields of
+    the split. The velocity block is preconditioned with algebraic multigrid,
+    and the Schur complement is approximated with
+    :math:`A_{\eta\eta} - A_{\eta u} \text{diag}(A_{uu})^{-1} A_{u\eta}` and
+    preconditioned with algebraic multigrid as well.
+
+    The solves of this solver are not annotated for dolfin-adjoint.
+    Requires PETSc and petsc4py.
+
+    :param F: The residual form.
+    :param state: The mixed (velocity, free-surface) solution function.
+    :param bcs: The strong boundary conditions.
+    :param newton_parameters: The dolfin Newton solver parameters. The linear
+        solver settings are ignored.
+    :param parameters: The iterative solver parameters, see
+        :attr:`CoupledSWSolverParameters.iterative_solver_parameters`.
+    """
+
+    def __init__(self, F, state, bcs, newton_parameters, parameters):
+        from petsc4py import PETSc
+
+        self.state = state
+        self.problem = _SWNonlinearProblem(F, derivative(F, state), bcs)
+
+        # Solve on the communicator of the mesh, which may be a
+        # sub-communicator, e.g. of a time level partition.
+        W = state.function_space()
+        comm = W.mesh().mpi_comm()
+
+        self.linear_solver = PETScKrylovSolver(comm, "gmres")
+        ksp = self.linear_solver.ksp()
+        prefix = "otf_sw_"
+        ksp.setOptionsPrefix(prefix)
+
+        # Define the fields by their degrees of freedom.
+        fields = [("u", W.sub(0).dofmap().dofs()),
+                  ("eta", W.sub(1).dofmap().dofs())]
+        pc = ksp.getPC()
+        pc.setType("fieldsplit")
+        pc.setFieldSplitIS(*[(name, PETSc.IS().createGeneral(dofs, comm=comm))
+                             for name, dofs in fields])
+
+        amg = parameters["amg"]
+        options = PETSc.Options()
+        options[prefix + "ksp_rtol"] = parameters["relative_tolerance"]
+        options[prefix + "ksp_max_it"] = parameters["maximum_iterations"]
+        options[prefix + "ksp_gmres_restart"] = parameters["gmres_restart"]
+        options[prefix + "pc_fieldsplit_type"] = "schur"
+        options[prefix + "pc_fieldsplit_schur_fact_type"] = "upper"
+        options[prefix + "pc_fieldsplit_schur_precondition"] = "selfp"
+        for name in ["u", "eta"]:
+            options[prefix + "fieldsplit_%s_ksp_type" % name] = "preonly"
+            options[prefix + "fieldsplit_%s_pc_type" % name] = amg
+        ksp.setFromOptions()
+
+        self.newton_solver = NewtonSolver(comm,
+                                          self.linear_solver,
+                                          PETScFactory.instance())
+        self.newton_solver.parameters.update(newton_parameters)
+
+    def solve(self):
+        """ Solves the nonlinear problem, starting from the current state.
+
+        :returns: The number of Newton iterations and whether they converged.
+        """
+        return self.newton_solver.solve(self.problem, self.state.vector())
+
+    def krylov_iterations(self):
+        """ Returns the total number of Krylov iterations of the last
+        solve. """
+        return self.newton_solver.krylov_iterations()
@@ -30,6 +30,17 @@ class IPCSSWSolverParameters(FrozenClass):
         Default: -1 (auto)
     :ivar cpp_flags: A list of cpp compiler options for the code generation.
         Default: ["-O3", "-ffast-math", "-march=native"]
+    :ivar tentative_velocity_solver: The linear solver method and
+        preconditioner for the tentative velocity system. A Krylov method,
+        e.g. ("gmres", "default"), uses the solution of the previous time step
+        as initial guess. Default: ("lu", "default")
+    :ivar pressure_correction_solver: The linear solver method and
+        preconditioner for the pressure correction system if the divergence
+        term is nonlinear, e.g. ("cg", "default"). Default: ("lu", "default")
+    :ivar krylov_solver_parameters: The parameters of the Krylov solvers, if
+        used. Default: {"relative_tolerance": 1e-10,
+        "absolute_tolerance": 1e-14, "maximum_iterations": 1000,
+        "nonzero_initial_guess": True}
 
     Large eddy simulation parameters:
 
@@ -48,6 +59,12 @@ class IPCSSWSolverParameters(FrozenClass):
     # Performance settings
     quadrature_degree = -1
     cpp_flags = ["-O3", "-ffast-math", "-march=native"]
+    tentative_velocity_solver = ("lu", "default")
+    pressure_correction_solver = ("lu", "default")
+    krylov_solver_parameters = {"relative_tolerance": 1e-10,
+                                "absolute_tolerance": 1e-14,
+                                "maximum_iterations": 1000,
+                                "nonzero_initial_guess": True}
 
     def __init__(self):
 
@@ -210,6 +227,38 @@ IPCSSWSolverParameters."
 
         return bcs_u, bcs_eta
 
+    def _linear_solver(self, A, method):
+        """ Returns a solver for the matrix A with the given (method,
+        preconditioner) pair. """
+        if method[0] == "lu":
+            return LUSolver(A)
+        solver = KrylovSolver(A, *method)
+        solver.parameters.update(self.parameters.krylov_solver_parameters)
+        return solver
+
+    @staticmethod
+    def _assemble_system(A, a, L, bcs, A_const, a_var, annotate):
+        """ Assembles the form a into the preallocated matrix A and returns the
+        assembled right hand side L, both with the boundary conditions bcs
+        applied.
+
+        Only the time-dependent part a_var is assembled; the preassembled
+        time-independent part A_const, which shares the sparsity pattern of A,
+        is added. If annotated, the full form a is attached to A so that
+        dolfin-adjoint records (and replays) the solve with the complete
+        operator. """
+        assemble(a_var, tensor=A)
+        A.axpy(1., A_const, True)
+        b = assemble(L)
+        if annotate:
+            # dolfin-adjoint records a solve from the form and boundary
+            # conditions attached to its matrix. The latter are collected by
+            # bc.apply, so reset them from the previous timestep.
+            A.form = a
+            A.bcs = []
+        for bc in bcs: bc.apply(A, b)
+        return b
+
     def _finished(self, current_time, finish_time):
         if (hasattr(self.problem.parameters, 'finished')):
             return self.problem.parameters.finished(current_time)
@@ -321,16 +370,17 @@ IPCSSWSolverParameters."
         eta0.assign(eta_ic, annotate=False)
         eta1.assign(eta_ic, annotate=False)
 
-        # Tentative velocity step
+        # Tentative velocity step. The terms are split into time-independent
+        # ones, whose matrix is assembled only once, and the remaining ones.
         u_mean = theta * u + (1. - theta) * u0
         u_bash = 3./2 * u0 - 1./2 * u00
         u_diff = u - u0
         norm_u0 = inner(u0, u0)**0.5
-        F_u_tent = ((1/dt) * inner(v, u_diff) * dx()
-                    + inner(v, grad(u_bash)*u_mean) * dx()
-                    + g * inner(v, grad(eta0)) * dx()
-                    + friction / H * norm_u0 * inner(u_mean, v) * dx
-                    - inner(v, f_u) * dx())
+        F_u_tent_const = (1/dt) * inner(v, u_diff) * dx()
+        F_u_tent_var = (inner(v, grad(u_bash)*u_mean) * dx()
+                        + g * inner(v, grad(eta0)) * dx()
+                        + friction / H * norm_u0 * inner(u_mean, v) * dx
+                        - inner(v, f_u) * dx())
         # Viscosity term
         if dgu:
             # Taken from http://maths.dur.ac.uk/~dma0mpj/summer_school/IPHO.pdf
@@ -341,23 +391,40 @@ IPCSSWSolverParameters."
             # we can select either side
             alpha = sigma/edgelen
 
-            F_u_tent += nu * inner(grad(v), grad(u_mean)) * dx()
+            F_visc = nu * inner(grad(v), grad(u_mean)) * dx()
             for d in range(2):
-                F_u_tent += - nu * inner(avg(grad(u_mean[d])), jump(v[d], n))*dS
-                F_u_tent += - nu * tau * inner(avg(grad(v[d])), jump(u[d], n))*dS
-                F_u_tent += alpha * nu * inner(jump(u[d], n), jump(v[d], n))*dS
+                F_visc += - nu * inner(avg(grad(u_mean[d])), jump(v[d], n))*dS
+                F_visc += - nu * tau * inner(avg(grad(v[d])), jump(u[d], n))*dS
+                F_visc += alpha * nu * inner(jump(u[d], n), jump(v[d], n))*dS
+
+        else:
+            F_visc = nu * inner(grad(v), grad(u_mean)) * dx()
 
+        # The viscosity is time-dependent if the LES model is active
+        if include_les:
+            F_u_tent_var += F_visc
         else:
-            F_u_tent += nu * inner(grad(v), grad(u_mean)) * dx()
+            F_u_tent_const += F_visc
 
+        F_u_tent = F_u_tent_const + F_u_tent_var
         a_u_tent = lhs(F_u_tent)
+        a_u_tent_const = lhs(F_u_tent_const)
+        a_u_tent_var = lhs(F_u_tent_var)
         L_u_tent = rhs(F_u_tent)
 
-        # Pressure correction
+        # Pressure correction. For the nonlinear divergence, the matrix depends
+        # linearly on the free-surface through the water depth H = eta0 + h,
+        # so the terms are split into the ones with the bathymetry h and the
+        # ones with eta0.
         eta_diff = eta - eta0
         ut_mean = theta * ut + (1. - theta) * u0
-        F_p_corr = (q*eta_diff + g * dt**2 * theta**2 * H * inner(grad(q),
-            grad(eta_diff)))*dx() + dt*q*div(H*ut_mean)*dx()
+        F_p_corr_const = (q*eta_diff + g * dt**2 * theta**2 * h *
+                          inner(grad(q), grad(eta_diff)))*dx()
+        F_p_corr_var = dt*q*div(H*ut_mean)*dx()
+        if not linear_divergence:
+            F_p_corr_var += g * dt**2 * theta**2 * eta0 * inner(grad(q),
+                                                          grad(eta_diff))*dx()
+        F_p_corr = F_p_corr_const + F_p_corr_var
         a_p_corr = lhs(F_p_corr)
         L_p_corr = rhs(F_p_corr)
 
@@ -379,6 +446,23 @@ IPCSSWSolverParameters."
             for bc in bceta: bc.apply(A_p_corr)
             a_p_corr_solver = LUSolver(A_p_corr)
             a_p_corr_solver.parameters["reuse_factorization"] = True
+        else:
+            # Assemble the time-independent part once. The matrix is
+            # preallocated with the sparsity pattern of the full form.
+            A_p_corr = assemble(a_p_corr)
+            A_p_corr_const = A_p_corr.copy()
+            assemble(lhs(F_p_corr_const), tensor=A_p_corr_const)
+            a_p_corr_var = lhs(F_p_corr_var)
+            a_p_corr_solver = self._linear_solver(A_p_corr,
+                solver_params.pressure_correction_solver)
+
+        # Assemble the time-independent part of the tentative velocity matrix
+        # once, with the sparsity pattern of the full form.
+        A_u_tent = assemble(a_u_tent)
+        A_u_tent_const = A_u_tent.copy()
+        assemble(a_u_tent_const, tensor=A_u_tent_const)
+        a_u_tent_solver = self._linear_solver(A_u_tent,
+            solver_params.tentative_velocity_solver)
 
         yield({"time": float(t),
                "u": u0,
@@ -414,23 +498,20 @@ IPCSSWSolverParameters."
 
             # Compute tentative velocity step
             log(PROGRESS, "Solve for tentative velocity.")
-            A_u_tent = assemble(a_u_tent)
-            b = assemble(L_u_tent)
-            for bc in bcu: bc.apply(A_u_tent, b)
-
-            solve(A_u_tent, ut.vector(), b)
+            b = self._assemble_system(A_u_tent, a_u_tent, L_u_tent, bcu,
+                                      A_u_tent_const, a_u_tent_var, annotate)
+            a_u_tent_solver.solve(ut.vector(), b)
 
             # Pressure correction
             log(PROGRESS, "Solve for pressure correction.")
-            b = assemble(L_p_corr)
-            for bc in bceta: bc.apply(b)
-
             if linear_divergence:
-                a_p_corr_solver.solve(eta1.vector(), b)
+                b = assemble(L_p_corr)
+                for bc in bceta: bc.apply(b)
             else:
-                A_p_corr = assemble(a_p_corr)
-                for bc in bceta: bc.apply(A_p_corr)
-                solve(A_p_corr, eta1.vector(), b)
+                b = self._assemble_system(A_p_corr, a_p_corr, L_p_corr, bceta,
+                                          A_p_corr_const, a_p_corr_var,
+                                          annotate)
+            a_p_corr_solver.solve(eta1.vector(), b)
 
             # Velocity correction
             log(PROGRESS, "Solve for velocity update.")
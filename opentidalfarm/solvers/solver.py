@@ -5,6 +5,8 @@ class Solver(object):
         """ Initialises the solver. """
         self.optimisation_iteration = 0
         self.search_iteration = 0
+        # The control vector of the current forward run, if known.
+        self.controls = None
 
     def update_optimisation_iteration(self, m):
         self.optimisation_iteration += 1
@@ -0,0 +1,142 @@
+import collections
+import numpy
+from dolfin import *
+from dolfin_adjoint import *
+from ..memoize import relative_distance, nbytes
+
+
+class WarmStartCache(object):
+    """ Stores the forward states of previous solves for several control
+    vectors, and provides initial guesses for the nonlinear solver.
+
+    Before each forward run, :meth:`start` selects the cached runs whose
+    control vectors are nearest to the new one. The states of these runs are
+    then used as the initial guesses for the Newton solves of the new run.
+
+    :param max_controls: The maximum number of control vectors for which the
+        states are kept. The states of the least recently used control vector
+        are evicted first.
+    :param max_bytes: The memory budget in bytes (per processor) for the
+        cached states, as estimated by :func:`memoize.nbytes`. If it is
+        exceeded, the states of the least recently used control vectors are
+        evicted. The states of the current run are always kept.
+        Default: None (only max_controls applies).
+    :param extrapolate: If True, the initial guess is linearly extrapolated
+        from the states of the two nearest control vectors.
+    """
+
+    def __init__(self, max_controls=1, extrapolate=False, max_bytes=None):
+        if max_controls < 1:
+            raise ValueError("max_controls must be at least 1.")
+        self.max_controls = max_controls
+        self.max_bytes = max_bytes
+        self.extrapolate = extrapolate
+
+        # Maps the control vectors (as tuples) to dictionaries of the form
+        # {time: state}, in least recently used order.
+        self._runs = collections.OrderedDict()
+        # The memory footprint of each run, and of all runs
+        self._run_nbytes = {}
+        self.nbytes = 0
+
+        self._current = None
+        self._current_key = None
+        self._nearest = None
+        self._second = None
+        self._alpha = 0.
+
+    def __len__(self):
+        return len(self._runs)
+
+    def start(self, controls):
+        """ Starts caching the states of a forward run with the given control
+        vector and selects the cached runs from which the initial guesses are
+        taken. """
+        controls = numpy.ravel(controls)
+        key = tuple(controls)
+
+        by_distance = sorted(self._runs.keys(),
+                             key=lambda k: relative_distance(controls, k))
+        neighbours = [k for k in by_distance
+                      if relative_distance(controls, k) < numpy.inf]
+
+        self._nearest = None
+        self._second = None
+        self._alpha = 0.
+
+        if len(neighbours) > 0:
+            self._nearest = self._runs[neighbours[0]]
+            log(INFO, "Use the states of a previous run with relative control "
+                      "distance %e as initial guesses." %
+                      relative_distance(controls, neighbours[0]))
+
+        if self.extrapolate and len(neighbours) > 1 and neighbours[0] != key:
+            self._second = self._runs[neighbours[1]]
+            self._alpha = self._extrapolation_factor(controls, neighbours[0],
+                                                     neighbours[1])
+
+        # The states of the current run replace those of a run with the same
+        # controls.
+        self._current = self._runs.pop(key, {})
+        self._current_key = key
+        self._runs[key] = self._current
+        if key not in self._run_nbytes:
+            self._run_nbytes[key] = nbytes(key) + nbytes(self._current)
+            self.nbytes += self._run_nbytes[key]
+        self._evict()
+
+    def _evict(self):
+        """ Evicts the states of the least recently used runs until at most
+        max_controls runs are cached and the memory budget is met. The
+        current run is always kept. """
+        while len(self._runs) > 1 and (len(self._runs) > self.max_controls or
+                                       (self.max_bytes is not None and
+                                        self.nbytes > self.max_bytes)):
+            key, _ = self._runs.popitem(last=False)
+            self.nbytes -= self._run_nbytes.pop(key)
+            log(INFO, "Evicted the cached states of a previous run.")
+
+    @staticmethod
+    def _extrapolation_factor(m, m1, m2):
+        """ Returns the factor alpha of the linear extrapolation
+        s1 + alpha*(s1 - s2), where alpha is the projection of m - m1 onto the
+        line through m2 and m1. It is limited to [-1, 1] to avoid poor initial
+        guesses far away from the cached states. """
+        m1 = numpy.array(m1)
+        d = m1 - numpy.array(m2)
+        norm = numpy.dot(d, d)
+        if norm == 0:
+            return 0.
+        return float(numpy.clip(numpy.dot(m - m1, d)/norm, -1., 1.))
+
+    def initial_guess(self, t, state):
+        """ Sets state to the initial guess for time t. Returns False if no
+        initial guess is cached for time t. """
+        if self._nearest is None or t not in self._nearest:
+            return False
+
+        s1 = self._nearest[t]
+        if (self._second is not None and t in self._second and
+            self._alpha != 0):
+            log(INFO, "Extrapolate initial guess from cache for t=%f with "
+                      "factor %f." % (t, self._alpha))
+            state.vector().zero()
+            state.vector().axpy(1.+self._alpha, s1.vector())
+            state.vector().axpy(-self._alpha, self._second[t].vector())
+        else:
+            log(INFO, "Read initial guess from cache for t=%f." % t)
+            state.assign(s1, annotate=False)
+        return True
+
+    def store(self, t, state):
+        """ Caches state as the solution of the current run at time t. """
+        if self._current is None:
+            raise ValueError("start() must be called before storing states.")
+
+        if t not in self._current:
+            self._current[t] = Function(state.function_space())
+            size = nbytes(t) + nbytes(self._current[t])
+            self._run_nbytes[self._current_key] += size
+            self.nbytes += size
+            self._evict()
+        self._current[t].assign(state, annotate=False)
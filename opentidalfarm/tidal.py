@@ -1,17 +1,24 @@
 from dolfin import Expression  # Keep readthedocs happy
 
+import dolfin
 from dolfin import *
 from dolfin_adjoint import *
-# this imports NetCDFFile from netCDF4, Scientific.IO.NetCDF or scipy.io.netcdf (whichever is available)
-from uptide.netcdf_reader import NetCDFFile
-import utm
-import uptide
-import uptide.tidal_netcdf
 import datetime
-import scipy.interpolate
+import hashlib
+import os
 import numpy
+from helpers import LazyModule, call_on_first_processor
 
-__all__ = ["TidalForcing", "BathymetryDepthExpression"]
+# The tidal and NetCDF dependencies are only imported once they are used.
+# netcdf_reader provides NetCDFFile from netCDF4, Scientific.IO.NetCDF or
+# scipy.io.netcdf (whichever is available)
+uptide = LazyModule("uptide")
+tidal_netcdf = LazyModule("uptide.tidal_netcdf")
+netcdf_reader = LazyModule("uptide.netcdf_reader")
+utm = LazyModule("utm")
+scipy_interpolate = LazyModule("scipy.interpolate")
+
+__all__ = ["TidalForcing", "BoundaryTidalForcing", "BathymetryDepthExpression"]
 
 # We need to store tnci_time as a non-class variable, otherwise
 # dolfin-adjoint tries to be clever and restores its values during the
@@ -42,7 +49,7 @@ class TidalForcing(Expression):
 
         tide = uptide.Tides(kwargs["constituents"])
         tide.set_initial_time(kwargs["initial_time"])
-        self.tnci = uptide.tidal_netcdf.OTPSncTidalInterpolator(tide,
+        self.tnci = tidal_netcdf.OTPSncTidalInterpolator(tide,
                     kwargs["grid_file_name"], kwargs["data_file_name"], kwargs["ranges"])
 
 
@@ -58,7 +65,7 @@ class TidalForcing(Expression):
         try:
           # OTPS has lon, lat coordinates!
           values[0] = self.tnci.get_val((latlon[1], latlon[0]), allow_extrapolation=True)
-        except uptide.netcdf_reader.CoordinateError:
+        except netcdf_reader.CoordinateError:
           # uptide raises a CoordinateError if interpolated within the land mask, this shouldn't happen
           # but dolfin evaluates too many points in the interior of the domain which are then not used
           # but some of those might overlap with landmask, therefore set to NaN instead of raising an exception
@@ -66,6 +73,139 @@ class TidalForcing(Expression):
           values[0] = numpy.NaN
 
 
+class BoundaryTidalForcing(Function):
+    """Create a tidal forcing Function from OTPSnc NetCDF files, with the same
+       data as :class:`TidalForcing`.
+
+       Unlike :class:`TidalForcing`, whose values dolfin evaluates at every
+       quadrature point of every assembly, this forcing is only defined at
+       the degrees of freedom on the forced boundaries. The complex
+       components of each constituent are interpolated once to these degrees
+       of freedom, and the forcing of a time level is a vectorised harmonic
+       sum.
+
+       The time is set with :meth:`set_time`, which the
+       :class:`BoundaryConditionSet` calls for every time level.
+
+       The parameters are:
+
+         V: the function space of the forcing
+         facet_ids: the facet markers (optional)
+         boundary_ids: the ids of the forced boundaries. Default: the whole
+             boundary
+         times: the time levels at which the forcing is tabulated once, e.g.
+             all time levels of the simulation, so that repeated solves (e.g.
+             in an optimisation) only look up the boundary values (optional)
+         grid_file_name
+         data_file_name
+         ranges
+         utm_zone
+         utm_band
+         initial_time
+         constituents
+        """
+
+    def __init__(self, V, facet_ids=None, boundary_ids=None, times=None,
+                 **kwargs):
+        super(BoundaryTidalForcing, self).__init__(V, name="tidal_forcing")
+        self.t = None
+
+        tide = uptide.Tides(kwargs["constituents"])
+        tide.set_initial_time(kwargs["initial_time"])
+        self.tnci = tidal_netcdf.OTPSncTidalInterpolator(tide,
+                    kwargs["grid_file_name"], kwargs["data_file_name"], kwargs["ranges"])
+
+        # Find the (processor-local) degrees of freedom on the boundaries
+        if boundary_ids is None:
+            bcs = [dolfin.DirichletBC(V, Constant(0), "on_boundary")]
+        else:
+            bcs = [dolfin.DirichletBC(V, Constant(0), facet_ids, i)
+                   for i in boundary_ids]
+        n_owned = V.dofmap().ownership_range()[1] - V.dofmap().ownership_range()[0]
+        dofs = set()
+        for bc in bcs:
+            dofs.update(bc.get_boundary_values().keys())
+        self._dofs = numpy.array(sorted([d for d in dofs if d < n_owned]),
+                                 dtype=numpy.intc)
+        self._n_owned = n_owned
+
+        # OTPS has lon, lat coordinates!
+        coords = V.tabulate_dof_coordinates().reshape(-1, 2)[self._dofs]
+        lonlat = [utm.to_latlon(x, y, kwargs["utm_zone"],
+                                kwargs["utm_band"])[::-1]
+                  for x, y in coords]
+
+        # The harmonic sum of uptide, with the nodal corrections of the
+        # initial time
+        self._omega = numpy.asarray(tide.omega, dtype=float)[:, numpy.newaxis]
+        self._f = numpy.asarray(tide.f, dtype=float)[:, numpy.newaxis]
+        self._phase = numpy.asarray(tide.phi + tide.u,
+                                    dtype=float)[:, numpy.newaxis]
+        self._real_parts, self._imag_parts = self._components(lonlat)
+
+        self._table = {}
+        for t in times or []:
+            self._table[float(t)] = self._boundary_values(t)
+
+    def _components(self, lonlat):
+        """ Returns the real and imaginary parts of the constituents at the
+        boundary degrees of freedom, as arrays of shape (constituents,
+        boundary degrees of freedom).
+
+        The components are interpolated from the grid with the interpolator
+        that uptide uses for the tidal signal. Since the interpolation is
+        linear, the harmonic sum of the interpolated components equals the
+        interpolated harmonic sum. """
+        n = len(self._omega)
+        real_parts = numpy.empty((n, len(lonlat)))
+        imag_parts = numpy.empty((n, len(lonlat)))
+
+        log(INFO, "Interpolating the tidal constituents to %i boundary degrees "
+                  "of freedom." % len(lonlat))
+        nci = self.tnci.nci
+        interpolators = [netcdf_reader.Interpolator(nci.origin, nci.delta,
+                                                    numpy.asarray(parts),
+                                                    nci.mask)
+                         for parts in (self.tnci.real_part,
+                                       self.tnci.imag_part)]
+        for k, x in enumerate(lonlat):
+            try:
+                real_parts[:, k] = interpolators[0].get_val(x,
+                    allow_extrapolation=True)
+                imag_parts[:, k] = interpolators[1].get_val(x,
+                    allow_extrapolation=True)
+            except netcdf_reader.CoordinateError:
+                # The boundary is within the land mask, set to NaN so that
+                # we'll notice it
+                real_parts[:, k] = numpy.NaN
+                imag_parts[:, k] = numpy.NaN
+
+        return real_parts, imag_parts
+
+    def _boundary_values(self, t):
+        """ Returns the forcing at the boundary degrees of freedom at time t. """
+        arguments = self._omega*float(t) + self._phase
+        return (self._f*(numpy.cos(arguments)*self._real_parts -
+                         numpy.sin(arguments)*self._imag_parts)).sum(axis=0)
+
+    def set_time(self, t):
+        """ Sets the forcing to its values at time t. """
+        self.t = t
+
+        values = numpy.zeros(self._n_owned)
+        boundary_values = self._table.get(float(t))
+        if boundary_values is None:
+            boundary_values = self._boundary_values(t)
+        values[self._dofs] = boundary_values
+
+        # The values are assigned from a new function, so that dolfin-adjoint
+        # records the forcing of each time level.
+        forcing = Function(self.function_space())
+        forcing.vector().set_local(values)
+        forcing.vector().apply("insert")
+        self.assign(forcing)
+
+
 class BathymetryDepthExpression(Expression):
     """Create a bathymetry depth Expression from a lat/lon NetCDF file, where
        the depth values stored as "z" field. 
@@ -81,23 +221,115 @@ class BathymetryDepthExpression(Expression):
     def __init__(self, *args, **kwargs):
 
         self._domain = kwargs.get("domain", None)
-        nc = NetCDFFile(kwargs["filename"], 'r')
-
-        lat = nc.variables['lat']
-        lon = nc.variables['lon']
-        values = nc.variables['z']
-
-        # work around incompatibilities in different netcdf libraries
-        if hasattr(lat, 'data'): lat = lat.data
-        if hasattr(lon, 'data'): lon = lon.data
-        if hasattr(values, 'data'): values = values.data
-
+        self.filename = kwargs["filename"]
         self.utm_zone = kwargs["utm_zone"]
         self.utm_band = kwargs["utm_band"]
         self.maxval = kwargs.get("maxval", 10)
-        self.interpolator = scipy.interpolate.RectBivariateSpline(lat, lon, values)
+        # The NetCDF file is only read once the bathymetry is evaluated, so
+        # that cached depth fields can be loaded without reading it.
+        self._interpolator = None
+
+    @property
+    def interpolator(self):
+        """ The spline interpolator of the NetCDF bathymetry data. """
+        if self._interpolator is None:
+            nc = netcdf_reader.NetCDFFile(self.filename, 'r')
+
+            lat = nc.variables['lat']
+            lon = nc.variables['lon']
+            values = nc.variables['z']
+
+            # work around incompatibilities in different netcdf libraries
+            if hasattr(lat, 'data'): lat = lat.data
+            if hasattr(lon, 'data'): lon = lon.data
+            if hasattr(values, 'data'): values = values.data
+
+            self._interpolator = scipy_interpolate.RectBivariateSpline(lat,
+                    lon, values)
+        return self._interpolator
 
     def eval(self, values, x):
-	" Evaluates the bathymetry at a point. """
+        """ Evaluates the bathymetry at a point. """
         lat, lon = utm.to_latlon(x[0], x[1], self.utm_zone, self.utm_band)
         values[0] = max(self.maxval, -self.interpolator(lat, lon))
+
+    def _to_latlon(self, x, y):
+        """ Converts arrays of UTM coordinates to latitude and longitude. """
+        try:
+            # Recent versions of utm accept numpy arrays
+            return utm.to_latlon(x, y, self.utm_zone, self.utm_band)
+        except (TypeError, ValueError):
+            latlon = [utm.to_latlon(xi, yi, self.utm_zone, self.utm_band)
+                      for xi, yi in zip(x, y)]
+            latlon = numpy.array(latlon).reshape(-1, 2)
+            return latlon[:, 0], latlon[:, 1]
+
+    def _cache_file(self, V, cache_dir):
+        """ Returns the name of the cache file of the depth field on V and
+        whether it exists. The name and the check are computed on the first
+        processor, so that all processors open the same file. """
+        comm = V.mesh().mpi_comm()
+        mesh_hashes = [V.mesh().hash()]
+        if MPI.size(comm) > 1:
+            mesh_hashes = comm.gather(mesh_hashes[0], root=0)
+
+        def cache_file():
+            sha = hashlib.sha1()
+            with open(self.filename, "rb") as f:
+                for chunk in iter(lambda: f.read(2**20), b""):
+                    sha.update(chunk)
+
+            # Everything that changes the interpolated values is part of the
+            # key, including the projection of the mesh coordinates.
+            key = (mesh_hashes, sha.hexdigest(), str(V.ufl_element()),
+                   self.maxval, self.utm_zone, self.utm_band)
+            key_hash = hashlib.sha1(repr(key)).hexdigest()
+            filename = os.path.join(cache_dir, "bathymetry_%s.h5" % key_hash)
+            return filename, os.path.isfile(filename)
+
+        return call_on_first_processor(comm, cache_file)
+
+    def interpolate(self, V, cache_dir=None):
+        """ Interpolates the bathymetry depth onto a function space.
+
+        Unlike :func:`dolfin.interpolate`, the coordinates of all degrees of
+        freedom are converted to latitude and longitude at once and the
+        spline is evaluated on the whole array.
+
+        :param V: A scalar function space.
+        :param cache_dir: If not None, the depth field is stored in an HDF5
+            file in this directory. The file is reused if the mesh, the
+            NetCDF file, the function space, maxval and the UTM zone and band
+            are unchanged.
+        :returns: The depth as a :class:`dolfin.Function` on V.
+        """
+        depth = Function(V, name="depth")
+
+        if cache_dir is not None:
+            filename, cached = self._cache_file(V, cache_dir)
+            if cached:
+                log(INFO, "Load bathymetry from cache file %s." % filename)
+                f = HDF5File(V.mesh().mpi_comm(), filename, "r")
+                f.read(depth, "depth")
+                f.close()
+                return depth
+
+        coords = V.tabulate_dof_coordinates().reshape(-1, 2)
+        lat, lon = self._to_latlon(coords[:, 0], coords[:, 1])
+        z = self.interpolator(lat, lon, grid=False)
+
+        depth.vector().set_local(numpy.maximum(self.maxval, -z))
+        depth.vector().apply("insert")
+
+        if cache_dir is not None:
+            if MPI.rank(V.mesh().mpi_comm()) == 0 and \
+               not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            MPI.barrier(V.mesh().mpi_comm())
+
+            log(INFO, "Store bathymetry in cache file %s." % filename)
+            f = HDF5File(V.mesh().mpi_comm(), filename, "w")
+            f.write(depth, "depth")
+            f.close()
+
+        return depth
@@ -1,10 +1,23 @@
 import copy
 import numpy
+import scipy.sparse
 from dolfin import *
 from dolfin_adjoint import *
-from turbine_function import TurbineFunction
+from turbine_function import TurbineFunction, DofLocator
+from profiling import profiled
 
 class TurbineCache(dict):
+
+    # If at most this fraction of the turbines moved since the last update,
+    # only the contributions of the moved turbines are recomputed. Otherwise
+    # the cache is rebuilt from scratch. Set to 0 to always rebuild.
+    incremental_update_fraction = 0.5
+
+    # The cache is rebuilt from scratch after this many consecutive
+    # incremental updates, so that round-off errors do not accumulate in the
+    # turbine field.
+    incremental_rebuild_period = 10
+
     def __init__(self, *args, **kw):
         super(TurbineCache, self).__init__(*args, **kw)
         self.itemlist = super(TurbineCache, self).keys()
@@ -12,9 +25,13 @@ class TurbineCache(dict):
         self._specification = None
         self._controlled_by = None
         self._parameters = None
+        self._turbine_bumps = None
+        self._incremental_updates = 0
+        self._dof_locator = None
 
     def __setitem__(self, key, value):
-        self.itemlist.append(key)
+        if key not in self:
+            self.itemlist.append(key)
         super(TurbineCache,self).__setitem__(key, value)
 
     def __iter__(self):
@@ -31,12 +48,23 @@ class TurbineCache(dict):
 
     def set_function_space(self, function_space):
         self._function_space = function_space
+        self._dof_locator = None
+
+    def dof_locator(self, V):
+        """Returns the :class:`DofLocator` of the function space V. It is built
+        once and shared by all turbine functions of this cache, as long as the
+        function space does not change."""
+        if self._dof_locator is None or self._dof_locator[0] is not V:
+            log(INFO, "Building the DOF locator for the turbine function space.")
+            self._dof_locator = (V, DofLocator(V))
+        return self._dof_locator[1]
 
     def set_turbine_specification(self, specification):
         self._specification = specification
         self._controlled_by = specification.controls
 
 
+    @profiled("turbine cache update")
     def update(self, farm):
         """Creates a list of all turbine function/derivative interpolations.
         This list is used as a cache to avoid the recomputation of the expensive
@@ -63,6 +91,16 @@ class TurbineCache(dict):
 
         # Update the cache.
         log(INFO, "Updating the turbine cache")
+        self._turbine_bumps = None
+
+        # Check if only a few turbines moved, in which case we can update the
+        # cache incrementally. This needs the turbines at their old positions.
+        changed = None
+        if not self._specification.smeared:
+            changed = self._changed_turbines(position)
+            if changed is not None:
+                old_turbines = TurbineFunction(self, self._function_space,
+                                               self._specification)
 
         # Update the positions and frictions.
         self._parameters["density"] = numpy.copy(density)
@@ -85,67 +123,130 @@ class TurbineCache(dict):
         turbines = TurbineFunction(self, self._function_space,
                                    self._specification)
 
+        if changed is not None:
+            self._update_incrementally(turbines, old_turbines, changed)
+            self._incremental_updates += 1
+            return
+        self._incremental_updates = 0
+
         self["turbine_field"] = turbines(name="turbine_friction_cache")
 
-        # Precompute the interpolation of the friction function for each turbine.
-        log(INFO, "Building individual turbine power friction functions "
-                  "for caching purposes...")
-        self["turbine_field_individual"] = [
-                TurbineFunction(self, self._function_space,
-                    self._specification)()]
-
-        # Precompute the derivatives with respect to the friction magnitude
-        # of each turbine.
-        if self._controlled_by.friction:
-            self["turbine_derivative_friction"] = []
-            for n in xrange(len(self._parameters["friction"])):
-                tfd = turbines(derivative_index=n,
-                               derivative_var="turbine_friction",
-                               name=("turbine_friction_derivative_with_"
-                                     "respect_friction_magnitude_of_turbine_"
-                                     + str(n)))
-                self["turbine_derivative_friction"].append(tfd)
-
-        elif self._controlled_by.dynamic_friction:
-            self["turbine_derivative_friction"] = []
-            for t in xrange(len(self._parameters["friction"])):
-                self["turbine_derivative_friction"].append([])
-
-                for n in xrange(len(self._parameters["friction"][t])):
-                    tfd = turbines(derivative_index=n,
-                                   derivative_var="turbine_friction",
-                                   name=("turbine_friction_derivative_with_"
-                                         "respect_friction_magnitude_of_"
-                                         "turbine_" + str(n) + "t_" +
-                                         str(t)),
-                                   timestep=t)
-                    self["turbine_derivative_friction"][t].append(tfd)
-
-        # Precompute the derivatives with respect to the turbine position.
-        if self._controlled_by.position:
-            if not self._controlled_by.dynamic_friction:
-                self["turbine_derivative_pos"] = []
-                for n in xrange(len(self._parameters["position"])):
-                    self["turbine_derivative_pos"].append({})
-                    for var in ("turbine_pos_x", "turbine_pos_y"):
-                        tfd = turbines(derivative_index=n, derivative_var=var,
-                                       name=("turbine_friction_derivative_"
-                                             "with_respect_position_of_"
-                                             "turbine_" + str(n)))
-                        self["turbine_derivative_pos"][-1][var] = tfd
-            else:
-                self["turbine_derivative_pos"] = []
-                for t in xrange(len(self._parameters["friction"])):
-                    self["turbine_derivative_pos"].append([])
-
-                    for n in xrange(len(self._parameters["position"])):
-                        self["turbine_derivative_pos"][t].append({})
-                        for var in ("turbine_pos_x", "turbine_pos_y"):
-                            tfd = turbines(derivative_index=n,
-                                           derivative_var=var,
-                                           name=("turbine_friction_"
-                                                 "derivative_with_respect_"
-                                                 "position_of_turbine_" +
-                                                 str(n)),
-                                           timestep=t)
-                            self["turbine_derivative_pos"][t][-1][var] = tfd
+        # Precompute the derivatives of the turbine field with respect to all
+        # controls in one batched pass. They are stored as a sparse
+        # (DOF x control) matrix, since each column is only non-zero within
+        # the support of a single turbine.
+        log(INFO, "Building the turbine derivative operator...")
+        friction_control = (self._controlled_by.friction or
+                            self._controlled_by.dynamic_friction)
+        position_control = self._controlled_by.position
+        derivatives = turbines.derivatives(friction=friction_control,
+                                           position=position_control)
+        self["turbine_derivatives"] = derivatives
+
+    def turbine_bumps(self):
+        """Returns the bump functions of the turbines as a sparse
+        (DOF x turbine) matrix. The turbine field is the sum of its columns.
+        The matrix is computed on first use after each update.
+
+        :rtype: scipy.sparse.csc_matrix
+        """
+        if self._turbine_bumps is None:
+            turbines = TurbineFunction(self, self._function_space,
+                                       self._specification)
+            self._turbine_bumps = turbines.derivatives(friction=True)
+        return self._turbine_bumps
+
+    def turbine_field_individual(self, i):
+        """Returns the turbine field of the turbine with index i, i.e. column i
+        of :meth:`turbine_bumps`."""
+        f = Function(self._function_space, annotate=False)
+        f.vector().set_local(self.turbine_bumps()[:, i].toarray().ravel())
+        f.vector().apply("insert")
+        return f
+
+    def _changed_turbines(self, position):
+        """Returns the indices of the turbines whose position differs from the
+        cached one, or None if the cache needs to be rebuilt from scratch."""
+        if (self.incremental_update_fraction <= 0 or
+            "turbine_field" not in self or
+            "turbine_derivatives" not in self or
+            self._incremental_updates >= self.incremental_rebuild_period or
+            len(self._parameters["position"]) != len(position) or
+            len(position) == 0):
+            return None
+
+        old = numpy.reshape(self._parameters["position"], (-1, 2))
+        new = numpy.reshape(position, (-1, 2))
+        changed = numpy.flatnonzero(numpy.any(old != new, axis=1))
+
+        if len(changed) > self.incremental_update_fraction*len(new):
+            return None
+        return changed
+
+    def _update_incrementally(self, turbines, old_turbines, changed):
+        """Updates the cached fields for the turbines with indices `changed`.
+
+        The old contributions of these turbines are subtracted from the
+        turbine field and their new contributions are added, on the DOFs
+        inside their old and new supports only. Their columns in the
+        derivative operator are replaced, all other columns are kept.
+        """
+        n_turbines = len(self._parameters["position"])
+        log(INFO, "Incrementally updating the turbine cache for %i of %i "
+                  "turbines" % (len(changed), n_turbines))
+
+        old_dofs, old_values = old_turbines.bump_values(changed)
+        new_dofs, new_values = turbines.bump_values(changed)
+        dofs, inverse = numpy.unique(numpy.concatenate((old_dofs, new_dofs)),
+                                     return_inverse=True)
+        delta = numpy.bincount(inverse, weights=numpy.concatenate((-old_values,
+                                                                   new_values)))
+        dofs = dofs.astype(numpy.intc)
+        if len(dofs) > 0:
+            vector = self["turbine_field"].vector()
+            vector[dofs] = vector[dofs] + delta
+            vector.apply("insert")
+
+        friction_control = (self._controlled_by.friction or
+                            self._controlled_by.dynamic_friction)
+        position_control = self._controlled_by.position
+
+        # Find the columns of the moved turbines in the derivative operator.
+        columns = []
+        shift = 0
+        if friction_control:
+            columns.append(changed)
+            shift = n_turbines
+        if position_control:
+            columns += [shift+2*changed, shift+2*changed+1]
+
+        if len(columns) == 0:
+            return
+
+        self["turbine_derivatives"] = self._replace_columns(
+            self["turbine_derivatives"], numpy.concatenate(columns),
+            turbines.derivatives(friction=friction_control,
+                                 position=position_control, indices=changed))
+
+    @staticmethod
+    def _replace_columns(matrix, columns, new):
+        """Returns the sparse matrix with the given columns taken from the
+        matrix `new`. The column arrays are spliced together without any
+        arithmetic on the unchanged columns.
+
+        :type matrix: scipy.sparse.csc_matrix
+        :type new: scipy.sparse.csc_matrix
+        """
+        counts = numpy.diff(matrix.indptr)
+        starts = matrix.indptr[:-1].copy()
+        counts[columns] = numpy.diff(new.indptr)[columns]
+        starts[columns] = len(matrix.data) + new.indptr[columns]
+
+        indptr = numpy.concatenate(([0], numpy.cumsum(counts)))
+        entries = (numpy.repeat(starts - indptr[:-1], counts) +
+                   numpy.arange(indptr[-1]))
+
+        data = numpy.concatenate((matrix.data, new.data))[entries]
+        indices = numpy.concatenate((matrix.indices, new.indices))[entries]
+        return scipy.sparse.csc_matrix((data, indices, indptr),
+                                       shape=matrix.shape)
@@ -0,0 +1,60 @@
+""" Distances between turbine pairs, shared by the minimum distance
+constraints. """
+import numpy
+import scipy.sparse
+from scipy.spatial import cKDTree
+
+
+def turbine_pairs(xy, cutoff=None):
+    """ Returns the index arrays (i, j) of the turbine pairs with i > j, in the
+    order of the loop ``for i in range(n): for j in range(i)``. If a cutoff is
+    given, only the pairs closer than the cutoff distance are returned. """
+    if cutoff is None:
+        return numpy.tril_indices(len(xy), -1)
+
+    pairs = numpy.array(sorted([(i, j) for j, i in
+                                cKDTree(xy).query_pairs(cutoff)]), dtype=int)
+    if len(pairs) == 0:
+        return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def squared_distances(xy, i, j):
+    """ Returns the squared distances of the turbine pairs (i, j). """
+    d = xy[i] - xy[j]
+    return (d**2).sum(axis=1)
+
+
+def squared_distances_jacobian(xy, i, j, shift, n_controls):
+    """ Returns the sparse jacobian of the squared distances of the turbine
+    pairs (i, j) with respect to the control vector, in which the turbine
+    positions start at index shift. """
+    d = 2*(xy[i] - xy[j])
+    rows = numpy.tile(numpy.arange(len(i)), 4)
+    cols = numpy.concatenate((shift+2*i, shift+2*i+1, shift+2*j, shift+2*j+1))
+    data = numpy.concatenate((d[:, 0], d[:, 1], -d[:, 0], -d[:, 1]))
+    return scipy.sparse.csr_matrix((data, (rows, cols)),
+                                   shape=(len(i), n_controls))
+
+
+def check_cutoff(cutoff, minimum_distance):
+    """ Raises a ValueError if the cutoff of the constrained pairs is smaller
+    than the minimum distance, in which case pairs that violate the minimum
+    distance would not be constrained. """
+    if cutoff is not None and cutoff < minimum_distance:
+        raise ValueError("The cutoff distance (%s) of the minimum distance "
+                         "constraints must not be smaller than the minimum "
+                         "distance (%s)." % (cutoff, minimum_distance))
+
+
+def unconstrained_pairs(xy, pairs, minimum_distance):
+    """ Returns the index arrays (i, j) of the turbine pairs that are closer
+    than the minimum distance, but are not in the constrained pairs.
+
+    The constrained pairs cannot be recomputed when the turbines move, since
+    the number of constraints must not change during an optimisation. """
+    constrained = set(zip(pairs[0], pairs[1]))
+    i, j = turbine_pairs(xy, minimum_distance)
+    keep = numpy.array([(a, b) not in constrained for a, b in zip(i, j)],
+                       dtype=bool)
+    return i[keep], j[keep]
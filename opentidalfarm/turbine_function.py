@@ -1,10 +1,54 @@
 import copy
 import numpy
+import scipy.sparse
+import scipy.spatial
 from dolfin import *
 from dolfin_adjoint import *
 
 __all__ = ["TurbineFunction"]
 
+
+class DofLocator(object):
+    """A spatial index over the DOF coordinates of a scalar function space.
+
+    The bump functions of the turbines vanish outside a square of half-width
+    `radius` around the turbine position. The locator allows to find the
+    DOFs inside that square without touching the rest of the mesh.
+    """
+
+    def __init__(self, V):
+        self.x = interpolate(Expression("x[0]", degree=1), V).vector().array()
+        self.y = interpolate(Expression("x[1]", degree=1), V).vector().array()
+        self._tree = scipy.spatial.cKDTree(numpy.column_stack((self.x,
+                                                               self.y)))
+
+    def __len__(self):
+        return len(self.x)
+
+    def support(self, positions, radius):
+        """Returns the DOFs inside the square supports of the given positions.
+
+        :param positions: The (x, y) coordinates of the turbines.
+        :param radius: The half-width of the square support.
+        :returns: A tuple (dofs, owners) of integer arrays. For each DOF index
+            in `dofs`, `owners` contains the index of the position in whose
+            support the DOF lies. A DOF appears once for every support that
+            contains it.
+        """
+        positions = numpy.reshape(numpy.asarray(positions, dtype=float),
+                                  (-1, 2))
+        if len(positions) == 0:
+            return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+
+        # The infinity norm ball is exactly the square support of the bump.
+        hits = self._tree.query_ball_point(positions, radius, p=numpy.inf)
+        lengths = [len(h) for h in hits]
+        dofs = numpy.fromiter((d for h in hits for d in h), dtype=int,
+                              count=sum(lengths))
+        owners = numpy.repeat(numpy.arange(len(positions)), lengths)
+        return dofs, owners
+
+
 class TurbineFunction(object):
 
     def __init__(self, cache, V, turbine_specification):
@@ -13,12 +57,42 @@ class TurbineFunction(object):
         self._turbine_specification = turbine_specification
         self._cache = cache
 
-        # Precompute some turbine parameters for efficiency.
-        self.x = interpolate(Expression("x[0]", degree=1), V).vector().array()
-        self.y = interpolate(Expression("x[1]", degree=1), V).vector().array()
+        # Precompute some turbine parameters for efficiency. The DOF locator
+        # is kept by the turbine cache, if available.
+        if hasattr(cache, "dof_locator"):
+            self._locator = cache.dof_locator(V)
+        else:
+            self._locator = DofLocator(V)
+        self.x = self._locator.x
+        self.y = self._locator.y
         self.V = V
 
 
+    def _bumps(self, position):
+        """Evaluates the bumps of the given turbines on the DOFs inside their
+        support.
+
+        :returns: A tuple (dofs, owners, x_unit, y_unit, exp) where `exp`
+            holds the bump values at `dofs` for the turbine with index
+            `owners`, and `x_unit`/`y_unit` are the scaled coordinates of these
+            DOFs relative to the turbine.
+        """
+        eps = 1e-12
+        radius = self._turbine_specification.radius
+        dofs, owners = self._locator.support(position, radius)
+        position = numpy.reshape(numpy.asarray(position, dtype=float), (-1, 2))
+
+        x_unit = numpy.minimum(
+            numpy.maximum((self.x[dofs]-position[owners, 0])/radius, -1+eps),
+            1-eps)
+        y_unit = numpy.minimum(
+            numpy.maximum((self.y[dofs]-position[owners, 1])/radius, -1+eps),
+            1-eps)
+
+        exp = numpy.exp(-1./(1-x_unit**2)-1./(1-y_unit**2)+2)
+        return dofs, owners, x_unit, y_unit, exp
+
+
     def __call__(self, name="", derivative_index=None, derivative_var=None,
                  timestep=None):
         """If the derivative selector is i >= 0, the Expression will compute the
@@ -32,31 +106,30 @@ class TurbineFunction(object):
         else:
             position = [params["position"][derivative_index]]
 
-        ff = numpy.zeros(len(self.x))
         # Ignore division by zero.
         numpy.seterr(divide="ignore")
-        eps = 1e-12
 
+        # Only evaluate the bumps on the DOFs inside their support; the bump
+        # is exactly zero everywhere else.
+        radius = self._turbine_specification.radius
+        dofs, owners, x_unit, y_unit, exp = self._bumps(position)
+
+        if derivative_index is None:
+            values = exp
 
-        for x_pos, y_pos in position:
-            radius = self._turbine_specification.radius
-            x_unit = numpy.minimum(
-                numpy.maximum((self.x-x_pos)/radius, -1+eps), 1-eps)
-            y_unit = numpy.minimum(
-                numpy.maximum((self.y-y_pos)/radius, -1+eps), 1-eps)
+        elif derivative_var == "turbine_friction":
+            values = exp
 
-            # Apply chain rule to get the derivative with respect to the turbine
-            # friction.
-            exp = numpy.exp(-1./(1-x_unit**2)-1./(1-y_unit**2)+2)
+        elif derivative_var == "turbine_pos_x":
+            values = exp*(-2*x_unit/((1.0-x_unit**2)**2))*(-1.0/radius)
 
-            if derivative_index is None:
-                ff += exp
+        elif derivative_var == "turbine_pos_y":
+            values = exp*(-2*y_unit/((1.0-y_unit**2)**2))*(-1.0/radius)
 
-            if derivative_var == "turbine_pos_x":
-                ff += exp*(-2*x_unit/((1.0-x_unit**2)**2))*(-1.0/radius)
+        else:
+            values = numpy.zeros(len(dofs))
 
-            elif derivative_var == "turbine_pos_y":
-                ff += exp*(-2*y_unit/((1.0-y_unit**2)**2))*(-1.0/radius)
+        ff = numpy.bincount(dofs, weights=values, minlength=len(self.x))
 
         # Reset numpy to warn for zero division errors.
         numpy.seterr(divide="warn")
@@ -65,3 +138,78 @@ class TurbineFunction(object):
         f.vector().set_local(ff)
         f.vector().apply("insert")
         return f
+
+
+    def bump_values(self, indices=None):
+        """Returns the values of the bumps of the given turbines on the DOFs
+        inside their support.
+
+        :param indices: The indices of the turbines to include. Default: all.
+        :returns: A tuple (dofs, values) of arrays. A DOF appears once for
+            every support that contains it.
+        """
+        positions = numpy.reshape(
+            numpy.asarray(self._parameters["position"], dtype=float), (-1, 2))
+        if indices is not None:
+            positions = positions[indices]
+
+        numpy.seterr(divide="ignore")
+        dofs, owners, x_unit, y_unit, exp = self._bumps(positions)
+        numpy.seterr(divide="warn")
+
+        return dofs, exp
+
+
+    def derivatives(self, friction=False, position=False, indices=None):
+        """Computes the derivatives of the turbine field with respect to all
+        turbine controls in one vectorised pass.
+
+        :param friction: Include the derivatives with respect to the friction
+            of each turbine.
+        :param position: Include the derivatives with respect to the x and y
+            position of each turbine.
+        :param indices: Only compute the columns of the turbines with these
+            indices; all other columns are left empty. Default: all turbines.
+        :returns: A sparse matrix of shape (number of DOFs, number of
+            controls). The columns are ordered as the control array, i.e. the
+            frictions of all turbines first, followed by
+            [t1_x, t1_y, t2_x, t2_y, ...].
+        :rtype: scipy.sparse.csc_matrix
+        """
+        positions = numpy.reshape(
+            numpy.asarray(self._parameters["position"], dtype=float), (-1, 2))
+        n_turbines = len(positions)
+        radius = self._turbine_specification.radius
+
+        if indices is None:
+            indices = numpy.arange(n_turbines)
+        indices = numpy.asarray(indices, dtype=int)
+
+        numpy.seterr(divide="ignore")
+        dofs, owners, x_unit, y_unit, exp = self._bumps(positions[indices])
+        numpy.seterr(divide="warn")
+        owners = indices[owners]
+
+        rows, cols, vals = [], [], []
+        shift = 0
+        if friction:
+            rows.append(dofs)
+            cols.append(owners)
+            vals.append(exp)
+            shift = n_turbines
+
+        if position:
+            dx = exp*(-2*x_unit/((1.0-x_unit**2)**2))*(-1.0/radius)
+            dy = exp*(-2*y_unit/((1.0-y_unit**2)**2))*(-1.0/radius)
+            rows += [dofs, dofs]
+            cols += [shift+2*owners, shift+2*owners+1]
+            vals += [dx, dy]
+            shift += 2*n_turbines
+
+        if len(rows) == 0:
+            return scipy.sparse.csc_matrix((len(self.x), 0))
+
+        return scipy.sparse.csc_matrix(
+            (numpy.concatenate(vals),
+             (numpy.concatenate(rows), numpy.concatenate(cols))),
+            shape=(len(self.x), shift))
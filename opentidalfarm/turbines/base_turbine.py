@@ -1,8 +1,18 @@
 import dolfin
 import math
+from ..helpers import tabulated_expression
 
 class BaseTurbine(object):
     """A base turbine class from which others are derived."""
+
+    #: Points of the thrust curve whose thrust coefficient differs by less than
+    #: this from the linear interpolation of their neighbours are dropped from
+    #: the thrust coefficient expression, so that its size does not grow with
+    #: the resolution of the thrust curve. The thrust coefficient is then
+    #: accurate to within this value. Set to 0 to represent the thrust curve
+    #: exactly. Default: 1e-3
+    thrust_curve_tolerance = 1e-3
+
     def __init__(self, thrust_coefficient=None,
                  thrust_curve=None,
                  diameter=20., 
@@ -49,12 +59,13 @@ class BaseTurbine(object):
         if self._thrust_curve is None:
             return self._thrust_coefficient
         else:
-            return tabulated_expression(u, self._thrust_curve)
+            return tabulated_expression(u, self._thrust_curve,
+                                        self.thrust_curve_tolerance)
 
     def get_power_coefficient(self, u):
         """Get power coefficient C_P for given speed `u`""" 
         C_t = self.get_thrust_coefficient(u)
-        return 0.5 * C_t * (1 + sqrt(1-C_t))
+        return 0.5 * C_t * (1 + dolfin.sqrt(1-C_t))
 
     def _set_controls(self, controls):
         self._controls = controls
@@ -72,7 +83,7 @@ class BaseTurbine(object):
         
         :param u: velocity vector or speed
         :type u: dolfin.Function or float"""
-        unorm = dolfin.dot(u,u)**0.5
+        u_norm = dolfin.dot(u,u)**0.5
         return 0.5 * self.get_thrust_coefficient(u_norm) * self._swept_area * u_norm * u
 
 
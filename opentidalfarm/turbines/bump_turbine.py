@@ -47,7 +47,7 @@ class BumpTurbine(BaseTurbine):
         """Set thrust curve given as a list of pairs `(u, Ct)`."""
         if self._thrust_curve is None:
             return
-        if not hasattr(self._original_thrust_curve):
+        if not hasattr(self, "_original_thrust_curve"):
             self._original_thrust_curve = self._thrust_curve
         # translate thrust curve from (u_inf, C_t) to (u_bar, C_t)
         # where u_inf and u_bar are free-stream and depth-averaged speeds resp.
@@ -73,7 +73,7 @@ class BumpTurbine(BaseTurbine):
             # note that here we always use linear depth to avoid adding unnec. non-linearities
             area_ratio = pi * self.diameter / (4*self.depth)
             correction = 4/(1+(1-area_ratio*C_t)**0.5)**2
-        return correction * super(BumpTurbine, self).force(self, u)
+        return correction * super(BumpTurbine, self).force(u)
 
 
     def power(self, u):
@@ -92,7 +92,7 @@ class BumpTurbine(BaseTurbine):
             area_ratio = pi * self.diameter / (4*self.depth)
             correction = 4 * (1+(1-C_t)**0.5)/(1+(1-area_ratio*C_t)**0.5)**3
 
-        return correction * super(BumpTurbine, self).power(self, u)
+        return correction * super(BumpTurbine, self).power(u)
 
 
 def thrust_from_power_coefficient(Cp):
@@ -1,162 +1,416 @@
-from pylab import *
-import matplotlib.tri as Tri
+''' Converts FVCOM meshes and velocity fields to OpenTidalFarm compatible HDF5
+files.
+
+The mesh and the velocity fields are written in the HDF5 layout of DOLFIN's
+HDF5File, and can be read with
+
+.. code-block:: python
+
+    f = HDF5File(mpi_comm_world(), "mesh.h5", "r")
+    mesh = Mesh()
+    f.read(mesh, "mesh", False)
+
+    G = VectorFunctionSpace(mesh, "DG", 0)
+    u = Function(G)
+    f = HDF5File(mpi_comm_world(), "velocity.h5", "r")
+    f.read(u, "velocity/vector_0")
+
+All time levels are written to one HDF5 file, with the dataset
+velocity/vector_<i> for time level i. An XDMF file referencing the HDF5 data
+is written alongside for visualisation, for example with ParaView.
+
+The DOLFIN XML output of previous versions is still available with the
+deprecated --xml option instead of --mesh.
+
+The velocity time levels are read from the NetCDF file in chunks, so that the
+memory usage is bounded independently of the length of the FVCOM run. The
+chunks can be read in parallel.
+'''
+import os.path
+import sys
+import multiprocessing
+import numpy
 import netCDF4
-import datetime as dt
 
 
 class FVCOMReader(object):
+    """ Reads the mesh and the depth averaged velocities of a FVCOM output
+    file. All data is returned as numpy arrays. """
 
     def __init__(self, ncfile):
-        self.nc = netCDF4.Dataset(ncfile).variables
+        self.ncfile = ncfile
+        self.dataset = netCDF4.Dataset(ncfile)
+        self.nc = self.dataset.variables
+
+    def close(self):
+        self.dataset.close()
 
     @property
     def triangles(self):
-        return self.nc["trinodes"]
+        """ The node ids of each triangle as an array of shape (n, 3). """
+        return numpy.asarray(self.nc["trinodes"][:], dtype="uint64")
 
     @property
     def nodes(self):
-        return zip(self.nc["x"], self.nc["y"])
+        """ The node positions as an array of shape (n, 2). """
+        return numpy.column_stack((numpy.asarray(self.nc["x"][:]),
+                                   numpy.asarray(self.nc["y"][:])))
 
     @property
-    def velocity_x(self):
-        for timelevel in range(len(self.nc["ua"])):
-            yield self.nc["ua"][timelevel]
+    def num_timelevels(self):
+        return len(self.nc["ua"])
 
     @property
-    def velocity_y(self):
-        for timelevel in range(len(self.nc["va"])):
-            yield self.nc["va"][timelevel]
+    def julianTime(self):
+        if "julianTime" not in self.nc:
+            return numpy.arange(self.num_timelevels, dtype=float)
+        return numpy.asarray(self.nc["julianTime"][:])
 
-    @property
-    def velocity(self):
-        for timelevel in range(len(self.nc["ua"])):
-            yield zip(self.nc["ua"][timelevel], self.nc["va"][timelevel])
+    def velocity(self, start, stop):
+        """ Returns the velocities of the time levels start to stop (exclusive)
+        as an array of shape (stop-start, number of cells, 2). """
+        return numpy.stack((numpy.asarray(self.nc["ua"][start:stop]),
+                            numpy.asarray(self.nc["va"][start:stop])), axis=-1)
 
-    @property
-    def julianTime(self):
-        return self.nc["julianTime"]
+    def chunks(self, chunk_size):
+        """ Returns the (start, stop) ranges of the time level chunks. """
+        n = self.num_timelevels
+        return [(start, min(start + chunk_size, n))
+                for start in range(0, n, chunk_size)]
 
 
 class FEniCSWriter(object):
+    """ Writes meshes and DG0 functions in the HDF5 layout of DOLFIN's
+    HDF5File. h5py is only required for the HDF5 output. """
 
     def write_mesh(self, nodes, triangles, filename):
-        """ Writes a FEniCS compatible xml mesh.
+        """ Writes a FEniCS compatible HDF5 mesh.
 
             Parameters:
 
-            nodes: A list of (x, y) tuples with the node positions
-            triangles: A list of (n1, n2, n3) tuples with the node ids of each
+            nodes: An array of shape (n, 2) with the node positions
+            triangles: An array of shape (n, 3) with the node ids of each
                        triangle
-            filename: The output file (.xml) """
+            filename: The output file (.h5) """
+        import h5py
+
+        with h5py.File(filename, "w") as f:
+            group = f.create_group("mesh")
+            group.create_dataset("coordinates", data=nodes, dtype="float64")
+            topology = group.create_dataset("topology", data=triangles,
+                                            dtype="uint64")
+            topology.attrs["celltype"] = numpy.string_("triangle")
+            topology.attrs["partition"] = numpy.array([0], dtype="uint64")
+            group.create_dataset("cell_indices",
+                                 data=numpy.arange(len(triangles),
+                                                   dtype="uint64"))
+
+    def write_dg0_function(self, values, filename, name="velocity"):
+        """ Writes a FEniCS compatible DG0 function in HDF5 format.
+
+            Parameters:
 
-        f = open(filename, "w")
+            values: An array of shape (n,) or (n, dim) with the cell values
+            filename: The output file (.h5)
+            name: The name of the function in the output file """
 
-        # Write header
-        f.write('<?xml version="1.0"?>\n')
-        f.write('<dolfin xmlns:dolfin="http://fenicsproject.org">\n')
-        f.write('  <mesh celltype="triangle" dim="{}">\n'.format(2))
+        self.write_dg0_time_levels([values], filename, name=name, mode="w")
 
-        # Write nodes
-        f.write('    <vertices size="{}">\n'.format(len(nodes)))
+    def write_dg0_time_levels(self, values, filename, start=0, times=None,
+                              name="velocity", mode="a"):
+        """ Writes time levels of a FEniCS compatible DG0 function to one HDF5
+        file. Time level i is stored in the dataset name/vector_<i>, as in
+        the time series of DOLFIN's HDF5File, and is read with
+        HDF5File.read(u, "name/vector_<i>").
 
-        for i, (x, y) in enumerate(nodes):
-            f.write('      <vertex index="{}" x="{}" y="{}" />\n'.format(i, x, y))
-        f.write('    </vertices>')
+            Parameters:
 
-        # Write elements
-        f.write('    <cells size="{}">\n'.format(len(triangles)))
+            values: An array of shape (levels, n) or (levels, n, dim) with
+                    the cell values of each time level
+            filename: The output file (.h5)
+            start: The index of the first time level
+            times: The times of the time levels (optional)
+            name: The name of the function in the output file
+            mode: "w" to create the file, "a" to add the time levels to an
+                  existing file """
+        import h5py
+
+        values = numpy.asarray(values, dtype="float64")
+        num_cells = values.shape[1]
+        dim = 1 if values.ndim == 2 else values.shape[2]
+
+        with h5py.File(filename, mode) as f:
+            if name not in f:
+                group = f.create_group(name)
+                # The degrees of freedom of cell i are i*dim, ..., i*dim+dim-1
+                group.create_dataset("cells",
+                                     data=numpy.arange(num_cells,
+                                                       dtype="uint64"))
+                group.create_dataset("cell_dofs",
+                                     data=numpy.arange(num_cells*dim,
+                                                       dtype="int64"))
+                group.create_dataset("x_cell_dofs",
+                                     data=numpy.arange(0, num_cells*dim + 1,
+                                                       dim, dtype="uint64"))
+            group = f[name]
+
+            for i, value in enumerate(values):
+                dataset = group.create_dataset("vector_{}".format(start + i),
+                                               data=value.ravel())
+                if times is not None:
+                    dataset.attrs["timestamp"] = float(times[i])
+            group.attrs["count"] = len([key for key in group
+                                        if key.startswith("vector_")])
+
+    def write_xml_mesh(self, nodes, triangles, filename):
+        """ Writes a FEniCS compatible xml mesh.
 
-        for i, (n1, n2, n3) in enumerate(triangles):
-            f.write('      <triangle index="{}" v0="{}" v1="{}" v2="{}" />\n'.format(i, n1, n2, n3))
-        f.write('    </cells>\n')
+            Deprecated: use write_mesh.
 
-        # Write footer
-        f.write('  </mesh>\n')
-        f.write('</dolfin>')
+            Parameters:
 
-        f.close()
+            nodes: An array of shape (n, 2) with the node positions
+            triangles: An array of shape (n, 3) with the node ids of each
+                       triangle
+            filename: The output file (.xml) """
 
-    def write_dg0_function(self, values, filename):
+        with open(filename, "w") as f:
+            # Write header
+            f.write('<?xml version="1.0"?>\n')
+            f.write('<dolfin xmlns:dolfin="http://fenicsproject.org">\n')
+            f.write('  <mesh celltype="triangle" dim="{}">\n'.format(2))
+
+            # Write nodes
+            f.write('    <vertices size="{}">\n'.format(len(nodes)))
+            for i, (x, y) in enumerate(nodes):
+                f.write('      <vertex index="{}" x="{!r}" y="{!r}" />\n'.format(
+                    i, x, y))
+            f.write('    </vertices>\n')
+
+            # Write elements
+            f.write('    <cells size="{}">\n'.format(len(triangles)))
+            for i, (n1, n2, n3) in enumerate(triangles):
+                f.write('      <triangle index="{}" v0="{}" v1="{}" v2="{}" />\n'.format(
+                    i, n1, n2, n3))
+            f.write('    </cells>\n')
+
+            # Write footer
+            f.write('  </mesh>\n')
+            f.write('</dolfin>')
+
+    def write_xml_dg0_function(self, values, filename):
         """ Writes a FEniCS compatible DG0 function in xml format.
 
+            Deprecated: use write_dg0_function.
+
             Parameters:
 
-            values: A list of float or tuple of floats with the function values
+            values: An array of shape (n,) or (n, dim) with the cell values
             filename: The output file (.xml) """
 
+        values = numpy.asarray(values, dtype="float64")
+        if values.ndim == 1:
+            values = values[:, numpy.newaxis]
+        dim = values.shape[1]
+
+        with open(filename, "w") as f:
+            # Write header
+            f.write('<?xml version="1.0"?>\n')
+            f.write('<dolfin xmlns:dolfin="http://fenicsproject.org">\n')
+            # Write function values
+            f.write('  <function_data size="{}">\n'.format(values.size))
+            for i, value in enumerate(values):
+                for d, v in enumerate(value):
+                    f.write('    <dof index="{}" value="{!r}" cell_index="{}" '
+                            'cell_dof_index="{}" />\n'.format(i*dim + d, v,
+                                                               i, d))
+            f.write('  </function_data>\n')
+            # Write footer
+            f.write('</dolfin>')
+
+    def write_xdmf(self, mesh_file, num_nodes, num_cells, velocity_file,
+                   times, filename, name="velocity"):
+        """ Writes a XDMF time series of the time levels in the velocity file
+        for visualisation. """
+
+        mesh_file = os.path.basename(mesh_file)
+        velocity_file = os.path.basename(velocity_file)
+        grid = '''    <Grid Name="{name}_{i}" GridType="Uniform">
+      <Time Value="{time}" />
+      <Topology TopologyType="Triangle" NumberOfElements="{num_cells}">
+        <DataItem Format="HDF" Dimensions="{num_cells} 3">{mesh}:/mesh/topology</DataItem>
+      </Topology>
+      <Geometry GeometryType="XY">
+        <DataItem Format="HDF" Dimensions="{num_nodes} 2">{mesh}:/mesh/coordinates</DataItem>
+      </Geometry>
+      <Attribute Name="{name}" AttributeType="Vector" Center="Cell">
+        <DataItem ItemType="Function" Function="JOIN($0, $1, 0*$0)" Dimensions="{num_cells} 3">
+{components}
+        </DataItem>
+      </Attribute>
+    </Grid>
+'''
+        component = '''          <DataItem ItemType="HyperSlab" Dimensions="{num_cells}">
+            <DataItem Dimensions="3 1">{d} 2 {num_cells}</DataItem>
+            <DataItem Format="HDF" Dimensions="{size}">{velocity}:/{name}/vector_{i}</DataItem>
+          </DataItem>'''
+
+        with open(filename, "w") as f:
+            f.write('<?xml version="1.0"?>\n')
+            f.write('<Xdmf Version="2.0">\n')
+            f.write('  <Domain>\n')
+            f.write('  <Grid Name="TimeSeries" GridType="Collection" '
+                    'CollectionType="Temporal">\n')
+            for i, time in enumerate(times):
+                components = "\n".join(component.format(d=d,
+                    num_cells=num_cells, size=2*num_cells,
+                    velocity=velocity_file, name=name, i=i) for d in range(2))
+                f.write(grid.format(name=name, i=i, time=time,
+                                    num_cells=num_cells, num_nodes=num_nodes,
+                                    mesh=mesh_file, components=components))
+            f.write('  </Grid>\n')
+            f.write('  </Domain>\n')
+            f.write('</Xdmf>\n')
+
+
+def convert_velocity_chunk(args):
+    """ Reads the velocity time levels start to stop (exclusive). This runs
+    in a separate process, hence it opens its own NetCDF file.
+
+    If xml_base_file is given, the time levels are written to one file per
+    time level in the deprecated xml format instead of being returned. """
+    ncfile, xml_base_file, start, stop = args
+    fvcom_reader = FVCOMReader(ncfile)
+    velocity = fvcom_reader.velocity(start, stop)
+    fvcom_reader.close()
+
+    if xml_base_file is not None:
+        fenics_writer = FEniCSWriter()
+        for i, u in enumerate(velocity, start):
+            fenics_writer.write_xml_dg0_function(u, xml_base_file.format(i))
+        velocity = None
+    return start, stop, velocity
+
+
+def convert_velocity(fvcom_reader, filename, chunk_size=32, processes=1,
+                     xml=False):
+    """ Converts all velocity time levels, streaming them from the NetCDF
+    file in chunks of chunk_size time levels.
+
+    The time levels are written to the HDF5 file filename. The HDF5 file is
+    only written by this process, the other processes only read the NetCDF
+    file. With xml, the time levels are written to the deprecated xml files
+    filename_<i>.xml instead. """
+    xml_base_file = None
+    if xml:
+        xml_base_file = os.path.splitext(filename)[0] + "_{}.xml"
+    tasks = [(fvcom_reader.ncfile, xml_base_file, start, stop)
+             for start, stop in fvcom_reader.chunks(chunk_size)]
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(convert_velocity_chunk, tasks)
+    else:
+        pool = None
+        results = (convert_velocity_chunk(task) for task in tasks)
 
-        f = open(filename, "w")
-
-        # Write header
-        f.write('<?xml version="1.0"?>\n')
-        f.write('<dolfin xmlns:dolfin="http://fenicsproject.org">\n')
+    fenics_writer = FEniCSWriter()
+    times = fvcom_reader.julianTime
+    mode = "w"
+    for start, stop, velocity in results:
+        if velocity is not None:
+            fenics_writer.write_dg0_time_levels(velocity, filename, start,
+                                                times[start:stop], mode=mode)
+            mode = "a"
+        print "Wrote time levels {} to {}".format(start, stop - 1)
 
-        # Vector or scalar function?
-        if not hasattr(values[0], '__iter__'):
-            dim = 1
-        else:
-            dim = len(values[0])
-
-        # Write function values
-        f.write('  <function_data size="{}">\n'.format(len(values)*dim))
-        idx = 0
-        for i, value in enumerate(values):
-            if dim == 1:
-                f.write('    <dof index="{}" value="{}" cell_index="{}" cell_dof_index="{}" />\n'.format(idx, value, i, 0))
-                idx += 1
-            else:
-                for d, v in enumerate(value):
-                    f.write('    <dof index="{}" value="{}" cell_index="{}" cell_dof_index="{}" />\n'.format(idx, value[d], i, d))
-                    idx += 1
-        f.write('  </function_data>\n')
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-        # Write footer
-        f.write('</dolfin>')
 
-def plot(args):
-    from dolfin import plot, interactive, Mesh, Function, VectorFunctionSpace
+def plot(args, fvcom_reader):
+    from dolfin import (plot, interactive, Mesh, Function,
+                        VectorFunctionSpace, HDF5File, mpi_comm_world)
 
     # Plot the mesh
-    mesh = Mesh(args.xml)
+    if args.xml is not None:
+        mesh = Mesh(args.xml)
+    else:
+        mesh = Mesh()
+        f = HDF5File(mpi_comm_world(), args.mesh, "r")
+        f.read(mesh, "mesh", False)
+        f.close()
     plot(mesh, title="Mesh")
     interactive()
 
     # Plot velocities
     if args.velocity is not None:
         G = VectorFunctionSpace(mesh, "DG", 0)
-        base_file = args.velocity[:-4] + "_{}.xml"
+        if args.xml is not None:
+            base_file = os.path.splitext(args.velocity)[0] + "_{}.xml"
+        else:
+            f = HDF5File(mpi_comm_world(), args.velocity, "r")
 
-        for i, u in enumerate(fvcom_reader.velocity):
-            g = Function(G, base_file.format(i))
+        for i in range(fvcom_reader.num_timelevels):
+            if args.xml is not None:
+                g = Function(G, base_file.format(i))
+            else:
+                g = Function(G)
+                f.read(g, "velocity/vector_{}".format(i))
             plot(g, title="Velocity time={}".format(i))
             interactive()
 
+        if args.xml is None:
+            f.close()
+
 
 if __name__ == "__main__":
     import argparse
 
     # Read the command line arguments
-    parser = argparse.ArgumentParser(description="Converts FVCOM meshes and velocity fields to OpenTidalFarm compatible xml files")
+    parser = argparse.ArgumentParser(description="Converts FVCOM meshes and velocity fields to OpenTidalFarm compatible HDF5 files")
     parser.add_argument('--nc', required=True, help='input FVCOM filename (.nc extension)')
-    parser.add_argument('--xml', required=True, help='output OpenTidalFarm mesh filename (.xml extension)')
-    parser.add_argument('--velocity', help='output OpenTidalFarm velocity filename (.xml extension)')
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--mesh', help='output OpenTidalFarm mesh filename (.h5 extension)')
+    output.add_argument('--xml', help='deprecated, use --mesh: output OpenTidalFarm mesh filename in the xml format (.xml extension)')
+    parser.add_argument('--velocity', help='output OpenTidalFarm velocity filename (.h5 extension, or .xml with --xml)')
+    parser.add_argument('--chunk-size', type=int, default=32, help='number of time levels read from the NetCDF file at once')
+    parser.add_argument('--processes', type=int, default=1, help='number of processes converting the time levels')
     parser.add_argument('--plot', action='store_true', help='plot the results')
     args = parser.parse_args()
 
     fvcom_reader = FVCOMReader(args.nc)
-
     fenics_writer = FEniCSWriter()
-    fenics_writer.write_mesh(fvcom_reader.nodes, fvcom_reader.triangles, args.xml)
-    print "Wrote {}".format(args.xml)
+
+    nodes = fvcom_reader.nodes
+    triangles = fvcom_reader.triangles
+    if args.xml is not None:
+        print >> sys.stderr, ("Warning: --xml is deprecated and will be "
+                              "removed, use --mesh to write HDF5 files.")
+        fenics_writer.write_xml_mesh(nodes, triangles, args.xml)
+        print "Wrote {}".format(args.xml)
+    else:
+        fenics_writer.write_mesh(nodes, triangles, args.mesh)
+        print "Wrote {}".format(args.mesh)
 
     # Write velocity fields
-    if args.velocity is not None:
-        base_file = args.velocity[:-4] + "_{}.xml"
-        for i, u in enumerate(fvcom_reader.velocity):
-            fenics_writer.write_dg0_function(u, base_file.format(i))
-            print "Wrote {}".format(base_file.format(i))
+    if args.velocity is not None and args.xml is not None:
+        convert_velocity(fvcom_reader, args.velocity, args.chunk_size,
+                         args.processes, xml=True)
+
+    elif args.velocity is not None:
+        convert_velocity(fvcom_reader, args.velocity, args.chunk_size,
+                         args.processes)
+        print "Wrote {}".format(args.velocity)
+
+        xdmf_file = os.path.splitext(args.velocity)[0] + ".xdmf"
+        fenics_writer.write_xdmf(args.mesh, len(nodes), len(triangles),
+                                 args.velocity, fvcom_reader.julianTime,
+                                 xdmf_file)
+        print "Wrote {}".format(xdmf_file)
 
     print "Conversion finished."
 
     if args.plot:
-        plot(args)
+        plot(args, fvcom_reader)
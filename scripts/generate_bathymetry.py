@@ -10,11 +10,14 @@ utm_band = sys.argv[3]
 
 meshfile = sys.argv[4]
 output = sys.argv[5]
+# An optional directory in which the interpolated bathymetry is cached
+cache_dir = sys.argv[6] if len(sys.argv) > 6 else None
 
-bathexpr = BathymetryDepthExpression(bathnc, utm_zone, utm_band)
+bathexpr = BathymetryDepthExpression(filename=bathnc, utm_zone=utm_zone,
+                                     utm_band=utm_band, degree=1)
 mesh = Mesh(meshfile)
 
 V = FunctionSpace(mesh, "CG", 1)
-bath = interpolate(bathexpr, V)
+bath = bathexpr.interpolate(V, cache_dir=cache_dir)
 
 File(output) << bath
@@ -1,6 +1,7 @@
 import sys
 import os
 import pytest
+import numpy
 import dolfin
 import dolfin_adjoint
 import opentidalfarm
@@ -19,3 +20,7 @@ def pytest_runtest_setup(item):
 
     # Reset adjoint state
     dolfin_adjoint.adj_reset()
+
+    # Seed the random perturbation directions of the Taylor tests, so that
+    # they are the same on all processors
+    numpy.random.seed(21)
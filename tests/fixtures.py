@@ -76,6 +76,9 @@ def sw_nonlinear_problem_parameters():
 
 @pytest.fixture
 def multi_steady_sw_problem_parameters():
+    return default_multi_steady_sw_problem_parameters()
+
+def default_multi_steady_sw_problem_parameters():
 
     # Set the parameters for the Shallow water problem
     parameters = MultiSteadySWProblem.default_parameters()
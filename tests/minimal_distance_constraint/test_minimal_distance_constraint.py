@@ -4,6 +4,7 @@ from opentidalfarm import *
 from dolfin import log, INFO
 import numpy
 import math
+import pytest
 
 class TestMinimalDistanceConstraint(object):
 
@@ -49,3 +50,59 @@ class TestMinimalDistanceConstraint(object):
         # Let's check that the tolerance is not above a threshold
         log(INFO, "Expecting a Nan convergence order")
         assert math.isnan(minconv)
+
+    def test_cutoff_constrains_near_pairs_only(self):
+        positions = [[0, 0], [20, 0], [1000, 0], [1015, 5]]
+        m = numpy.array(positions, dtype=float).flatten()
+
+        full = MinimumDistanceConstraints(positions, 30, 0)
+        ieq = MinimumDistanceConstraints(positions, 30, 0, cutoff=100)
+
+        assert full.length() == 6
+        assert ieq.length() == 3
+
+        # The near pairs are the first and the last pair of the full list,
+        # the last constraint penalises the unconstrained pairs.
+        assert numpy.allclose(ieq.function(m), list(full.function(m)[[0, 5]])
+                                               + [0.])
+        assert numpy.allclose(ieq.jacobian(m)[:2], full.jacobian(m)[[0, 5]])
+        assert numpy.allclose(ieq.jacobian(m)[2], 0.)
+
+    def test_cutoff_penalises_unconstrained_violations(self):
+        positions = [[0, 0], [20, 0], [1000, 0], [1015, 5]]
+        ieq = MinimumDistanceConstraints(positions, 30, 0, cutoff=100)
+
+        # The second turbine moved next to the third and the fourth one
+        m = numpy.array([[0, 0], [990, 0], [1000, 0], [1015, 5]],
+                        dtype=float).flatten()
+        assert len(ieq.function(m)) == ieq.length()
+        assert numpy.isclose(ieq.function(m)[-1], (100 - 900) + (650 - 900))
+
+        ieqcons_J = lambda m: ieq.function(m)[-1]
+        ieqcons_dJ = lambda m, forget=False: ieq.jacobian(m)[-1]
+        minconv = helpers.test_gradient_array(ieqcons_J, ieqcons_dJ, m,
+                                              seed=0.1)
+        assert minconv > 1.99
+
+    def test_cutoff_smaller_than_minimum_distance_raises(self):
+        with pytest.raises(ValueError):
+            MinimumDistanceConstraints([[0, 0], [20, 0]], 30, 0, cutoff=10)
+
+    def test_large_arrays_matches_all_pairs(self):
+        numpy.random.seed(21)
+        m = numpy.random.rand(2*50)*200
+        ieq = MinimumDistanceConstraintsLargeArrays(m, 30, 0)
+
+        xy = m.reshape(-1, 2)
+        value = 0
+        gradient = numpy.zeros(len(m))
+        for i in range(len(xy)):
+            for j in range(i):
+                d = xy[i] - xy[j]
+                if d.dot(d) <= 30**2:
+                    value += d.dot(d) - 30**2
+                    gradient[2*i:2*i+2] += 2*d
+                    gradient[2*j:2*j+2] -= 2*d
+
+        assert numpy.allclose(ieq.function(m), [value])
+        assert numpy.allclose(ieq.jacobian(m), [gradient])
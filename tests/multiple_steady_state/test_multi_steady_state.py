@@ -1,7 +1,113 @@
 import os
+import sys
+import subprocess
+import distutils.spawn
 import pytest
 from opentidalfarm import *
 
+
+def reduced_functional(problem_params, domain, steps):
+    """ Returns the reduced functional of the multi steady-state problem on
+    the domain and its initial control array. """
+
+    # Some domain information
+    basin_x = 640.
+    basin_y = 320.
+
+    # Set parameters
+    problem_params.start_time = Constant(0.)
+    problem_params.dt = Constant(1.)
+    problem_params.finish_time = Constant(steps * problem_params.dt)
+    problem_params.viscosity = Constant(16)
+    problem_params.domain = domain
+    problem_params.initial_condition = Constant((1, 1, 1))
+
+    # Compute the expected eta jump for a free-stream of 2.5 m/s (without
+    # turbines) by assuming balance between the pressure and friction terms
+    u_free_stream = 2.5
+    log(INFO, "Target free-stream velocity (without turbines): %s" % u_free_stream)
+    delta_eta = problem_params.friction/problem_params.depth/problem_params.g
+    delta_eta *= u_free_stream**2
+    delta_eta *= basin_x
+    delta_eta = float(delta_eta)
+    log(INFO, "Derived head-loss difference to achieve target free-stream: %s" % delta_eta)
+
+    # Set Boundary conditions
+    bcs = BoundaryConditionSet()
+    expl = Expression("-delta_eta/2*cos(pi/steps*(t-1))",
+            delta_eta=delta_eta, t=Constant(0), steps=steps, degree=3)
+    expr = Expression("delta_eta/2*cos(pi/steps*(t-1))",
+            delta_eta=delta_eta, t=Constant(0), steps=steps, degree=3)
+    bcs.add_bc("eta", expl, 1, "strong_dirichlet")
+    bcs.add_bc("eta", expr, 2, "strong_dirichlet")
+    bcs.add_bc("u", facet_id=3, bctype="free_slip")
+    problem_params.bcs = bcs
+
+    # Create a turbine specification.
+    turbine = BumpTurbine(diameter=20., thrust_coefficient=0.8,
+                          depth=problem_params.depth)
+
+    # Create the farm.
+    site_x = 320.
+    site_y = 160.
+    site_x_start = (basin_x - site_x)/2
+    site_y_start = (basin_y - site_y)/2
+    farm = RectangularFarm(domain,
+                           site_x_start=site_x_start,
+                           site_x_end=site_x_start+site_x,
+                           site_y_start=site_y_start,
+                           site_y_end=site_y_start+site_y,
+                           turbine=turbine,
+                           site_ids=(0,1))
+
+    farm.add_regular_turbine_layout(num_x=8, num_y=4)
+    problem_params.tidal_farm = farm
+
+    # Create problem
+    problem = MultiSteadySWProblem(problem_params)
+
+    solver_params = CoupledSWSolver.default_parameters()
+    solver_params.cache_forward_state = True
+    solver_params.dump_period = -1
+    solver_params.dolfin_solver["newton_solver"]["relative_tolerance"] = 1e-15
+    solver = CoupledSWSolver(problem, solver_params)
+
+    functional = PowerFunctional(problem)
+    control = TurbineFarmControl(farm)
+    rf_params = ReducedFunctionalParameters()
+    rf_params.automatic_scaling = 5.
+    rf = ReducedFunctional(functional, control, solver, rf_params)
+    m0 = farm.control_array
+
+    return rf, m0
+
+
+def partitioned_gradient_convergence(problem_params, steps, groups):
+    """ Returns the convergence order of the Taylor test of the multi
+    steady-state problem with the time levels distributed over the given
+    number of processor groups. """
+
+    path = os.path.dirname(__file__)
+    meshfile = os.path.join(path, "mesh_coarse.xml")
+    partition = TimeLevelPartition(groups=groups)
+    problem_params.time_level_partition = partition
+    domain = FileDomain(meshfile, comm=partition.comm)
+
+    rf, m0 = reduced_functional(problem_params, domain, steps)
+
+    # Draw the perturbation direction from a private generator on the first
+    # processor and broadcast it: this also runs outside pytest (under
+    # mpirun), where conftest does not seed numpy, and all processors must
+    # perturb in the same direction.
+    p = numpy.random.RandomState(1).rand(len(m0))
+    if MPI.size(mpi_comm_world()) > 1:
+        from mpi4py import MPI as mpi4py_MPI
+        p = mpi4py_MPI.COMM_WORLD.bcast(p, root=0)
+    seed = 0.1
+    return helpers.test_gradient_array(rf.__call__, rf.derivative, m0,
+            seed=seed, perturbation_direction=p)
+
+
 class TestMultiSteadyState(object):
 
     @pytest.mark.parametrize(("steps"), [1, 3])
@@ -93,3 +199,33 @@ class TestMultiSteadyState(object):
                 seed=seed, perturbation_direction=p)
 
         assert minconv > 1.9
+
+    def test_partitioned_gradient_passes_taylor_test(self,
+            multi_steady_sw_problem_parameters):
+        # Processor groups of size one
+        groups = MPI.size(mpi_comm_world())
+        minconv = partitioned_gradient_convergence(
+            multi_steady_sw_problem_parameters, 3, groups)
+        assert minconv > 1.9
+
+    @pytest.mark.skipif(distutils.spawn.find_executable("mpirun") is None,
+                        reason="mpirun is not available")
+    def test_partitioned_gradient_passes_taylor_test_in_parallel(self):
+        # Two groups, so that each group misses some of the time levels
+        # including, for one of them, the final time level.
+        subprocess.check_call(["mpirun", "-n", "2", sys.executable,
+                               os.path.abspath(__file__), "2"])
+
+
+if __name__ == "__main__":
+    # Run the partitioned Taylor test with mpirun, e.g.
+    # mpirun -n 2 python test_multi_steady_state.py 2
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+    from fixtures import default_multi_steady_sw_problem_parameters
+
+    minconv = partitioned_gradient_convergence(
+        default_multi_steady_sw_problem_parameters(), steps=3,
+        groups=int(sys.argv[1]))
+    if minconv <= 1.9:
+        sys.exit("The Taylor test failed with convergence order %f." %
+                 minconv)
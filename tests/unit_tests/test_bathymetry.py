@@ -0,0 +1,77 @@
+from opentidalfarm import *
+import scipy.io
+import numpy
+import os
+
+
+class TestBathymetryDepthExpression(object):
+
+    def write_netcdf(self, filename):
+        nc = scipy.io.netcdf.netcdf_file(filename, "w")
+        lat = numpy.linspace(58., 59., 21)
+        lon = numpy.linspace(-4., -2., 41)
+        nc.createDimension("lat", len(lat))
+        nc.createDimension("lon", len(lon))
+        nc.createVariable("lat", "d", ("lat",))[:] = lat
+        nc.createVariable("lon", "d", ("lon",))[:] = lon
+        z = -50. - 10.*numpy.outer(lat - 58., lon + 4.)
+        nc.createVariable("z", "d", ("lat", "lon"))[:] = z
+        nc.close()
+
+    def test_bulk_interpolation_and_cache(self, tmpdir):
+        filename = str(tmpdir.join("bathymetry.nc"))
+        cache_dir = str(tmpdir.join("cache"))
+        self.write_netcdf(filename)
+
+        mesh = RectangleMesh(Point(480000, 6450000), Point(490000, 6460000),
+                             4, 4)
+        V = FunctionSpace(mesh, "CG", 1)
+        bathy_expr = BathymetryDepthExpression(filename=filename, utm_zone=30,
+                                               utm_band="V", degree=1)
+
+        reference = interpolate(bathy_expr, V)
+        depth = bathy_expr.interpolate(V, cache_dir=cache_dir)
+        assert numpy.allclose(depth.vector().array(),
+                              reference.vector().array())
+        assert len(os.listdir(cache_dir)) == 1
+
+        # The cached field is loaded without reading the NetCDF file
+        os.remove(filename)
+        self.write_netcdf(filename)
+        bathy_expr = BathymetryDepthExpression(filename=filename, utm_zone=30,
+                                               utm_band="V", degree=1)
+        cached = bathy_expr.interpolate(V, cache_dir=cache_dir)
+        assert bathy_expr._interpolator is None
+        assert numpy.allclose(cached.vector().array(),
+                              depth.vector().array())
+
+        # A different maxval is a different cache entry
+        bathy_expr.maxval = 60
+        bathy_expr.interpolate(V, cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 2
+
+    def test_changed_projection_misses_cache(self, tmpdir):
+        filename = str(tmpdir.join("bathymetry.nc"))
+        cache_dir = str(tmpdir.join("cache"))
+        self.write_netcdf(filename)
+
+        mesh = RectangleMesh(Point(480000, 6450000), Point(490000, 6460000),
+                             4, 4)
+        V = FunctionSpace(mesh, "CG", 1)
+        BathymetryDepthExpression(filename=filename, utm_zone=30,
+                                  utm_band="V",
+                                  degree=1).interpolate(V, cache_dir=cache_dir)
+
+        for zone, band in [(29, "V"), (30, "W")]:
+            bathy_expr = BathymetryDepthExpression(filename=filename,
+                                                   utm_zone=zone,
+                                                   utm_band=band, degree=1)
+            depth = bathy_expr.interpolate(V, cache_dir=cache_dir)
+
+            # The cache is missed, hence the NetCDF file is read
+            assert bathy_expr._interpolator is not None
+            reference = interpolate(bathy_expr, V)
+            assert numpy.allclose(depth.vector().array(),
+                                  reference.vector().array())
+
+        assert len(os.listdir(cache_dir)) == 3
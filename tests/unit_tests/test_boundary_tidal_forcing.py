@@ -0,0 +1,89 @@
+from opentidalfarm import *
+import datetime
+import scipy.io
+import numpy
+import pytest
+
+
+class TestBoundaryTidalForcing(object):
+
+    def write_otps(self, grid_file, data_file):
+        """ Writes a small OTPS netCDF grid and data file with M2 and S2
+        elevations that vary linearly in space. """
+        lon = numpy.linspace(-4., -2., 21)
+        lat = numpy.linspace(58., 59., 11)
+        lon_z, lat_z = numpy.meshgrid(lon, lat, indexing="ij")
+
+        nc = scipy.io.netcdf.netcdf_file(grid_file, "w")
+        nc.createDimension("nx", len(lon))
+        nc.createDimension("ny", len(lat))
+        for name, values in [("lon_z", lon_z), ("lat_z", lat_z),
+                             ("mz", numpy.ones_like(lon_z)),
+                             ("hz", 50*numpy.ones_like(lon_z))]:
+            nc.createVariable(name, "d", ("nx", "ny"))[:] = values
+        nc.close()
+
+        nc = scipy.io.netcdf.netcdf_file(data_file, "w")
+        nc.createDimension("nc", 2)
+        nc.createDimension("nct", 4)
+        nc.createDimension("nx", len(lon))
+        nc.createDimension("ny", len(lat))
+        nc.createVariable("con", "c", ("nc", "nct"))[:] = [list("m2  "),
+                                                           list("s2  ")]
+        nc.createVariable("lon_z", "d", ("nx", "ny"))[:] = lon_z
+        nc.createVariable("lat_z", "d", ("nx", "ny"))[:] = lat_z
+        h = numpy.array([1. + 0.2*(lon_z + 4.), 0.4 - 0.1*(lat_z - 58.)])
+        g = numpy.array([0.3 + 0.5*(lat_z - 58.), 1.2 + 0.2*(lon_z + 4.)])
+        nc.createVariable("hRe", "d", ("nc", "nx", "ny"))[:] = h*numpy.cos(g)
+        nc.createVariable("hIm", "d", ("nc", "nx", "ny"))[:] = -h*numpy.sin(g)
+        nc.close()
+
+    def forcing_arguments(self, tmpdir):
+        grid_file = str(tmpdir.join("grid.nc"))
+        data_file = str(tmpdir.join("data.nc"))
+        self.write_otps(grid_file, data_file)
+
+        return dict(grid_file_name=grid_file, data_file_name=data_file,
+                    ranges=((-4., -2.), (58., 59.)), utm_zone=30,
+                    utm_band="V", initial_time=datetime.datetime(2001, 9, 18),
+                    constituents=["M2", "S2"])
+
+    def function_space(self):
+        mesh = RectangleMesh(Point(480000, 6450000), Point(490000, 6460000),
+                             4, 4)
+        return FunctionSpace(mesh, "CG", 1)
+
+    def test_matches_tidal_forcing(self, tmpdir):
+        pytest.importorskip("uptide")
+        kwargs = self.forcing_arguments(tmpdir)
+        V = self.function_space()
+        forcing = BoundaryTidalForcing(V, **kwargs)
+        expr = TidalForcing(degree=1, **kwargs)
+
+        dofs = forcing._dofs
+        assert len(dofs) > 0
+        for t in [0., 3600., 5*86400. + 1234.]:
+            forcing.set_time(t)
+            expr.t = t
+            expected = interpolate(expr, V).vector().array()[dofs]
+            assert numpy.allclose(forcing.vector().array()[dofs], expected,
+                                  atol=1e-8)
+
+    def test_tabulated_times(self, tmpdir):
+        pytest.importorskip("uptide")
+        kwargs = self.forcing_arguments(tmpdir)
+        V = self.function_space()
+        times = [0., 3600., 7200.]
+        forcing = BoundaryTidalForcing(V, **kwargs)
+        tabulated = BoundaryTidalForcing(V, times=times, **kwargs)
+
+        def fail(t):
+            raise AssertionError("The forcing of a tabulated time level was "
+                                 "recomputed.")
+        tabulated._boundary_values = fail
+
+        for t in times:
+            forcing.set_time(t)
+            tabulated.set_time(t)
+            assert (tabulated.vector().array() ==
+                    forcing.vector().array()).all()
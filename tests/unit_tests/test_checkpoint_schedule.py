@@ -0,0 +1,45 @@
+from opentidalfarm import *
+from opentidalfarm.checkpointing import (CheckpointSchedule,
+                                         binomial_forward_steps)
+
+
+class TestCheckpointSchedule(object):
+
+    def test_binomial_forward_steps(self):
+        # With a single snapshot every adjoint step recomputes the forward
+        # run from the start.
+        assert binomial_forward_steps(4, 1) == (3, 6)
+        # With enough snapshots no timestep is recomputed.
+        assert binomial_forward_steps(10, 10) == (1, 9)
+        assert binomial_forward_steps(10, 3) == (2, 15)
+
+    def test_no_checkpointing_if_all_states_fit(self):
+        schedule = CheckpointSchedule(steps=10, state_bytes=100,
+                                      memory_budget=1000)
+        assert not schedule.active
+        assert schedule.recomputed_steps == 0
+
+    def test_memory_budget(self):
+        schedule = CheckpointSchedule(steps=4, state_bytes=100,
+                                      memory_budget=150)
+        assert schedule.active
+        assert schedule.snaps_in_ram == 1
+        assert schedule.recomputed_steps == 3
+
+    def test_disk_budget_reduces_recomputation(self):
+        ram_only = CheckpointSchedule(steps=100, state_bytes=100,
+                                      memory_budget=500)
+        with_disk = CheckpointSchedule(steps=100, state_bytes=100,
+                                       memory_budget=500, disk_budget=2000)
+        assert with_disk.snaps_on_disk == 20
+        assert with_disk.recomputed_steps < ram_only.recomputed_steps
+
+    def test_state_size(self):
+        V = FunctionSpace(UnitSquareMesh(4, 4), "CG", 1)
+        size = CheckpointSchedule.state_size(V, functions=1)
+        # The same size on all processors, large enough for the largest part
+        comm = mpi_comm_world()
+        assert MPI.min(comm, size) == MPI.max(comm, size)
+        assert size*MPI.size(comm) >= 25*8
+        if MPI.size(comm) == 1:
+            assert size == 25*8
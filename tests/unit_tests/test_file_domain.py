@@ -0,0 +1,54 @@
+from opentidalfarm import *
+import os
+
+
+class TestFileDomain(object):
+
+    def write_mesh(self, tmpdir):
+        mesh = UnitSquareMesh(4, 4)
+        facet_ids = FacetFunction("size_t", mesh)
+        CompiledSubDomain("near(x[0], 0) && on_boundary").mark(facet_ids, 1)
+        cell_ids = CellFunction("size_t", mesh)
+        CompiledSubDomain("x[0] <= 0.5").mark(cell_ids, 2)
+
+        mesh_file = str(tmpdir.join("mesh.xml"))
+        File(mesh_file) << mesh
+        File(str(tmpdir.join("mesh_facet_region.xml"))) << facet_ids
+        File(str(tmpdir.join("mesh_physical_region.xml"))) << cell_ids
+        return mesh_file
+
+    def check(self, domain):
+        assert MPI.sum(mpi_comm_world(), domain.mesh.num_cells()) == 32
+        assert abs(assemble(Constant(1)*domain.ds(1)) - 1) < 1e-12
+        assert abs(assemble(Constant(1)*domain.dx(2)) - 0.5) < 1e-12
+
+    def test_mesh_is_cached(self, tmpdir):
+        mesh_file = self.write_mesh(tmpdir)
+        cache_file = str(tmpdir.join("mesh.h5"))
+
+        self.check(FileDomain(mesh_file, cache_file=cache_file))
+        assert os.path.isfile(cache_file)
+
+        # The second load reads the cache file and does not rewrite it
+        mtime = os.path.getmtime(cache_file)
+        self.check(FileDomain(mesh_file, cache_file=cache_file))
+        assert os.path.getmtime(cache_file) == mtime
+
+    def test_changed_mesh_invalidates_cache(self, tmpdir):
+        mesh_file = self.write_mesh(tmpdir)
+        cache_file = str(tmpdir.join("mesh.h5"))
+        FileDomain(mesh_file, cache_file=cache_file)
+
+        File(mesh_file) << UnitSquareMesh(2, 2)
+        File(str(tmpdir.join("mesh_facet_region.xml"))) << \
+            FacetFunction("size_t", UnitSquareMesh(2, 2), 0)
+        File(str(tmpdir.join("mesh_physical_region.xml"))) << \
+            CellFunction("size_t", UnitSquareMesh(2, 2), 0)
+
+        domain = FileDomain(mesh_file, cache_file=cache_file)
+        assert MPI.sum(mpi_comm_world(), domain.mesh.num_cells()) == 8
+
+    def test_cache_is_opt_in(self, tmpdir):
+        mesh_file = self.write_mesh(tmpdir)
+        self.check(FileDomain(mesh_file))
+        assert len(tmpdir.listdir(fil="*.h5")) == 0
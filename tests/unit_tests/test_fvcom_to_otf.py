@@ -0,0 +1,87 @@
+from opentidalfarm import *
+import os
+import imp
+import numpy
+import pytest
+
+pytest.importorskip("netCDF4")
+
+script = os.path.join(os.path.dirname(__file__), os.path.pardir,
+                      os.path.pardir, "scripts", "fvcom_to_otf.py")
+fvcom_to_otf = imp.load_source("fvcom_to_otf", script)
+
+
+class TestFVCOMToOTF(object):
+
+    nodes = numpy.array([[0., 0.], [1., 0.], [0., 1.], [1., 1.], [2., 0.5]])
+    triangles = numpy.array([[0, 1, 2], [1, 3, 2], [1, 4, 3]],
+                            dtype="uint64")
+    velocity = numpy.array([[1., 2.], [3., 4.], [5., 6.]])
+
+    def check(self, mesh, u):
+        assert mesh.num_cells() == len(self.triangles)
+        assert mesh.num_vertices() == len(self.nodes)
+
+        for triangle, value in zip(self.triangles, self.velocity):
+            midpoint = self.nodes[triangle.astype(int)].mean(axis=0)
+            assert numpy.allclose(u(Point(*midpoint)), value)
+
+    def read_mesh(self, mesh_file):
+        mesh = Mesh()
+        f = HDF5File(mpi_comm_world(), mesh_file, "r")
+        f.read(mesh, "mesh", False)
+        f.close()
+        return mesh
+
+    def test_hdf5_round_trip(self, tmpdir):
+        pytest.importorskip("h5py")
+        mesh_file = str(tmpdir.join("mesh.h5"))
+        velocity_file = str(tmpdir.join("velocity_0.h5"))
+
+        writer = fvcom_to_otf.FEniCSWriter()
+        writer.write_mesh(self.nodes, self.triangles, mesh_file)
+        writer.write_dg0_function(self.velocity, velocity_file)
+
+        mesh = self.read_mesh(mesh_file)
+        u = Function(VectorFunctionSpace(mesh, "DG", 0))
+        f = HDF5File(mpi_comm_world(), velocity_file, "r")
+        f.read(u, "velocity")
+        f.close()
+
+        self.check(mesh, u)
+
+    def test_hdf5_time_levels_in_one_file(self, tmpdir):
+        pytest.importorskip("h5py")
+        mesh_file = str(tmpdir.join("mesh.h5"))
+        velocity_file = str(tmpdir.join("velocity.h5"))
+
+        writer = fvcom_to_otf.FEniCSWriter()
+        writer.write_mesh(self.nodes, self.triangles, mesh_file)
+        # Write the time levels in two chunks, the later one first
+        writer.write_dg0_time_levels([2*self.velocity, 3*self.velocity],
+                                     velocity_file, start=1, times=[1., 2.],
+                                     mode="w")
+        writer.write_dg0_time_levels([self.velocity], velocity_file, start=0,
+                                     times=[0.])
+
+        mesh = self.read_mesh(mesh_file)
+        u = Function(VectorFunctionSpace(mesh, "DG", 0))
+        f = HDF5File(mpi_comm_world(), velocity_file, "r")
+        for i in range(3):
+            f.read(u, "velocity/vector_%i" % i)
+            u.vector()[:] = u.vector().array()/(i + 1)
+            self.check(mesh, u)
+        f.close()
+
+    def test_xml_round_trip(self, tmpdir):
+        mesh_file = str(tmpdir.join("mesh.xml"))
+        velocity_file = str(tmpdir.join("velocity_0.xml"))
+
+        writer = fvcom_to_otf.FEniCSWriter()
+        writer.write_xml_mesh(self.nodes, self.triangles, mesh_file)
+        writer.write_xml_dg0_function(self.velocity, velocity_file)
+
+        mesh = Mesh(mesh_file)
+        u = Function(VectorFunctionSpace(mesh, "DG", 0), velocity_file)
+
+        self.check(mesh, u)
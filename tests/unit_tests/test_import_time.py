@@ -0,0 +1,34 @@
+import subprocess
+import sys
+from opentidalfarm.helpers import LazyModule
+
+
+def imported_modules(statement):
+    """ Returns the modules that are loaded after running the statement in a
+    fresh Python interpreter. """
+    code = "import sys; %s; print(' '.join(sys.modules))" % statement
+    return subprocess.check_output([sys.executable, "-c", code]).split()
+
+
+class TestImportTime(object):
+
+    def test_lazy_module(self):
+        colorsys = LazyModule("colorsys")
+        assert colorsys._module is None
+        assert colorsys.rgb_to_hsv(0., 0., 0.) == (0., 0., 0.)
+        assert colorsys._module is not None
+
+    def test_optional_dependencies_are_not_imported(self):
+        modules = imported_modules("import opentidalfarm")
+
+        assert "opentidalfarm" in modules
+        for name in ["uptide", "uptide.netcdf_reader", "utm", "yaml"]:
+            assert name not in modules
+
+    def test_import_does_not_seed_numpy(self):
+        code = ("import numpy; numpy.random.seed(3); import opentidalfarm; "
+                "print(numpy.random.randint(1000000))")
+        seeded = subprocess.check_output([sys.executable, "-c", code])
+
+        import numpy
+        assert int(seeded) == numpy.random.RandomState(3).randint(1000000)
@@ -0,0 +1,106 @@
+from opentidalfarm.memoize import MemoizeMutable, MemoryStore, \
+                                  AppendOnlyFileStore
+import numpy
+
+
+class TestMemoize(object):
+
+    def counting(self):
+        calls = []
+        def f(m):
+            calls.append(m)
+            return numpy.ones(100)*sum(m)
+        return f, calls
+
+    def test_memory_store_evicts_least_recently_used(self):
+        f, calls = self.counting()
+        store = MemoryStore(max_bytes=2500)
+        mem = MemoizeMutable(f, store=store)
+
+        mem([1., 2.])
+        mem([3., 4.])
+        mem([1., 2.])  # [1, 2] is now the most recently used entry
+        mem([5., 6.])
+
+        assert store.nbytes <= 2500
+        assert mem.has_cache([1., 2.])
+        assert not mem.has_cache([3., 4.])
+        assert len(calls) == 3
+
+    def test_append_only_store_reloads_evicted_values(self, tmpdir):
+        f, calls = self.counting()
+        filename = str(tmpdir.join("memo.dat"))
+        mem = MemoizeMutable(f, store=AppendOnlyFileStore(filename,
+                                                          max_bytes=1000))
+
+        values = [mem([float(i), 1.]) for i in range(5)]
+        assert len(calls) == 5
+
+        # All values are served from memory or disk without recomputation.
+        for i in range(5):
+            assert (mem([float(i), 1.]) == values[i]).all()
+        assert len(calls) == 5
+
+        # A new store indexes the existing log.
+        mem = MemoizeMutable(f, store=AppendOnlyFileStore(filename))
+        assert len(mem.memo) == 5
+        assert (mem([3., 1.]) == values[3]).all()
+        assert len(calls) == 5
+
+    def test_append_only_store_drops_truncated_record(self, tmpdir):
+        f, calls = self.counting()
+        filename = str(tmpdir.join("memo.dat"))
+        mem = MemoizeMutable(f, store=AppendOnlyFileStore(filename))
+        values = [mem([float(i), 1.]) for i in range(3)]
+
+        # Simulate an interrupted write of the last record
+        size = tmpdir.join("memo.dat").size()
+        with open(filename, "r+b") as log_file:
+            log_file.truncate(size - 10)
+
+        mem = MemoizeMutable(f, store=AppendOnlyFileStore(filename,
+                                                          max_bytes=0))
+        assert len(mem.memo) == 2
+
+        # New records are appended after the last complete one
+        values += [mem([float(i), 1.]) for i in range(3, 6)]
+        mem = MemoizeMutable(f, store=AppendOnlyFileStore(filename))
+        assert len(mem.memo) == 5
+        for i in [0, 1, 3, 4, 5]:
+            assert (mem([float(i), 1.]) == values[i]).all()
+
+    def test_checkpoint_appends_new_values_only(self, tmpdir):
+        f, calls = self.counting()
+        filename = str(tmpdir.join("checkpoint.dat"))
+        mem = MemoizeMutable(f)
+
+        mem([1., 2.])
+        mem.save_checkpoint(filename)
+        size = tmpdir.join("checkpoint.dat").size()
+
+        mem([3., 4.])
+        mem.save_checkpoint(filename)
+        assert tmpdir.join("checkpoint.dat").size() < 2*size + 100
+
+        mem = MemoizeMutable(f)
+        mem.load_checkpoint(filename)
+        assert mem.has_cache([1., 2.])
+        assert mem.has_cache([3., 4.])
+
+    def test_tolerance_reuses_nearby_control_vectors(self):
+        f, calls = self.counting()
+        mem = MemoizeMutable(f, rtol=1e-8)
+
+        m = numpy.array([1000., 2000., 3.])
+        mem(m)
+
+        # Within the tolerance, also across rounding boundaries
+        assert mem.has_cache(m*(1+1e-12))
+        assert mem.has_cache(m + numpy.array([0., 1e-6, 0.]))
+        mem(m*(1+1e-12))
+        assert len(calls) == 1
+
+        # Outside the tolerance
+        assert not mem.has_cache(m + numpy.array([0., 1e-3, 0.]))
+        mem(m + numpy.array([0., 1e-3, 0.]))
+        assert len(calls) == 2
@@ -0,0 +1,67 @@
+from opentidalfarm import *
+from opentidalfarm.helpers import OutputWriter
+from opentidalfarm.turbine_cache import TurbineCache
+import numpy
+
+
+class DummyControls(object):
+    position = True
+    friction = True
+    dynamic_friction = False
+
+
+class DummySpecification(object):
+    radius = 20.
+    smeared = False
+    controls = DummyControls()
+
+
+class DummyFarm(object):
+    def __init__(self, V, positions):
+        self._parameters = {"position": numpy.array(positions, dtype=float),
+                            "density": numpy.array([1., 2., 0.5])}
+        self.site_dx = dx(domain=V.mesh())
+        self.turbine_cache = TurbineCache()
+        self.turbine_cache.set_function_space(V)
+        self.turbine_cache.set_turbine_specification(DummySpecification())
+        self.turbine_cache.update(self)
+
+
+class DummyFunctional(object):
+    rho = 1000.
+
+    def Jt(self, state, tf):
+        speed = sqrt(state[0]**2 + state[1]**2)
+        return self.rho*tf*speed**3*dx
+
+
+class TestOutputWriter(object):
+
+    def test_turbine_diagnostics_match_individual_assembly(self):
+        domain = RectangularDomain(0, 0, 640, 320, 32, 16)
+        mesh = domain.mesh
+        V = FunctionSpace(mesh, "CG", 2)
+        W = FunctionSpace(mesh, MixedElement(finite_elements.p2p1()))
+
+        state = Function(W)
+        state.interpolate(Expression(("2 + x[0]/640", "x[1]/320 - 0.5", "0"),
+                                     degree=2))
+
+        positions = [(100., 100.), (300., 150.), (500., 200.)]
+        farm = DummyFarm(V, positions)
+        functional = DummyFunctional()
+
+        power, force = OutputWriter(functional).turbine_diagnostics(
+            state, farm, functional.rho)
+
+        u = as_vector((state[0], state[1]))
+        speed = sqrt(dot(u, u))
+        for i in range(len(positions)):
+            tf_i = farm.turbine_cache.turbine_field_individual(i)
+            expected_power = assemble(functional.Jt(state, tf_i))
+            expected_force = [assemble(functional.rho*tf_i*speed*u[k]*dx)
+                              for k in range(2)]
+
+            assert abs(power[i] - expected_power) < 1e-8*abs(expected_power)
+            assert (abs(force[i] - numpy.linalg.norm(expected_force)) <
+                    1e-8*force[i])
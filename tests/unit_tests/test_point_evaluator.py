@@ -0,0 +1,41 @@
+from opentidalfarm import *
+from opentidalfarm.helpers import PointEvaluator
+import numpy
+
+
+class TestPointEvaluator(object):
+
+    def test_batch_evaluation(self):
+        mesh = UnitSquareMesh(8, 8)
+        V = FunctionSpace(mesh, "CG", 2)
+        f = interpolate(Expression("x[0]*x[0] + x[1]", degree=2), V)
+        g = interpolate(Expression("x[0] - x[1]", degree=1), V)
+
+        evaluator = PointEvaluator(mesh)
+        points = numpy.array([[0.1, 0.2], [0.5, 0.5], [2., 0.5]])
+        values = evaluator([f, g], points)
+
+        assert values.shape == (2, 3)
+        assert numpy.allclose(values[:, :2], [[0.21, 0.75], [-0.1, 0.]])
+        assert numpy.isinf(values[:, 2]).all()
+
+        # Move the points, some of them out of their cells
+        points = numpy.array([[0.11, 0.2], [0.9, 0.1], [0.5, 0.5]])
+        values = evaluator([f], points)
+        assert numpy.allclose(values[0], [0.3221, 0.91, 0.75])
+
+    def test_unmoved_points_are_not_searched_again(self):
+        mesh = UnitSquareMesh(8, 8)
+        f = interpolate(Expression("x[0]", degree=1),
+                        FunctionSpace(mesh, "CG", 1))
+
+        evaluator = PointEvaluator(mesh)
+        points = numpy.array([[0.1, 0.2], [2., 0.5]])
+        evaluator([f], points)
+
+        # Neither the point in its cached cell nor the point outside the
+        # mesh needs the bounding box tree
+        evaluator._tree = None
+        values = evaluator([f], points)
+        assert numpy.isclose(values[0, 0], 0.1)
+        assert numpy.isinf(values[0, 1])
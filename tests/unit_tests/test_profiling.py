@@ -0,0 +1,77 @@
+import json
+import pytest
+from opentidalfarm.profiling import Profiler
+
+
+class TestProfiler(object):
+
+    def profile(self):
+        profiler = Profiler()
+        profiler.trace = True
+        for iteration in range(2):
+            profiler.iteration = iteration
+            with profiler.region("gradient evaluation"):
+                for i in range(3):
+                    with profiler.region("forward solve"):
+                        profiler.count("newton_iterations", 2)
+                with profiler.region("adjoint solve"):
+                    pass
+        return profiler
+
+    def test_nested_regions_are_aggregated_per_iteration(self):
+        summary = self.profile().summary()
+
+        assert [s["iteration"] for s in summary] == [0, 1]
+        regions = summary[0]["regions"]
+        assert sorted(regions) == ["gradient evaluation",
+                                   "gradient evaluation/adjoint solve",
+                                   "gradient evaluation/forward solve"]
+
+        forward = regions["gradient evaluation/forward solve"]
+        assert forward["calls"] == 3
+        assert forward["counters"] == {"newton_iterations": 6}
+        assert forward["time"] <= regions["gradient evaluation"]["time"]
+        assert regions["gradient evaluation"]["counters"] == {}
+
+    def test_region_is_closed_on_error(self):
+        profiler = Profiler()
+        with pytest.raises(ValueError):
+            with profiler.region("failing"):
+                raise ValueError
+        with profiler.region("next"):
+            pass
+
+        assert sorted(profiler.summary()[0]["regions"]) == ["failing", "next"]
+
+    def test_disabled(self):
+        profiler = Profiler()
+        profiler.enabled = False
+        with profiler.region("ignored"):
+            profiler.count("newton_iterations")
+
+        assert profiler.summary() == []
+
+    def test_trace_is_opt_in(self):
+        profiler = Profiler()
+        with profiler.region("forward solve"):
+            pass
+
+        assert profiler.events == []
+        assert profiler.summary()[0]["regions"]["forward solve"]["calls"] == 1
+
+    def test_export(self, tmpdir):
+        profiler = self.profile()
+
+        filename = str(tmpdir.join("profile.json"))
+        profiler.write_json(filename)
+        iterations = json.load(open(filename))["iterations"]
+        assert len(iterations) == 2
+
+        filename = str(tmpdir.join("profile_trace.json"))
+        profiler.write_chrome_trace(filename, pid=3)
+        events = json.load(open(filename))["traceEvents"]
+        assert len(events) == 2*5
+        for event in events:
+            assert event["ph"] == "X"
+            assert event["pid"] == 3
+            assert event["dur"] >= 0
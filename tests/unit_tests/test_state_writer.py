@@ -0,0 +1,48 @@
+from opentidalfarm import *
+from opentidalfarm.helpers import StateWriter
+import os
+
+
+class DummySolver(object):
+
+    class parameters:
+        output_abs_u_at_turbine_positions = False
+
+    optimisation_iteration = 0
+
+    def __init__(self, function_space, output_dir):
+        self.function_space = function_space
+        self.output_dir = output_dir
+
+        prob_params = SteadySWProblem.default_parameters()
+        self.problem = type("DummyProblem", (object,),
+                            {"parameters": prob_params})
+
+    def get_optimisation_and_search_directory(self):
+        return self.output_dir
+
+
+class TestStateWriter(object):
+
+    def test_writes_all_states(self, tmpdir):
+        mesh = UnitSquareMesh(4, 4)
+        elements = SteadySWProblem.default_parameters().finite_element()
+        W = FunctionSpace(mesh, MixedElement(elements))
+        solver = DummySolver(W, str(tmpdir))
+
+        written = []
+        def callback(state, u_out, p_out, timestep, iteration):
+            written.append(p_out.vector().max())
+
+        writer = StateWriter(solver, callback=callback)
+        state = Function(W)
+        for t in range(5):
+            state.assign(Constant((0, 0, t)))
+            writer.write(state, float(t))
+        writer.close()
+
+        assert written == [0., 1., 2., 3., 4.]
+        basename = solver.problem.parameters.finite_element.func_name
+        for field in ["u", "p"]:
+            assert os.path.exists(os.path.join(str(tmpdir),
+                                  basename + "_%s.xdmf" % field))
@@ -0,0 +1,50 @@
+from opentidalfarm import *
+from opentidalfarm.helpers import simplify_table, tabulated_expression
+import numpy
+
+
+class TestTabulatedExpression(object):
+
+    def evaluate(self, expr):
+        mesh = UnitSquareMesh(1, 1)
+        return assemble(expr*dx(domain=mesh))
+
+    def test_interpolates_table(self):
+        table = [(1., 0.5), (2., 1.), (3., 0.2), (4., 0.4)]
+        for x in [0.5, 1., 1.5, 2.7, 3.9, 4., 5.]:
+            expected = numpy.interp(x, *zip(*table)) if x >= 1. else 0.
+            value = self.evaluate(tabulated_expression(Constant(x), table))
+            assert abs(value - expected) < 1e-12
+
+    def test_derivative(self):
+        table = [(1., 0.5), (2., 1.), (3., 0.2)]
+        x = variable(Constant(2.5))
+        d = diff(tabulated_expression(x, table), x)
+        assert abs(self.evaluate(d) + 0.8) < 1e-12
+
+    def test_size_is_independent_of_resolution(self):
+        coarse = numpy.array(standard_thrust_curve(delta_u=0.1))
+        fine = numpy.array(standard_thrust_curve(delta_u=0.01))
+
+        assert len(fine) > 5*len(coarse)
+        assert len(simplify_table(fine, 1e-3)) < len(fine)/5
+
+        x = numpy.linspace(0., 7., 1000)
+        simplified = simplify_table(fine, 1e-3)
+        error = abs(numpy.interp(x, *simplified.T) - numpy.interp(x, *fine.T))
+        assert error.max() <= 1e-3
+
+    def test_default_tolerance_bounds_error(self):
+        fine = numpy.array(standard_thrust_curve(delta_u=0.01))
+        finer = numpy.array(standard_thrust_curve(delta_u=0.002))
+
+        # Refining the table beyond the tolerance does not grow the expression
+        assert (len(simplify_table(finer, 1e-3)) <=
+                len(simplify_table(fine, 1e-3)) + 2)
+
+        x = Constant(0.)
+        expr = tabulated_expression(x, finer)
+        for value in numpy.linspace(finer[0, 0], finer[-1, 0], 50):
+            x.assign(value)
+            expected = numpy.interp(value, *finer.T)
+            assert abs(self.evaluate(expr) - expected) <= 1e-3 + 1e-12
@@ -0,0 +1,29 @@
+from opentidalfarm import *
+import numpy
+
+
+class DummyFunctional(PrototypeFunctional):
+
+    def __init__(self):
+        pass
+
+    def Jt(self, state, tf):
+        return state*tf*dx
+
+
+class TestTimeIntegrator(object):
+
+    def test_form_is_compiled_once(self):
+        V = FunctionSpace(UnitSquareMesh(2, 2), "CG", 1)
+        state = interpolate(Constant(2.), V)
+        tf = interpolate(Constant(1.), V)
+
+        integrator = TimeIntegrator(None, DummyFunctional(), final_only=False)
+        for t in range(3):
+            state.assign(Constant(t))
+            integrator.add(float(t), state, tf, is_final=t == 2)
+
+        assert numpy.allclose(integrator.vals, [0., 1., 2.])
+        assert integrator.compiled_forms == 1
+        assert integrator.reused_forms == 2
+        assert integrator.integrate() == 2.
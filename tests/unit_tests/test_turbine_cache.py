@@ -0,0 +1,92 @@
+from opentidalfarm import *
+from opentidalfarm.turbine_cache import TurbineCache
+import numpy
+
+
+class DummyControls(object):
+    position = True
+    friction = True
+    dynamic_friction = False
+
+
+class DummySpecification(object):
+    radius = 20.
+    smeared = False
+    controls = DummyControls()
+
+
+class DummyFarm(object):
+    def __init__(self, positions):
+        self._parameters = {"position": numpy.array(positions, dtype=float),
+                            "density": numpy.ones(len(positions))}
+
+
+class TestTurbineCache(object):
+
+    def cache(self, V, incremental_update_fraction):
+        cache = TurbineCache()
+        cache.set_function_space(V)
+        cache.set_turbine_specification(DummySpecification())
+        cache.incremental_update_fraction = incremental_update_fraction
+        return cache
+
+    def test_incremental_update_matches_rebuild(self):
+        domain = RectangularDomain(0, 0, 640, 320, 32, 16)
+        V = FunctionSpace(domain.mesh, "CG", 2)
+
+        positions = [(100., 100.), (200., 100.), (300., 150.), (400., 200.)]
+        moved = [(100., 100.), (210., 95.), (300., 150.), (400., 200.)]
+
+        incremental = self.cache(V, incremental_update_fraction=0.5)
+        incremental.update(DummyFarm(positions))
+        incremental.update(DummyFarm(moved))
+
+        rebuilt = self.cache(V, incremental_update_fraction=0)
+        rebuilt.update(DummyFarm(moved))
+
+        assert numpy.allclose(incremental["turbine_field"].vector().array(),
+                              rebuilt["turbine_field"].vector().array())
+
+        diff = (incremental["turbine_derivatives"] -
+                rebuilt["turbine_derivatives"])
+        assert abs(diff).max() < 1e-12
+
+    def test_incremental_updates_are_periodically_rebuilt(self):
+        domain = RectangularDomain(0, 0, 640, 320, 32, 16)
+        V = FunctionSpace(domain.mesh, "CG", 2)
+
+        cache = self.cache(V, incremental_update_fraction=0.5)
+        cache.incremental_rebuild_period = 2
+
+        positions = [(100., 100.), (200., 100.), (300., 150.), (400., 200.)]
+        cache.update(DummyFarm(positions))
+        for step, increments in enumerate([1, 2, 0, 1]):
+            positions[1] = (200. + 5.*(step + 1), 100.)
+            cache.update(DummyFarm(positions))
+            assert cache._incremental_updates == increments
+
+        rebuilt = self.cache(V, incremental_update_fraction=0)
+        rebuilt.update(DummyFarm(positions))
+        assert numpy.allclose(cache["turbine_field"].vector().array(),
+                              rebuilt["turbine_field"].vector().array())
+
+    def test_turbine_bumps_sum_to_turbine_field(self):
+        domain = RectangularDomain(0, 0, 640, 320, 32, 16)
+        V = FunctionSpace(domain.mesh, "CG", 2)
+
+        positions = [(100., 100.), (200., 100.), (300., 150.)]
+        cache = self.cache(V, incremental_update_fraction=0.5)
+        cache.update(DummyFarm(positions))
+
+        bumps = cache.turbine_bumps()
+        assert bumps.shape[1] == len(positions)
+        assert numpy.allclose(numpy.asarray(bumps.sum(axis=1)).ravel(),
+                              cache["turbine_field"].vector().array())
+
+        # The individual turbine fields are the columns of the bump matrix,
+        # they are not stored in the cache
+        assert "turbine_field_individual" not in cache
+        individual = sum(cache.turbine_field_individual(i).vector().array()
+                         for i in range(len(positions)))
+        assert numpy.allclose(individual,
+                              cache["turbine_field"].vector().array())
@@ -0,0 +1,76 @@
+from opentidalfarm import *
+from opentidalfarm.turbine_function import TurbineFunction
+from opentidalfarm.turbine_cache import TurbineCache
+import numpy
+
+
+class DummyCache(object):
+    def __init__(self, positions):
+        self._parameters = {"position": numpy.array(positions, dtype=float)}
+
+
+class TestTurbineFunction(object):
+
+    def dense_bump(self, x, y, positions, radius):
+        """ The reference implementation which evaluates every bump on every
+        DOF. """
+        eps = 1e-12
+        ff = numpy.zeros(len(x))
+        with numpy.errstate(divide="ignore"):
+            for x_pos, y_pos in positions:
+                x_unit = numpy.clip((x-x_pos)/radius, -1+eps, 1-eps)
+                y_unit = numpy.clip((y-y_pos)/radius, -1+eps, 1-eps)
+                ff += numpy.exp(-1./(1-x_unit**2)-1./(1-y_unit**2)+2)
+        return ff
+
+    def test_support_limited_evaluation_matches_dense(self):
+        domain = RectangularDomain(0, 0, 640, 320, 64, 32)
+        V = FunctionSpace(domain.mesh, "CG", 2)
+        turbine = BumpTurbine(diameter=20.)
+
+        positions = [(100., 100.), (120., 105.), (400., 200.), (639., 1.)]
+        turbines = TurbineFunction(DummyCache(positions), V, turbine)
+
+        f = turbines()
+        ref = self.dense_bump(turbines.x, turbines.y, positions, turbine.radius)
+
+        assert numpy.allclose(f.vector().array(), ref, rtol=1e-12, atol=1e-14)
+
+    def test_dof_locator_is_kept_by_the_cache(self):
+        domain = RectangularDomain(0, 0, 640, 320, 8, 4)
+        V = FunctionSpace(domain.mesh, "CG", 1)
+        turbine = BumpTurbine(diameter=20.)
+
+        cache = TurbineCache()
+        cache.set_function_space(V)
+        cache._parameters = {"position": numpy.array([(100., 100.)])}
+
+        t1 = TurbineFunction(cache, V, turbine)
+        t2 = TurbineFunction(cache, V, turbine)
+        assert t1._locator is t2._locator
+
+        # The locator is not shared with other caches
+        other = TurbineCache()
+        other.set_function_space(V)
+        other._parameters = cache._parameters
+        assert TurbineFunction(other, V, turbine)._locator is not t1._locator
+
+    def test_derivative_matrix_matches_individual_fields(self):
+        domain = RectangularDomain(0, 0, 640, 320, 32, 16)
+        V = FunctionSpace(domain.mesh, "CG", 2)
+        turbine = BumpTurbine(diameter=40.)
+
+        positions = [(100., 100.), (120., 105.), (400., 200.)]
+        turbines = TurbineFunction(DummyCache(positions), V, turbine)
+        D = turbines.derivatives(friction=True, position=True)
+
+        n = len(positions)
+        assert D.shape == (len(turbines.x), 3*n)
+
+        for i in range(n):
+            f = turbines(derivative_index=i, derivative_var="turbine_friction")
+            assert numpy.allclose(D[:, i].toarray().ravel(), f.vector().array())
+            for j, var in enumerate(("turbine_pos_x", "turbine_pos_y")):
+                f = turbines(derivative_index=i, derivative_var=var)
+                assert numpy.allclose(D[:, n+2*i+j].toarray().ravel(),
+                                      f.vector().array())
@@ -0,0 +1,79 @@
+from opentidalfarm import *
+from opentidalfarm.solvers.warm_start import WarmStartCache
+import numpy
+
+
+class TestWarmStartCache(object):
+
+    def run(self, cache, V, controls, value):
+        cache.start(controls)
+        state = Function(V)
+        state.vector()[:] = value
+        cache.store(1., state)
+
+    def guess(self, cache, V, controls):
+        cache.start(controls)
+        state = Function(V)
+        assert cache.initial_guess(1., state)
+        return state.vector().array()
+
+    def test_nearest_control_is_used(self):
+        V = FunctionSpace(UnitSquareMesh(2, 2), "CG", 1)
+        cache = WarmStartCache(max_controls=2)
+
+        self.run(cache, V, [1., 1.], 1.)
+        self.run(cache, V, [2., 2.], 2.)
+
+        assert numpy.allclose(self.guess(cache, V, [1.1, 1.]), 1.)
+
+    def test_least_recently_used_is_evicted(self):
+        V = FunctionSpace(UnitSquareMesh(2, 2), "CG", 1)
+        cache = WarmStartCache(max_controls=2)
+
+        self.run(cache, V, [1., 1.], 1.)
+        self.run(cache, V, [2., 2.], 2.)
+        self.run(cache, V, [3., 3.], 3.)
+
+        assert len(cache) == 2
+        assert numpy.allclose(self.guess(cache, V, [1., 1.]), 2.)
+
+    def test_memory_budget_evicts_least_recently_used(self):
+        V = FunctionSpace(UnitSquareMesh(2, 2), "CG", 1)
+        cache = WarmStartCache(max_controls=10)
+        self.run(cache, V, [1., 1.], 1.)
+        run_nbytes = cache.nbytes
+
+        # The budget fits two runs
+        cache = WarmStartCache(max_controls=10, max_bytes=2*run_nbytes)
+        self.run(cache, V, [1., 1.], 1.)
+        self.run(cache, V, [2., 2.], 2.)
+        assert len(cache) == 2
+
+        self.run(cache, V, [3., 3.], 3.)
+        assert len(cache) == 2
+        assert cache.nbytes <= 2*run_nbytes
+        assert numpy.allclose(self.guess(cache, V, [1., 1.]), 2.)
+
+    def test_current_run_is_kept_over_budget(self):
+        V = FunctionSpace(UnitSquareMesh(2, 2), "CG", 1)
+        cache = WarmStartCache(max_controls=10, max_bytes=1)
+        self.run(cache, V, [1., 1.], 1.)
+        assert len(cache) == 1
+        assert numpy.allclose(self.guess(cache, V, [1., 1.]), 1.)
+
+    def test_extrapolation(self):
+        V = FunctionSpace(UnitSquareMesh(2, 2), "CG", 1)
+        cache = WarmStartCache(max_controls=2, extrapolate=True)
+
+        self.run(cache, V, [1., 1.], 1.)
+        self.run(cache, V, [2., 2.], 2.)
+
+        assert numpy.allclose(self.guess(cache, V, [2.5, 2.5]), 2.5)
+
+    def test_no_guess_for_unknown_time(self):
+        V = FunctionSpace(UnitSquareMesh(2, 2), "CG", 1)
+        cache = WarmStartCache()
+
+        self.run(cache, V, [1., 1.], 1.)
+        cache.start([1., 1.])
+        assert not cache.initial_guess(2., Function(V))